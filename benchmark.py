@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# Benchmark of the scheduler on synthetic workloads
+# Generates a workbook (N people, P positions, shift pattern, time off density), plans D days,
+# and reports the time of each phase, assignments per second and peak memory
+# Results are appended to a JSON lines file, to compare versions (--compare)
+
+import time
+import sys
+import os
+import json
+import random
+import argparse
+import tempfile
+import io
+import contextlib
+import subprocess
+from datetime import datetime, time as day_time
+
+import scheduler
+from scheduler import HOURS_IN_DAY, error, warning, print_header, print_delimiter
+
+##################################################################################
+# Constants
+##################################################################################
+
+# Preset scenarios (--scenario): people, positions, days, team size, pattern, time off density
+SCENARIOS = {
+    "example": dict(people=34,  positions=2,  days=7,  team_size=2, pattern="2h",    density=0.1),
+    "medium":  dict(people=150, positions=8,  days=14, team_size=2, pattern="mixed", density=0.2),
+    "roster":  dict(people=500, positions=25, days=28, team_size=2, pattern="mixed", density=0.2),
+}
+
+# Shift patterns (--pattern): shift length (hours) of each position, in turn
+# "mixed" also adds a person to each team in the day hours (resize at DAY_FIRST_HOUR, back at DAY_LAST_HOUR)
+PATTERNS = {"2h": [2], "3h": [3], "4h": [4], "mixed": [2, 3, 4]}
+DAY_FIRST_HOUR = 8
+DAY_LAST_HOUR = 20
+
+# Time off: hours per constraint, and planned days are within a single month (see parse_hours())
+TIME_OFF_HOURS = 6
+PREV_DATE = "2024-01-01"
+
+DEFAULT_RESULTS_FILE = "benchmark_results.jsonl"
+
+# Phases, in the order of the report
+PHASES = ["parse_input_file", "setup", "build_single_day_schedule", "write_schedule_to_xls", "color_worksheet", "save_xls",
+          "verify", "check_fairness", "check_positions", "check_teams"]
+
+
+##################################################################################
+# Synthetic workbook
+##################################################################################
+
+##################################################################################
+# Write a workbook in the format of Example.xlsx
+# Names are written inverted, same as the scheduler expects them
+def generate_workbook(file_name, people, positions, team_size, pattern, density, days, seed):
+    import openpyxl
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook()
+
+    # List of people, with time off for part of them
+    names = [f"P{i:04d}" for i in range(people)]
+    worksheet = workbook.active
+    worksheet.title = "List of people"
+    worksheet.append(["People", "Time off", "Time on"])
+    first_day = int(scheduler.get_next_date(PREV_DATE).split("-")[2])
+    month = int(PREV_DATE.split("-")[1])
+    for name in names:
+        time_off = None
+        if rng.random() < density:
+            day = first_day + rng.randrange(days)
+            start_hour = rng.randrange(HOURS_IN_DAY - TIME_OFF_HOURS + 1)
+            time_off = f"{day}/{month} {start_hour:02d}:00-{start_hour + TIME_OFF_HOURS:02d}:00"
+        worksheet.append([name[::-1], time_off, None])
+
+    # Positions
+    position_names = [f"Position {position + 1}" for position in range(positions)]
+    shift_lengths = PATTERNS[pattern]
+    for position in range(positions):
+        shift_length = shift_lengths[position % len(shift_lengths)]
+        worksheet = workbook.create_sheet(scheduler.get_position_sheet_name(position))
+        worksheet.append(["Time", "Team size", "Action", "Name"])
+        for hour in range(HOURS_IN_DAY):
+            size = team_size
+            action = "swap" if hour % shift_length == 1 else None
+            if pattern == "mixed":
+                if DAY_FIRST_HOUR <= hour < DAY_LAST_HOUR:
+                    size += 1
+                if hour in (DAY_FIRST_HOUR, DAY_LAST_HOUR) and action is None:
+                    action = "resize"
+            worksheet.append([day_time(hour, 0), size, action, position_names[position][::-1] if hour == 0 else None])
+
+    # Empty previous schedule
+    worksheet = workbook.create_sheet(PREV_DATE)
+    worksheet.append(["Time"] + [name[::-1] for name in position_names])
+    for hour in range(HOURS_IN_DAY):
+        worksheet.append(["{:02d}:00\t".format(hour)] + [None] * positions)
+
+    workbook.save(file_name)
+
+
+##################################################################################
+# Measurements
+##################################################################################
+
+##################################################################################
+# Time of each phase (seconds), and optionally its peak of traced allocations (bytes)
+class PhaseTimer:
+    def __init__(self, trace_memory=0):
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peak_bytes = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            if self.trace_memory:
+                self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), tracemalloc.get_traced_memory()[1])
+
+
+##################################################################################
+# Peak resident memory of the process (MB), None if not available (Windows)
+def get_peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+##################################################################################
+# Current version of the code: git commit, "" if not in a git repository
+def get_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+##################################################################################
+# Run the scenario on the workbook, return the result (see save_result())
+# The output of the scheduler (schedules, checks) is hidden, only the error is kept if the build fails
+def run_benchmark(file_name, scenario, policy, engine, seed, trace_memory):
+    cfg = scheduler.SchedulerCfg(input_file_name=file_name, num_of_positions=scenario["positions"],
+                                 days_to_plan=scenario["days"], seed=seed, policy=policy, engine=engine)
+    timer = PhaseTimer(trace_memory)
+    day_seconds = []
+    assignments = 0
+    status = "ok"
+
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            with timer.phase("parse_input_file"):
+                workbook_state = scheduler.parse_input_file(cfg, PREV_DATE)
+
+            # Build, one day at a time
+            planner = scheduler.Scheduler(cfg)
+            with timer.phase("setup"):
+                planned_days = planner.generate(workbook_state)
+            result = scheduler.ScheduleResult(cfg, planner.users_db, workbook_state.prev_schedule, seed)
+            while True:
+                start = time.perf_counter()
+                with timer.phase("build_single_day_schedule"):
+                    day = next(planned_days, None)
+                if day is None:
+                    break
+                day_seconds.append(time.perf_counter() - start)
+                result.add_day(*day)
+                assignments += sum(len(team) for line in day[1] for team in line)
+
+            # Write the days to a copy of the workbook (load, each sheet and its colors, save)
+            import openpyxl
+            workbook = openpyxl.load_workbook(file_name)
+            position_names = workbook_state.positions_db.position_names()
+            for date_str, schedule in result.days:
+                with timer.phase("write_schedule_to_xls"):
+                    worksheet = scheduler.write_schedule_to_xls(workbook, schedule.to_schedule(), date_str, position_names)
+                with timer.phase("color_worksheet"):
+                    scheduler.color_worksheet(worksheet)
+            with timer.phase("save_xls"):
+                workbook.save(file_name)
+
+            # Checks of the whole schedule
+            total_schedule = result.total_schedule
+            with timer.phase("verify"):
+                scheduler.verify(cfg, planner.users_db.valid_names, total_schedule)
+            with timer.phase("check_fairness"):
+                scheduler.check_fairness(cfg, planner.users_db)
+            with timer.phase("check_positions"):
+                scheduler.check_positions(cfg, total_schedule, position_names)
+            with timer.phase("check_teams"):
+                scheduler.check_teams(cfg, total_schedule)
+        except SystemExit:
+            errors = [line for line in output.getvalue().splitlines() if line.startswith("Error:")]
+            status = "failed: " + (errors[-1] if errors else "exit")
+    if trace_memory:
+        tracemalloc.stop()
+
+    build_seconds = timer.seconds.get("build_single_day_schedule", 0.0)
+    return {
+        "label": "",
+        "version": get_version(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "scenario": scenario,
+        "policy": policy,
+        "engine": engine,
+        "seed": seed,
+        "status": status,
+        "phases": {name: round(seconds, 4) for name, seconds in timer.seconds.items()},
+        "phase_peak_mb": {name: round(peak / (1024 * 1024), 2) for name, peak in timer.peak_bytes.items()},
+        "day_seconds": [round(seconds, 4) for seconds in day_seconds],
+        "assignments": assignments,
+        "assignments_per_sec": round(assignments / build_seconds) if build_seconds else 0,
+        "peak_memory_mb": get_peak_memory_mb(),
+    }
+
+
+##################################################################################
+# Report
+##################################################################################
+
+##################################################################################
+def print_result(result):
+    scenario = result["scenario"]
+    print_header(f"Benchmark: {scenario['people']} people, {scenario['positions']} positions, {scenario['days']} days, "
+                 f"team size {scenario['team_size']}, pattern {scenario['pattern']}, time off density {scenario['density']}, "
+                 f"policy {result['policy']}, engine {result['engine']}")
+    if result["status"] != "ok":
+        warning(f"The run {result['status']}, timings are partial")
+
+    total = sum(result["phases"].values())
+    for name in PHASES:
+        if name not in result["phases"]:
+            continue
+        seconds = result["phases"][name]
+        line = f"{name.ljust(scheduler.COLUMN_WIDTH)} {seconds:9.3f} s  {100 * seconds / total if total else 0:5.1f}%"
+        if name in result["phase_peak_mb"]:
+            line += f"  peak {result['phase_peak_mb'][name]:8.2f} MB"
+        print(line)
+    print_delimiter()
+
+    day_seconds = result["day_seconds"]
+    if day_seconds:
+        print(f"Day build: min {min(day_seconds):.3f} s, max {max(day_seconds):.3f} s, "
+              f"average {sum(day_seconds) / len(day_seconds):.3f} s")
+    print(f"Assignments: {result['assignments']}, {result['assignments_per_sec']} per second")
+    if result["peak_memory_mb"] is not None:
+        print(f"Peak memory: {result['peak_memory_mb']} MB")
+    print_delimiter()
+
+
+##################################################################################
+# Append the result to the results file (one JSON per line)
+def save_result(results_file_name, result):
+    with open(results_file_name, "a", encoding="utf-8") as file:
+        file.write(json.dumps(result) + "\n")
+
+
+##################################################################################
+# Print the stored results of the same scenario, policy and engine, oldest first
+def print_comparison(results_file_name, result):
+    if not os.path.exists(results_file_name):
+        error(f"File {results_file_name} does not exist.")
+    with open(results_file_name, encoding="utf-8") as file:
+        results = [json.loads(line) for line in file if line.strip()]
+    key = (json.dumps(result["scenario"], sort_keys=True), result["policy"], result["engine"])
+    results = [r for r in results if (json.dumps(r["scenario"], sort_keys=True), r["policy"], r["engine"]) == key]
+
+    print_header(f"Stored results of this scenario ({results_file_name})")
+    print(f"{'Label'.ljust(20)} {'Version'.ljust(10)} {'Date'.ljust(20)} {'Build (s)':>10} {'Total (s)':>10} "
+          f"{'Assign/s':>10} {'Peak MB':>9}")
+    for r in results:
+        print(f"{r['label'][:20].ljust(20)} {r['version'].ljust(10)} {r['date'].ljust(20)} "
+              f"{r['phases'].get('build_single_day_schedule', 0):10.3f} {sum(r['phases'].values()):10.3f} "
+              f"{r['assignments_per_sec']:10} {str(r['peak_memory_mb']):>9}")
+    print_delimiter()
+
+
+##################################################################################
+# Main
+##################################################################################
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark of the scheduler on a synthetic workbook")
+    parser.add_argument("--scenario", type=str, choices=SCENARIOS.keys(), default="example",
+                        help="Preset workload, the options below override it. Default is example")
+    parser.add_argument("--people", type=int, metavar='N', help="Number of people")
+    parser.add_argument("--positions", type=int, metavar='P', help="Number of positions")
+    parser.add_argument("--days", type=int, metavar='D', help="Number of days to plan")
+    parser.add_argument("--team_size", type=int, metavar='N', help="Team size")
+    parser.add_argument("--pattern", type=str, choices=PATTERNS.keys(),
+                        help="Shift length of the positions (mixed: 2, 3, 4 hours, and bigger teams at day)")
+    parser.add_argument("--density", type=float, metavar='X', help="Part of the people with time off (0..1)")
+    parser.add_argument("--policy", type=str, choices=scheduler.SELECTION_POLICIES.keys(), default="ttr_tier",
+                        help="Selection policy of the scheduler")
+    parser.add_argument("--engine", type=str, choices=scheduler.ENGINES, default="greedy", help="Engine of the scheduler")
+    parser.add_argument("--seed", type=int, default=1, help="Seed, for the workbook and for the build. Default is 1")
+    parser.add_argument("--trace_memory", action="store_true",
+                        help="Also report the peak of allocations of each phase (tracemalloc, slows down the run)")
+    parser.add_argument("--generate", type=str, metavar='FILE', help="Only write the synthetic workbook to FILE")
+    parser.add_argument("--results", type=str, metavar='FILE', default=DEFAULT_RESULTS_FILE,
+                        help=f"Append the result to FILE. Default is {DEFAULT_RESULTS_FILE}")
+    parser.add_argument("--no_save", action="store_true", help="Do not store the result")
+    parser.add_argument("--label", type=str, default="", help="Label of the stored result (default: empty, the git commit is stored anyway)")
+    parser.add_argument("--compare", action="store_true", help="Print the stored results of the same scenario")
+    args = parser.parse_args()
+
+    scenario = dict(SCENARIOS[args.scenario])
+    for option in scenario:
+        if getattr(args, option) is not None:
+            scenario[option] = getattr(args, option)
+    if scenario["people"] < 1 or scenario["positions"] < 1 or scenario["days"] < 1 or scenario["team_size"] < 1:
+        error("people, positions, days and team size must be positive")
+    if not 0 <= scenario["density"] <= 1:
+        error("density must be between 0 and 1")
+    return args, scenario
+
+
+def main():
+    args, scenario = parse_command_line_arguments()
+    workbook_args = (scenario["people"], scenario["positions"], scenario["team_size"], scenario["pattern"],
+                     scenario["density"], scenario["days"], args.seed)
+
+    if args.generate:
+        generate_workbook(args.generate, *workbook_args)
+        print(f"Wrote {args.generate}, previous schedule sheet {PREV_DATE}")
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "benchmark.xlsx")
+        generate_workbook(file_name, *workbook_args)
+        result = run_benchmark(file_name, scenario, args.policy, args.engine, args.seed, args.trace_memory)
+    result["label"] = args.label
+
+    print_result(result)
+    if not args.no_save:
+        save_result(args.results, result)
+    if args.compare:
+        print_comparison(args.results, result)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,6 @@
 
 # TODO:
 #######
-# - Use total_hours in choose_team_member()
-# - Allow running without generation, only analysis of the existing schedule (multiple prev)
 # - Allow running without --prev
 # - Add check for the leftest column - error if not starts with 0:00 or other way incorrect
 # - Support VIP positions? More general case, everyone should reach any position?
@@ -14,7 +12,6 @@
 # Run many times until the person who is with the worst score the most has the list amount
 # of score (served * 1 + night_served*1.5)
 # change slightly ttr_values and see if it changes something
-# Improve verify() function - currently checks that TTR is observed, check also that not two nights in a row
 # Idea, because of the shuffling in the algorithm you can run it a few times and get different results.
 # we could simply run it 50 times in a loop and take the schedule with the best standard deviation.
 # Transforming the graph into a heat map with night values or changing the graph to columns graph
@@ -23,49 +20,30 @@
 ########
 # - Errors should be warnings by default, error for developer (controlled with --arg)
 # - Consider: MAX_TTR = MIN_TTR * 2 - 1
-# - Consider: post-processing to fix fairness
 # - Allow planning for hour range (can help planning for Shabbat)
 # - Support list of people per position
-# - Improve XLS parsing (read once, all sheets, then parse)
 # - Consider:
 #   - Weight per position, per hour
 #   - Read from XLS, same as team_size or action
 #   - Use weight instead of TTR in set_ttr()
 
 
+import time
+MODULE_LOAD_START = time.perf_counter()
+
 import sys
 import os
 import random
-import pandas as pd
 import argparse
 import math
 import copy
-
-# For writing XLS file
-import openpyxl
-from openpyxl.styles import PatternFill
-from openpyxl.utils.units import cm_to_EMU
-from openpyxl.worksheet.dimensions import ColumnDimension
-from openpyxl.styles import Font
+import contextlib
+import bisect
 from datetime import datetime, timedelta
 
-##################################################################################
-# User parameters
-##################################################################################
-
-NUM_OF_POSITIONS = 5
-DAYS_TO_PLAN = 1
-SHUFFLE_COEFFICIENT = 3
-SEED = 1
-TTR_NIGHT = 9
-TTR_DAY = 4
-PERSONAL_SCHEDULE = 0
-PRINT_STATISTICS = 0
-GRAPH = 0
-DO_WRITE = 0
-INPUT_FILE_NAME = ""
-BY_SCORE = 0
-INVERT_STRINGS = 1
+# Note: heavy modules (openpyxl for the XLS file, matplotlib/numpy for --graph,
+# concurrent.futures for --tries) are imported only by the functions that need them,
+# so short runs (--help, errors) do not pay for them
 
 ##################################################################################
 # Constants
@@ -73,15 +51,61 @@ INVERT_STRINGS = 1
 
 HOURS_IN_DAY = 24
 COLUMN_WIDTH = 27
-LINE_WIDTH = 10 + NUM_OF_POSITIONS * COLUMN_WIDTH
 
-NIGHT_HOURS = [23, 0, 1, 2, 3, 4, 5, 6]
+# Startup budget: time to load this script, without the heavy modules (see --import_time)
+STARTUP_BUDGET_MS = 50
+# Heavy modules, should not be imported when the script is loaded
+# NumPy first, so the modules that import it too (openpyxl) are timed without it
+HEAVY_MODULES = ["numpy", "openpyxl", "matplotlib.pyplot", "concurrent.futures"]
+# Wide enough for 5 positions
+LINE_WIDTH = 10 + 5 * COLUMN_WIDTH
+
 DEEP_NIGHT_HOURS = [1, 2, 3, 4]
 
+# Deficit selection policy: weight halves for every DEFICIT_HALF_LIFE points of score
+DEFICIT_HALF_LIFE = 2
+# Draws out of all users before choosing among the candidates only
+DEFICIT_MAX_REJECTIONS = 16
+# Rebuild the weights when the lowest score moves this many half-lives away from their base
+DEFICIT_REBASE_HALF_LIVES = 16
+
+# Assignment engine: cost of putting a person in a slot (see Scheduler.get_assignment_cost())
+ASSIGN_TTR_WEIGHT = 0.3             # Per hour of TTR (negative TTR: rested for longer)
+ASSIGN_SCORE_WEIGHT = 1.0           # Per point of score (day_hours + night_hours*1.5)
+ASSIGN_NIGHT_WEIGHT = 1.0           # Per night hour served, at night
+ASSIGN_REPEAT_COST = 100.0          # Same position as the previous shift
+ASSIGN_TEAM_COST = 10.0             # Per previous occurrence of the team
+ASSIGN_NIGHT_FALLBACK_COST = 1e6    # Served last night (used only if there is no one else)
+ASSIGN_JITTER = 1.0                 # Random tie breaker
+# Times to solve again, while the chosen teams occurred before
+ASSIGN_TEAM_ROUNDS = 2
+
+# Post-processing (--optimize): default time budget (seconds)
+OPTIMIZE_TIME_LIMIT = 10
+# Simulated annealing: start temperature (in fairness score points), goes down to 0
+OPTIMIZE_START_TEMPERATURE = 0.05
+# Part of the moves that swap shifts of two people (the rest replace a person)
+OPTIMIZE_SWAP_RATIO = 0.5
+# Score of each shift at the same position as the previous shift of the person,
+# far above the gain of a single move, same as the build avoids them (see remove_repetative())
+OPTIMIZE_REPEAT_WEIGHT = 1.0
+
+# Format version of the checkpoint file (--checkpoint, --resume)
+CHECKPOINT_VERSION = 1
+
+# Analysis of existing schedules (--analyze): number of violations to print
+ANALYZE_MAX_VIOLATIONS = 10
+
+# Build counters (--counters): lower edges of the candidates pool size histogram bins
+COUNTERS_POOL_BINS = [0, 1, 2, 3, 5, 9, 17, 33]
+
 ##################################################################################
 # Enums
 ##################################################################################
 
+# Engines (--engine)
+ENGINES = ["greedy", "assignment"]
+
 # Actions
 NONE = 0;
 SWAP = 1;
@@ -89,10 +113,78 @@ RESIZE = 2
 
 # Colors
 COLOR_CODES = {'pink': "FFC0CB", 'blue': "ADD8E6", 'green': "98FB98", 'yellow': "FFFFE0", 'purple': "E6E6FA"}
+# Position column colors, in order. If there are more positions, the colors repeat
+POSITION_COLORS = ['pink', 'green', 'yellow', 'blue', 'purple']
 
 
 ##################################################################################
-# Class Cfg holds all user configurations
+# User parameters
+# Class SchedulerCfg holds all user configurations
+# Each schedule is built with its own SchedulerCfg, nothing is stored in globals
+##################################################################################
+class SchedulerCfg:
+    def __init__(self, input_file_name="", num_of_positions=5, days_to_plan=1, shuffle_coefficient=3, seed=None,
+                 ttr_night=9, ttr_day=4, night_hours=(23, 0, 1, 2, 3, 4, 5, 6), policy="ttr_tier", engine="greedy",
+                 personal_schedule=0, print_statistics=0, graph=0, do_write=0, invert_strings=1, tries=1, jobs=0,
+                 optimize_iterations=0, optimize_time=OPTIMIZE_TIME_LIMIT, stop_early=0, csv_file_name="",
+                 checkpoint_file_name="", resume_file_name="", analyze_last_date="", ledger_file_name="",
+                 profile=0, profile_top=0, counters=0):
+        # XLS file name
+        self.input_file_name = input_file_name
+        # Number of positions (sheets "Position 1" ... "Position N")
+        self.num_of_positions = num_of_positions
+        # Number of days to plan
+        self.days_to_plan = days_to_plan
+        # Number of lowest TTR values to choose from
+        self.shuffle_coefficient = shuffle_coefficient
+        # Random seed (None: not reproducible)
+        self.seed = seed
+        # Minimum time to rest after night/day shift
+        self.ttr_night = ttr_night
+        self.ttr_day = ttr_day
+        # Hours that count as night
+        self.night_hours = night_hours
+        # How to choose a single person out of the candidates, see SELECTION_POLICIES
+        self.policy = policy
+        # How to fill SWAP shifts: one member at a time (greedy),
+        # or all positions of the hour at once (assignment)
+        self.engine = engine
+        # Output options
+        self.personal_schedule = personal_schedule
+        self.print_statistics = print_statistics
+        self.graph = graph
+        self.do_write = do_write
+        self.invert_strings = invert_strings
+        # Also write the planned days to this CSV file ("": no CSV file)
+        self.csv_file_name = csv_file_name
+        # Best of N tries, in K parallel processes (0: number of CPUs)
+        self.tries = tries
+        self.jobs = jobs
+        # Post-processing: number of moves to try (0: no post-processing), and time budget (seconds)
+        self.optimize_iterations = optimize_iterations
+        self.optimize_time = optimize_time
+        # Stop the build at the first violation of the rest rules (see ScheduleValidator)
+        self.stop_early = stop_early
+        # Save the planner state to this file after each planned day ("": no checkpoint),
+        # and start from the planner state in this file ("": from the previous schedule sheet)
+        self.checkpoint_file_name = checkpoint_file_name
+        self.resume_file_name = resume_file_name
+        # Only analyze the existing schedule sheets, up to this date ("": build the schedule)
+        self.analyze_last_date = analyze_last_date
+        # Fairness ledger: served hours of all the runs ("": no ledger), see FairnessLedger
+        self.ledger_file_name = ledger_file_name
+        # Profile the run (see Profiler), with the top N functions and allocation sites
+        self.profile = profile
+        self.profile_top = profile_top
+        # Count the decisions of the build, per hour and position (see BuildCounters)
+        self.counters = counters
+
+    def is_night(self, hour):
+        return 1 if hour in self.night_hours else 0
+
+
+##################################################################################
+# Positions DB holds configurations of all positions
 ##################################################################################
 class PositionsDB:
     # Initialize the members
@@ -103,7 +195,7 @@ class PositionsDB:
     # Extract position names from PositionCfg list
     def position_names(self):
         position_names = []
-        for p in range(NUM_OF_POSITIONS):
+        for p in range(len(self.position)):
             position_names.append(self.position[p].name)
         return position_names
 
@@ -124,95 +216,69 @@ class PositionCfg:
     def print(self):
         print(f"Position name: {self.name}, actions: {self.action}, team_size: {self.team_size}")
 
-##################################################################################
-# User personal data
-##################################################################################
-class PersonalData:
-    def __init__(self, name="", ttr=0, prev_position=-1, total=0, night=0, time_off=[], time_on=[]):
-        # User name
-        self.name = name
-        # Remaining time to rest
-        self.ttr  = ttr
-        # Last position assigned to User
-        self.prev_position = prev_position
-        # Total hours served until now
-        self.total_hours = total
-        # Night hours served until now
-        self.night_hours = night
-        # Availability
-        self.time_off = time_off
-        self.time_on  = time_on
-
-    def print(self):
-        print(f"Name: {self.name.ljust(COLUMN_WIDTH)} TTR = {self.ttr}, prev_position = '{self.prev_position}', "
-              f"total_hours = {self.total_hours}, night_hours = {self.night_hours}")
-        print(f"Time off: {self.time_off}")
-        print(f"Time on:  {self.time_on}")
-
-    # Check if the user is available in the specified hour
-    def is_available(self, absolute_hour):
-        # Check time off
-        if absolute_hour in self.time_off:
-            return 0
-
-        # Check time on
-        if len(self.time_on) > 0 and absolute_hour not in self.time_on:
-            return 0
-
-        # Default
-        return 1
-
-    # Set night/day TTR for the user
-    def set_ttr(self, is_night):
-        # Note: need to handle a special case where Moshe starts shift at night, continues at day
-        # For example, shift of 03:00 - 07:00
-        # We detect such case when the previous TTR value ==  TTR_NIGHT+1
-        # In this case, restore NIGHT_TTR+1
-        if self.ttr == TTR_NIGHT:
-            self.ttr += 1
-            return
-
-        # Normal case
-        if is_night:
-            self.ttr = TTR_NIGHT + 1
-        else:
-            self.ttr = TTR_DAY + 1
-
-    def set_prev_position(self, position):
-        self.prev_position = position
-
-    def increment_total_hours(self):
-        self.total_hours += 1
-
-    def increment_night_hours(self):
-        self.night_hours += 1
-
-    def copy(self):
-        return PersonalData(self.name, self.ttr, self.prev_position, self.total_hours, self.night_hours, self.time_off, self.time_on)
-
-
 ##################################################################################
 # All users DB
+# Columnar store: each person gets an integer id (the order of "List of people"),
+# and personal data is kept in parallel NumPy arrays, indexed by the id
+# This way, hourly updates and candidate filtering are vectorized
 ##################################################################################
 class UsersDB:
 
-    def __init__(self, valid_names=[]):
+    def __init__(self, valid_names=[], cfg=None):
+        import numpy as np
         # List of valid names, as defined in "List of people"
         # Other names are ignored
         self.valid_names = valid_names
 
-        # Users data is a dict [name] --> PersonalData
-        self.users_data = {}
-        for name in valid_names:
-            self.users_data[name] = PersonalData(name)
+        # User configurations (TTR values, night hours)
+        self.cfg = cfg if cfg else SchedulerCfg()
+
+        # Person id --> name, name --> person id
+        self.names = list(dict.fromkeys(valid_names))
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+        num_of_users = len(self.names)
+        # Remaining time to rest is kept against a clock (hours since the DB was created):
+        # TTR = rested_at - clock, so the clock advances without touching the users
+        self.clock = 0
+        self.rested_at = np.zeros(num_of_users, dtype=np.int64)
+        # Users bucketed by rested_at, to find the lowest TTRs
+        self.ready_queue = ReadyQueue(self.rested_at)
+        # Last position assigned to user
+        self.prev_position = np.full(num_of_users, -1, dtype=np.int64)
+        # Total hours served until now
+        self.total_hours = np.zeros(num_of_users, dtype=np.int64)
+        # Night hours served until now (deep night hours count 3 times)
+        self.night_hours = np.zeros(num_of_users, dtype=np.int64)
+        # Night and deep night hours served until now, as reported by check_fairness()
+        self.night_served = np.zeros(num_of_users, dtype=np.int64)
+        self.deep_night_served = np.zeros(num_of_users, dtype=np.int64)
+        # Running statistics of total_hours and night_served, for the fairness
+        self.total_stats = RunningStats([0] * num_of_users)
+        self.night_stats = RunningStats([0] * num_of_users)
+        # Users bucketed by score, to find the lowest scores
+        self.score_index = ScoreIndex(self.get_score(np.arange(num_of_users)))
+        # Availability, list of absolute hours per user
+        self.time_off = [[] for _ in range(num_of_users)]
+        self.time_on  = [[] for _ in range(num_of_users)]
+        # Availability matrix [absolute hour - availability_first_hour][user id], see compile_availability()
+        self.availability = np.ones((0, num_of_users), dtype=bool)
+        self.availability_first_hour = 0
+
+        # Optional weighted sampler, updated when served hours change (see DeficitPolicy)
+        self.sampler = None
 
         # Teams DB
-        self.teams_db = TeamsDb();
+        self.teams_db = TeamsDb(self.names);
 
     # Print single user data
     def print_user(self, name):
-        if name in self.users_data.keys():
-            self.users_data[name].print()
+        if name in self.ids:
+            i = self.ids[name]
+            print(f"Name: {name.ljust(COLUMN_WIDTH)} TTR = {self.rested_at[i] - self.clock}, prev_position = '{self.prev_position[i]}', "
+                  f"total_hours = {self.total_hours[i]}, night_hours = {self.night_hours[i]}")
+            print(f"Time off: {self.time_off[i]}")
+            print(f"Time on:  {self.time_on[i]}")
         else:
             print(f"No '{name}' in users DB")
 
@@ -221,103 +287,149 @@ class UsersDB:
         print_header("Users DB")
         print(f"Valid names: {self.valid_names}")
         print_delimiter()
-        for name in self.users_data.keys():
-            self.users_data[name].print()
-        self.teams_db.print()
+        for name in self.names:
+            self.print_user(name)
+        self.teams_db.print(self.cfg.invert_strings)
+
+    # Remaining time to rest of all users
+    @property
+    def ttr(self):
+        return self.rested_at - self.clock
 
     # Decrement TTR for all users
     def decrement_ttr(self):
-        for name in self.users_data.keys():
-            self.users_data[name].ttr -= 1
+        self.clock += 1
+
+    # Set remaining time to rest of a single user
+    def set_user_ttr(self, user_id, ttr):
+        rested_at = self.clock + ttr
+        self.ready_queue.move(user_id, int(self.rested_at[user_id]), rested_at)
+        self.rested_at[user_id] = rested_at
 
     # Set time OFF information for all users
     def set_time_off(self, dict_time_off):
         for name in dict_time_off:
-            if name in self.users_data.keys():
-                self.users_data[name].time_off = dict_time_off[name]
+            if name in self.ids:
+                self.time_off[self.ids[name]] = dict_time_off[name]
             else:
                 error(f"'{name}' exists in 'Time off', but not in 'List of people'")
 
     # Set time ON information for all users
     def set_time_on(self, dict_time_on):
         for name in dict_time_on:
-            if name in self.users_data.keys():
-                self.users_data[name].time_on = dict_time_on[name]
+            if name in self.ids:
+                self.time_on[self.ids[name]] = dict_time_on[name]
             else:
                 error(f"'{name}' exists in 'Time on', but not in 'List of people'")
 
     # Set TTR for name
     def set_ttr(self, name, is_night):
         # Skip people that exist in prev_schedule, but not in current "List of people"
-        if not name in self.users_data.keys():
+        if not name in self.ids:
             warning(f"Cannot set TTR for '{name}', not in 'List of people'")
             return
 
-        # Set ttr
-        self.users_data[name].set_ttr(is_night)
+        # Note: need to handle a special case where Moshe starts shift at night, continues at day
+        # For example, shift of 03:00 - 07:00
+        # We detect such case when the previous TTR value ==  TTR_NIGHT+1
+        # In this case, restore NIGHT_TTR+1
+        i = self.ids[name]
+        ttr = self.rested_at[i] - self.clock
+        if ttr == self.cfg.ttr_night:
+            self.set_user_ttr(i, ttr + 1)
+            return
+
+        # Normal case
+        if is_night:
+            self.set_user_ttr(i, self.cfg.ttr_night + 1)
+        else:
+            self.set_user_ttr(i, self.cfg.ttr_day + 1)
         return
 
 
     def set_prev_position(self, name, position):
         # Skip people that exist in prev_schedule, but not in current "List of people"
-        if not name in self.users_data.keys():
+        if not name in self.ids:
             warning(f"Cannot set prev_position for '{name}', not in 'List of people'")
             return
 
         # Set prev_position
-        self.users_data[name].set_prev_position(position)
+        self.prev_position[self.ids[name]] = position
         return
 
 
     def increment_total_hours(self, name):
         # Skip people that exist in prev_schedule, but not in current "List of people"
-        if not name in self.users_data.keys():
+        if not name in self.ids:
             warning(f"Cannot increment total_hours for '{name}', not in 'List of people'")
             return
 
         # Increment
-        self.users_data[name].increment_total_hours()
+        i = self.ids[name]
+        self.total_hours[i] += 1
+        self.total_stats.replace(self.total_hours[i] - 1, self.total_hours[i])
         return
 
     def increment_night_hours(self, name):
         # Skip people that exist in prev_schedule, but not in current "List of people"
-        if not name in self.users_data.keys():
+        if not name in self.ids:
             warning(f"Cannot increment night_hours for '{name}', not in 'List of people'")
             return
 
         # Increment
-        self.users_data[name].increment_night_hours()
+        self.night_hours[self.ids[name]] += 1
         return
 
     def is_available(self, name, absolute_hour):
         # Skip people that exist in prev_schedule, but not in current "List of people"
-        if not name in self.users_data.keys():
+        if not name in self.ids:
             warning(f"Cannot check availability for '{name}', not in 'List of people'")
             return
 
         # Check availability
-        return self.users_data[name].is_available(absolute_hour)
+        i = self.ids[name]
+        hour = absolute_hour - self.availability_first_hour
+        if 0 <= hour < len(self.availability):
+            return int(self.availability[hour, i])
+        return self.is_available_by_lists(i, absolute_hour)
+
+    # Check availability from the lists of hours (for hours that are not in the availability matrix)
+    def is_available_by_lists(self, user_id, absolute_hour):
+        # Check time off
+        if absolute_hour in self.time_off[user_id]:
+            return 0
+
+        # Check time on
+        if len(self.time_on[user_id]) > 0 and absolute_hour not in self.time_on[user_id]:
+            return 0
+
+        # Default
+        return 1
+
+    # Compile time off/on of all users into the availability matrix [absolute hour][user id],
+    # for the hours [first_hour, first_hour + num_of_hours)
+    # Then, availability of everyone in a given hour is a single row
+    def compile_availability(self, num_of_hours, first_hour=0):
+        import numpy as np
+        availability = np.ones((num_of_hours, len(self.names)), dtype=bool)
+        last_hour = first_hour + num_of_hours
+        for i in range(len(self.names)):
+            # Time on: available only in these hours
+            if len(self.time_on[i]) > 0:
+                availability[:, i] = False
+                availability[[h - first_hour for h in self.time_on[i] if first_hour <= h < last_hour], i] = True
+            # Time off
+            availability[[h - first_hour for h in self.time_off[i] if first_hour <= h < last_hour], i] = False
+        self.availability = availability
+        self.availability_first_hour = first_hour
 
     def get_ttr(self, name):
         # Skip people that exist in prev_schedule, but not in current "List of people"
-        if not name in self.users_data.keys():
+        if not name in self.ids:
             error(f"Cannot get TTR for '{name}', not in 'List of people'")
             return
         else:
-            return self.users_data[name].ttr
-
-    def add_user(self, new_user):
-        name = new_user.name
-        if name in self.users_data.keys():
-            error(f"Cannot add user '{name}', already exists in UsersDB")
-        else:
-            self.users_data[name] = new_user.copy()
-
-    def del_user(self, name):
-        if name in self.users_data.keys():
-            del self.users_data[name]
-        else:
-            error(f"Cannot delete user '{name}', does not exist in UsersDB")
+            return int(self.rested_at[self.ids[name]] - self.clock)
 
 
     # When user is chosen, update its personal data
@@ -325,7 +437,7 @@ class UsersDB:
     # and when later analyzing this schedule as prev_schedule
     # To avoid counting the same shift twice, use bool update_hours flag
     def update_user(self, name, position, hour):
-        is_night = 1 if hour in NIGHT_HOURS else 0
+        is_night = self.cfg.is_night(hour)
         self.set_ttr(name, is_night)
         self.set_prev_position(name, position)
         self.increment_total_hours(name)
@@ -335,52 +447,474 @@ class UsersDB:
         if hour in DEEP_NIGHT_HOURS:
             self.increment_night_hours(name)
             self.increment_night_hours(name)
+        if name in self.ids:
+            i = self.ids[name]
+            # Update fairness
+            if is_night:
+                self.night_served[i] += 1
+                self.night_stats.replace(self.night_served[i] - 1, self.night_served[i])
+            if hour in DEEP_NIGHT_HOURS:
+                self.deep_night_served[i] += 1
+            self.update_score(i)
+
+    # Update score of a user, after the served hours changed
+    def update_score(self, user_id):
+        score = float(self.get_score(user_id))
+        self.score_index.move(user_id, score)
+        if self.sampler:
+            self.sampler.update(user_id, score)
+
+
+    # Add (or remove, if negative) served hours of a user, without serving a shift
+    # Used when the schedule is changed after the build
+    def add_hours(self, user_id, total_hours, night_hours, deep_night_hours):
+        old_total_hours = self.total_hours[user_id]
+        old_night_served = self.night_served[user_id]
+        self.total_hours[user_id] += total_hours
+        self.night_hours[user_id] += night_hours + 2 * deep_night_hours
+        self.night_served[user_id] += night_hours
+        self.deep_night_served[user_id] += deep_night_hours
+        self.total_stats.replace(old_total_hours, self.total_hours[user_id])
+        self.night_stats.replace(old_night_served, self.night_served[user_id])
+        self.update_score(user_id)
+
+    # Fairness score: standard deviation of total hours + of night hours. Lower is better
+    def get_fairness_score(self):
+        return round(self.total_stats.std(), 4) + round(self.night_stats.std(), 4)
 
-
+    # Check if there are no users in the DB
     def is_empty(self):
-        return (len(self.users_data) == 0)
+        return (len(self.names) == 0)
+
 
+    # Return score (day_hours + night_hours*1.5) of a user, or of an array of users
+    def get_score(self, user_ids):
+        return (self.total_hours[user_ids] - self.night_hours[user_ids]) + self.night_hours[user_ids]*1.5
 
     # Return dict [name] --> num_of_total_hours
     def get_total_hours(self):
-        dict_total_hours = {}
-        for name in self.users_data.keys():
-            dict_total_hours[name] = self.users_data[name].total_hours
-        return dict_total_hours
+        return dict(zip(self.names, self.total_hours.tolist()))
 
     # Return dict [name] --> num_of_night_hours
     def get_night_hours(self):
-        dict_night_hours = {}
-        for name in self.users_data.keys():
-            dict_night_hours[name] = self.users_data[name].night_hours
-        return dict_night_hours
-
-    # Get list of names that recently served at the specified position
-    def remove_repetative(self, curr_position):
-        names_to_delete = []
-        for name in self.users_data.keys():
-            if self.users_data[name].prev_position == curr_position and len(names_to_delete) < len(self.users_data.keys())-1:
-                names_to_delete.append(name)
-
-        # Remove these people from the DB
-        for name in names_to_delete:
-            self.del_user(name)
+        return dict(zip(self.names, self.night_hours.tolist()))
+
+    # Return dicts [name] --> hours: total, night and deep night, as reported by check_fairness()
+    def get_served_hours(self):
+        return (self.get_total_hours(), dict(zip(self.names, self.night_served.tolist())),
+                dict(zip(self.names, self.deep_night_served.tolist())))
+
+    # Return mask of users on the list of names (other names are ignored)
+    def get_mask(self, names):
+        import numpy as np
+        mask = np.zeros(len(self.names), dtype=bool)
+        mask[[self.ids[name] for name in names if name in self.ids]] = True
+        return mask
+
+    # Return mask of users available in the specified hour (time off/on)
+    def get_available_mask(self, absolute_hour):
+        import numpy as np
+        hour = absolute_hour - self.availability_first_hour
+        if 0 <= hour < len(self.availability):
+            return self.availability[hour]
+        return np.array([self.is_available_by_lists(i, absolute_hour) for i in range(len(self.names))], dtype=bool)
+
+    # Remove people that recently served at the specified position from the candidates mask
+    # If all the candidates served there, keep the last one
+    def remove_repetative(self, candidates, curr_position):
+        import numpy as np
+        repetative = candidates & (self.prev_position == curr_position)
+        if repetative.any() and np.array_equal(repetative, candidates):
+            repetative[np.flatnonzero(repetative)[-1]] = False
+        return candidates & ~repetative
+
+    # Planner state of all users, for a checkpoint (see PlannerCheckpoint)
+    # Dict [name] --> [TTR, prev_position, total_hours, night_hours, night_served, deep_night_served]
+    def get_state(self):
+        columns = [self.ttr, self.prev_position, self.total_hours, self.night_hours, self.night_served, self.deep_night_served]
+        return {name: [int(column[i]) for column in columns] for i, name in enumerate(self.names)}
+
+    # Restore the planner state of the users, as returned by get_state()
+    # People that are not in the state start as if they never served
+    def set_state(self, state):
+        for name, (ttr, prev_position, total_hours, night_hours, night_served, deep_night_served) in state.items():
+            # Skip people that exist in the checkpoint, but not in current "List of people"
+            if not name in self.ids:
+                warning(f"Cannot restore state of '{name}', not in 'List of people'")
+                continue
+            i = self.ids[name]
+            self.rested_at[i] = self.clock + ttr
+            self.prev_position[i] = prev_position
+            self.total_hours[i] = total_hours
+            self.night_hours[i] = night_hours
+            self.night_served[i] = night_served
+            self.deep_night_served[i] = deep_night_served
+        self.ready_queue = ReadyQueue(self.rested_at)
+        self.update_stats()
+
+    # Add served hours of earlier days (see FairnessLedger)
+    # Dict [name] --> (total hours, night hours, deep night hours), other names are ignored
+    def add_history(self, served_hours):
+        for name, (total_hours, night_hours, deep_night_hours) in served_hours.items():
+            if name in self.ids:
+                i = self.ids[name]
+                self.total_hours[i] += total_hours
+                self.night_hours[i] += night_hours + 2 * deep_night_hours
+                self.night_served[i] += night_hours
+                self.deep_night_served[i] += deep_night_hours
+        self.update_stats()
+
+    # Rebuild everything that is kept in sync with the served hours
+    def update_stats(self):
+        import numpy as np
+        self.total_stats = RunningStats(self.total_hours.tolist())
+        self.night_stats = RunningStats(self.night_served.tolist())
+        self.score_index = ScoreIndex(self.get_score(np.arange(len(self.names))))
 
-    # Check if there are no users in the DB
+
+##################################################################################
+# Running mean and variance of a fixed number of values (one per user)
+# Values are added, or replaced when they change, in O(1) (Welford's updates),
+# so the standard deviation can be read at any time without rescanning
+##################################################################################
+class RunningStats:
+    def __init__(self, values=()):
+        self.count = 0
+        self.mean = 0.0
+        # Sum of squared differences from the mean
+        self.m2 = 0.0
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def replace(self, old_value, new_value):
+        delta = float(new_value - old_value)
+        old_mean = self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * ((new_value - self.mean) + (old_value - old_mean))
+
+    def variance(self):
+        if self.count == 0:
+            return 0.0
+        return max(self.m2 / self.count, 0.0)
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+
+##################################################################################
+# Ready queue: user ids bucketed by the hour they are rested at (see UsersDB.rested_at)
+# The buckets are kept in order, so the lowest TTR tiers are found by walking
+# the first buckets, not by sorting the TTRs of all users
+##################################################################################
+class ReadyQueue:
+    def __init__(self, rested_at):
+        # Dict [rested_at hour] --> set of user ids
+        self.buckets = {}
+        # Sorted list of the buckets hours
+        self.hours = []
+        for user_id, hour in enumerate(rested_at.tolist()):
+            self.add(user_id, hour)
+
+    def add(self, user_id, hour):
+        if hour not in self.buckets:
+            self.buckets[hour] = set()
+            bisect.insort(self.hours, hour)
+        self.buckets[hour].add(user_id)
+
+    def move(self, user_id, old_hour, new_hour):
+        bucket = self.buckets[old_hour]
+        bucket.discard(user_id)
+        if not bucket:
+            del self.buckets[old_hour]
+            del self.hours[bisect.bisect_left(self.hours, old_hour)]
+        self.add(user_id, new_hour)
+
+    # Get ids of the candidates (mask) in the <num_of_tiers> lowest buckets,
+    # out of the buckets that are already rested at the clock hour
+    # Buckets without candidates do not count. The ids are returned sorted
+    def get_lowest_tiers(self, candidates_mask, clock, num_of_tiers):
+        user_ids = []
+        for hour in self.hours:
+            if hour > clock or num_of_tiers == 0:
+                break
+            tier = [user_id for user_id in self.buckets[hour] if candidates_mask[user_id]]
+            if tier:
+                user_ids += tier
+                num_of_tiers -= 1
+        return sorted(user_ids)
+
+
+##################################################################################
+# Users bucketed by score (day_hours + night_hours*1.5), sorted by score
+# Kept up to date by UsersDB.update_user(), so the lowest score is found
+# without recomputing the score of every candidate
+##################################################################################
+class ScoreIndex:
+    def __init__(self, scores):
+        # Score of each user id
+        self.scores = [float(score) for score in scores]
+        # Dict [score] --> set of user ids
+        self.buckets = {}
+        # Sorted list of the buckets scores
+        self.sorted_scores = []
+        for user_id, score in enumerate(self.scores):
+            self.add(user_id, score)
+
+    def add(self, user_id, score):
+        if score not in self.buckets:
+            self.buckets[score] = set()
+            bisect.insort(self.sorted_scores, score)
+        self.buckets[score].add(user_id)
+
+    def move(self, user_id, new_score):
+        old_score = self.scores[user_id]
+        if new_score == old_score:
+            return
+        bucket = self.buckets[old_score]
+        bucket.discard(user_id)
+        if not bucket:
+            del self.buckets[old_score]
+            del self.sorted_scores[bisect.bisect_left(self.sorted_scores, old_score)]
+        self.scores[user_id] = new_score
+        self.add(user_id, new_score)
+
+    # Get id of the user with the lowest score, out of user_ids (set)
+    # If several, the lowest id. Returns None if none of the users is found
+    def get_lowest(self, user_ids):
+        for score in self.sorted_scores:
+            bucket = self.buckets[score]
+            if len(user_ids) < len(bucket):
+                lowest = [user_id for user_id in user_ids if user_id in bucket]
+            else:
+                lowest = [user_id for user_id in bucket if user_id in user_ids]
+            if lowest:
+                return min(lowest)
+        return None
+
+
+##################################################################################
+# Candidates for a single team slot: a view of the users DB
+# Holds only the ids of the candidates (in id order), personal data is read
+# from the users DB, so nothing is copied
+##################################################################################
+class CandidatesView:
+    def __init__(self, users_db, mask):
+        import numpy as np
+        self.users_db = users_db
+        # Mask over all users, and the ids it selects
+        self.mask = mask
+        self.ids = np.flatnonzero(mask)
+
+    # Check if there are no candidates
     def is_empty(self):
-        return not self.users_data.keys()
+        return (len(self.ids) == 0)
+
+    # Get names of the candidates, optionally only the ones in mask
+    def get_names(self, mask=None):
+        ids = self.ids if mask is None else self.ids[mask]
+        return [self.users_db.names[i] for i in ids]
+
+    # Get names of the candidates with the <num_of_tiers> lowest TTR values
+    def get_names_with_lowest_ttrs(self, num_of_tiers):
+        # Sanity
+        if self.is_empty():
+            error("At function get_names_with_lowest_ttrs() got no candidates")
+
+        return [self.users_db.names[i] for i in self.get_ids_with_lowest_ttrs(num_of_tiers)]
+
+    # Get ids of the candidates with the <num_of_tiers> lowest TTR values
+    def get_ids_with_lowest_ttrs(self, num_of_tiers):
+        users_db = self.users_db
+        return users_db.ready_queue.get_lowest_tiers(self.mask, users_db.clock, num_of_tiers)
 
-    # Get user with lowest night_hours
-    def get_user_with_lowest_night_hours(self):
+    # Get night_hours of each candidate
+    def get_night_hours(self):
+        return self.users_db.night_hours[self.ids]
+
+    # Get candidate with lowest night_hours
+    def get_user_with_lowest_night_hours(self, rng):
         if self.is_empty():
-            error("Cannot get user with lowest night_hours, because UserDB is empty")
+            error("Cannot get user with lowest night_hours, because there are no candidates")
 
         night_hours = self.get_night_hours()
-        min_value = min(night_hours.values())
-        all_names_with_min_value = [key for key, value in night_hours.items() if value == min_value]
-        shuffled_list_of_names = random.sample(all_names_with_min_value, len(all_names_with_min_value))
-        name = shuffled_list_of_names[0]
-        return name
+        all_names_with_min_value = self.get_names(night_hours == night_hours.min())
+        return rng.choice(all_names_with_min_value)
+
+
+##################################################################################
+# Selection policies: how to choose a single person out of the candidates
+# of a team slot. Scheduler.plan() creates one policy per build, see SELECTION_POLICIES
+##################################################################################
+class SelectionPolicy:
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    # Called once, before the build, with the users DB of the build
+    def attach(self, users_db):
+        pass
+
+    # Return name of the chosen candidate
+    def choose(self, candidates, rng):
+        error(f"Selection policy {type(self).__name__} does not implement choose()")
+
+
+##################################################################################
+# Random candidate out of the lowest TTRs
+# Get all names for with <shuffle_coefficient> TTRs
+# (TTR, TTR+1, ... , TTR+shuffle_coefficient-1)
+class TtrTierPolicy(SelectionPolicy):
+    def choose(self, candidates, rng):
+        all_names_with_lowest_ttr = candidates.get_names_with_lowest_ttrs(self.cfg.shuffle_coefficient)
+        return rng.choice(all_names_with_lowest_ttr)
+
+
+##################################################################################
+# Candidate with the lowest score out of the lowest TTRs (first one, if several)
+class ScorePolicy(SelectionPolicy):
+    def choose(self, candidates, rng):
+        users_db = candidates.users_db
+        if candidates.is_empty():
+            error("At ScorePolicy got no candidates")
+
+        # Lowest TTRs, then lowest score out of them (from the score index)
+        ids_with_lowest_ttr = candidates.get_ids_with_lowest_ttrs(self.cfg.shuffle_coefficient)
+        user_id = users_db.score_index.get_lowest(set(ids_with_lowest_ttr))
+        if user_id is None:
+            error(f"At ScorePolicy none of the {len(ids_with_lowest_ttr)} candidates with the lowest TTRs is in the score index")
+        return users_db.names[user_id]
+
+
+##################################################################################
+# Random candidate, weighted by how little the person served:
+# the weight halves for every DEFICIT_HALF_LIFE points of score
+# The weights of all users are kept in a Fenwick tree, updated when a user serves,
+# so a pick costs O(log n) and the candidates are never copied or shuffled
+# Unlike the other policies, the TTR tiers are not used: the weights replace them
+# (the candidates are rested anyway, the rest rules are kept by the candidates mask)
+class DeficitPolicy(SelectionPolicy):
+    def attach(self, users_db):
+        import numpy as np
+        users_db.sampler = DeficitSampler(users_db.get_score(np.arange(len(users_db.names))))
+
+    def choose(self, candidates, rng):
+        users_db = candidates.users_db
+        return users_db.names[users_db.sampler.sample(candidates, rng)]
+
+
+# Policy name (--policy) --> class
+SELECTION_POLICIES = {"ttr_tier": TtrTierPolicy, "score": ScorePolicy, "deficit": DeficitPolicy}
+
+
+##################################################################################
+# Fenwick tree (binary indexed tree) of weights
+# Set a weight, sum of all weights and find by prefix sum, all in O(log n)
+##################################################################################
+class FenwickTree:
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.weights = [float(weight) for weight in weights]
+        # tree[i] holds the sum of weights (i - lowbit(i), i], 1-based
+        self.tree = [0.0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def set(self, index, weight):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        total = 0.0
+        i = self.size
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    # Find the index where the prefix sum of weights passes value
+    def find(self, value):
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if index + step <= self.size and self.tree[index + step] <= value:
+                index += step
+                value -= self.tree[index]
+            step >>= 1
+        return min(index, self.size - 1)
+
+
+##################################################################################
+# Weighted sampler for DeficitPolicy
+# Weight of a user is 2 ** ((base_score - score) / DEFICIT_HALF_LIFE)
+# The weights are also kept in an array, for the candidates-only fallback of sample()
+##################################################################################
+class DeficitSampler:
+    def __init__(self, scores):
+        self.scores = [float(score) for score in scores]
+        self.rebase()
+
+    # Rebuild the tree from the exact weights, relative to the lowest score
+    # Keeps the weights of the lowest scores near 1, so the sums in the tree do not
+    # turn into rounding errors of the (much bigger) weights they had before
+    def rebase(self):
+        import numpy as np
+        self.base_score = min(self.scores, default=0.0)
+        self.min_score = self.base_score
+        self.tree = FenwickTree([self.get_weight(score) for score in self.scores])
+        self.weights = np.array(self.tree.weights)
+
+    def get_weight(self, score):
+        return 2.0 ** ((self.base_score - score) / DEFICIT_HALF_LIFE)
+
+    def update(self, user_id, score):
+        old_score = self.scores[user_id]
+        self.scores[user_id] = float(score)
+
+        # The lowest score changes only if it was the score of this user, or the new score is lower
+        if score < self.min_score:
+            self.min_score = float(score)
+        elif old_score == self.min_score:
+            self.min_score = min(self.scores)
+
+        if abs(self.min_score - self.base_score) > DEFICIT_REBASE_HALF_LIVES * DEFICIT_HALF_LIFE:
+            self.rebase()
+        else:
+            self.tree.set(user_id, self.get_weight(score))
+            self.weights[user_id] = self.tree.weights[user_id]
+
+    # Return id of a weighted random candidate
+    # Each draw out of all the users costs O(log n), and hits a candidate with the
+    # candidates' share of the weight, so the fallback is rare unless the share is small
+    # The fallback is a single draw among the candidates: O(candidates), vectorized
+    def sample(self, candidates, rng):
+        import numpy as np
+        if candidates.is_empty():
+            error("Cannot choose a weighted candidate, because there are no candidates")
+
+        # Draw out of all the users, until a candidate is drawn
+        for _ in range(DEFICIT_MAX_REJECTIONS):
+            user_id = self.tree.find(rng.random() * self.tree.total())
+            if candidates.mask[user_id]:
+                return user_id
+
+        # Most of the weight belongs to users that are not candidates, choose among the candidates only
+        cumulative_weights = np.cumsum(self.weights[candidates.ids])
+        if cumulative_weights[-1] == 0:
+            return int(rng.choice(candidates.ids))
+        index = np.searchsorted(cumulative_weights, rng.random() * cumulative_weights[-1], side="right")
+        return int(candidates.ids[min(index, len(candidates.ids) - 1)])
+
 
 ##################################################################################
 # Hold number of occurrences for each team
@@ -388,53 +922,693 @@ class UsersDB:
 # - Value: number of occurrences
 ##################################################################################
 class TeamsDb:
-    def __init__(self):
+    def __init__(self, names=[]):
         # Initialize the members
-        self.name = ""
+        # Teams are kept as tuples of sorted person ids (names: id --> name)
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
         self.db = {}
 
-    def print(self):
+    def print(self, invert=1):
         print_header("Teams occurrence (shifts, not hours)")
         # Count teams that appear only once
         # The teams will not be printed, only the number of such teams
         num_of_unique_teams = 0
         for team in self.db.keys():
             # Skip one person team
-            if not "," in team:
+            if len(team) < 2:
                 continue
             num_of_occurrences = self.db[team]
             if num_of_occurrences == 1:
                 num_of_unique_teams += 1;
             else:
-                print(f"{format_str(team)} {format_str(str(num_of_occurrences))}")
+                team_str = ",".join(sorted(self.names[i] for i in team))
+                print(f"{format_str(team_str, invert=invert)} {format_str(str(num_of_occurrences), invert=invert)}")
         print(f"Number of unique teams: {num_of_unique_teams}")
 
+    # Turn list of names into the key of the team
+    def get_key(self, team):
+        return tuple(sorted(self.ids[name] for name in team if name in self.ids))
+
     def update_team(self, team):
         # Ignore empty team
         if len(team) == 0:
             return
 
-        # Turn list into string
-        team_str = ",".join(sorted(team))
-
         # Update DB
-        if team_str in self.db.keys():
-            self.db[team_str] += 1
-        else:
-            self.db[team_str] = 1
+        key = self.get_key(team)
+        self.db[key] = self.db.get(key, 0) + 1
 
     def get_team_occ(self, team):
-        team_str = ",".join(sorted(team))
-        if team_str in self.db.keys():
-            return self.db[team_str]
+        return self.db.get(self.get_key(team), 0)
+
+    # Teams occurrence by names, for a checkpoint (see PlannerCheckpoint): list of [team, occurrences]
+    def get_state(self):
+        return [[[self.names[i] for i in key], num_of_occurrences] for key, num_of_occurrences in self.db.items()]
+
+    # Restore teams occurrence, as returned by get_state()
+    def set_state(self, state):
+        self.db = {}
+        for team, num_of_occurrences in state:
+            key = self.get_key(team)
+            self.db[key] = self.db.get(key, 0) + num_of_occurrences
+
+
+##################################################################################
+# Snapshot of the input XLS file
+# The file is opened once (read-only, streaming), only the requested sheets are
+# loaded, and every later column lookup is served from memory
+# Empty cells are stored as NaN, same as pandas.read_excel() returns them
+##################################################################################
+class WorkbookSnapshot:
+    def __init__(self, file_name, sheet_names):
+        self.file_name = file_name
+        # Dict [sheet name] --> dict [column name] --> list of values (without the header)
+        self.sheets = {}
+
+        import openpyxl
+        workbook = openpyxl.load_workbook(file_name, read_only=True, data_only=True)
+        try:
+            for sheet_name in sheet_names:
+                if sheet_name in self.sheets:
+                    continue
+                if sheet_name not in workbook.sheetnames:
+                    error(f"Sheet '{sheet_name}' not found in {file_name}")
+                worksheet = workbook[sheet_name]
+                # Do not trust the dimensions stored in the file
+                worksheet.reset_dimensions()
+                self.sheets[sheet_name] = self.read_sheet(worksheet)
+        finally:
+            workbook.close()
+
+    # Turn worksheet rows into dict [column name] --> list of values
+    @staticmethod
+    def read_sheet(worksheet):
+        rows = [list(row) for row in worksheet.iter_rows(values_only=True)]
+        if not rows:
+            return {}
+
+        # Drop trailing empty rows
+        while len(rows) > 1 and all(value is None for value in rows[-1]):
+            rows.pop()
+
+        header = rows[0]
+        columns = {}
+        for col, column_name in enumerate(header):
+            # Skip unnamed and duplicate columns (the first one wins)
+            if column_name is None or column_name in columns:
+                continue
+            columns[column_name] = [row[col] if col < len(row) and row[col] is not None else math.nan
+                                    for row in rows[1:]]
+        return columns
+
+    # Get column from sheet, return None if the column does not exist
+    def get_column(self, sheet_name, column_name):
+        if sheet_name not in self.sheets:
+            error(f"Sheet '{sheet_name}' was not loaded from {self.file_name}")
+        return self.sheets[sheet_name].get(column_name)
+
+
+##################################################################################
+# Everything parsed from the input file, needed to plan the next days
+##################################################################################
+class WorkbookState:
+    def __init__(self, users_db, prev_schedule, positions_db, prev_date_str):
+        # Users DB, already includes time off/on
+        self.users_db = users_db
+        # Schedule of the previous day, as read from the file
+        self.prev_schedule = prev_schedule
+        # Positions configurations
+        self.positions_db = positions_db
+        # Previous schedule sheet name (date)
+        self.prev_date_str = prev_date_str
+        # Replay the previous schedule into the users DB (TTR, served hours) before the first day
+        # Not needed when resumed from a checkpoint, the users DB already includes it
+        self.replay_prev = 1
+        # Random generator state to continue from (resumed from a checkpoint), None: start from the seed
+        self.rng_state = None
+
+
+##################################################################################
+# Planner state after a planned day (--checkpoint), so a later run can continue
+# from it (--resume), instead of replaying the previous schedule sheet:
+#  - Users DB counters (TTR, last position, served hours) and teams occurrence, by name,
+#    so the fairness is kept over all the runs, not only over the last day
+#  - The last planned day and its date (night list, rest rules)
+#  - Random generator state
+# Saved as a JSON file
+##################################################################################
+class PlannerCheckpoint:
+    def __init__(self, date_str, schedule, users, teams, rng_state):
+        # Date of the last planned day, the next run plans the day after it
+        self.date_str = date_str
+        # Schedule of the last planned day
+        self.schedule = schedule
+        # Dict [name] --> counters, see UsersDB.get_state()
+        self.users = users
+        # List of [team, occurrences], see TeamsDb.get_state()
+        self.teams = teams
+        # See random.Random.getstate()
+        self.rng_state = rng_state
+
+    @classmethod
+    def from_build(cls, date_str, schedule, users_db, rng):
+        return cls(date_str, schedule, users_db.get_state(), users_db.teams_db.get_state(), rng.getstate())
+
+    # Write to a temporary file, then replace, so the file is never left half written
+    def save(self, file_name):
+        import json
+        version, internal_state, gauss_next = self.rng_state
+        data = {"version": CHECKPOINT_VERSION, "date": self.date_str, "schedule": self.schedule,
+                "users": self.users, "teams": self.teams, "rng": [version, list(internal_state), gauss_next]}
+        temp_file_name = file_name + ".tmp"
+        with open(temp_file_name, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        import json
+        if not os.path.exists(file_name):
+            error(f"Checkpoint file {file_name} does not exist.")
+        try:
+            with open(file_name, encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            error(f"Cannot read checkpoint file {file_name}: {e}")
+        if data.get("version") != CHECKPOINT_VERSION:
+            error(f"Checkpoint file {file_name} has version {data.get('version')}, expected {CHECKPOINT_VERSION}")
+
+        version, internal_state, gauss_next = data["rng"]
+        schedule = [[[sys.intern(name) for name in team] for team in line] for line in data["schedule"]]
+        return cls(data["date"], schedule, data["users"], data["teams"], (version, tuple(internal_state), gauss_next))
+
+
+##################################################################################
+# Fairness ledger (--ledger): SQLite file with the served hours of all the runs
+#  - hours: per person, date and position - total, night and deep night hours
+#  - teams: per team and date - occurrences (shifts, not hours)
+# Indexed by person (team) and by date. A day that is planned again replaces its rows,
+# so the same day is never counted twice
+# At startup, the totals of the days before the previous schedule are loaded with a
+# single query, instead of replaying their sheets (see load_ledger())
+##################################################################################
+class FairnessLedger:
+    def __init__(self, file_name):
+        import sqlite3
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS hours (name TEXT, date TEXT,
+                total_hours INTEGER, night_hours INTEGER, deep_night_hours INTEGER, PRIMARY KEY (name, date));
+            CREATE INDEX IF NOT EXISTS hours_by_date ON hours (date);
+            CREATE TABLE IF NOT EXISTS teams (team TEXT, date TEXT, occurrences INTEGER, PRIMARY KEY (team, date));
+            CREATE INDEX IF NOT EXISTS teams_by_date ON teams (date);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    # Served hours before the date: dict [name] --> (total hours, night hours, deep night hours)
+    def get_hours(self, before_date_str):
+        rows = self.connection.execute("SELECT name, SUM(total_hours), SUM(night_hours), SUM(deep_night_hours) "
+                                       "FROM hours WHERE date < ? GROUP BY name", (before_date_str,))
+        return {name: (total_hours, night_hours, deep_night_hours) for name, total_hours, night_hours, deep_night_hours in rows}
+
+    # Teams occurrence before the date, same as TeamsDb.get_state()
+    def get_teams(self, before_date_str):
+        rows = self.connection.execute("SELECT team, SUM(occurrences) FROM teams WHERE date < ? GROUP BY team", (before_date_str,))
+        return [[team.split(","), num_of_occurrences] for team, num_of_occurrences in rows]
+
+    # Replace the rows of the days, in a single transaction
+    # days: list of (date, single day schedule), in order
+    # prev_line: teams of the last hour before the days (a team that continues is the same shift)
+    # Only people on the list are kept (same as the users DB), not empty cells or other names
+    def set_days(self, cfg, days, prev_line, valid_names):
+        valid_names = set(valid_names)
+        prev_line = self.get_valid_line(prev_line, valid_names)
+        with self.connection:
+            for date_str, schedule in days:
+                prev_line = self.set_day(cfg, date_str, schedule, prev_line, valid_names)
+
+    # Replace the rows of a day (see set_days()), return the last line of the day
+    def set_day(self, cfg, date_str, schedule, prev_line, valid_names):
+        # Name --> [total, night, deep night hours]
+        hours = {}
+        # Team --> occurrences
+        teams = {}
+        for hour in range(HOURS_IN_DAY):
+            line = self.get_valid_line(schedule[hour], valid_names)
+            for position, team in enumerate(line):
+                for name in team:
+                    counts = hours.setdefault(name, [0, 0, 0])
+                    counts[0] += 1
+                    counts[1] += cfg.is_night(hour)
+                    counts[2] += 1 if hour in DEEP_NIGHT_HOURS else 0
+                if team and (position >= len(prev_line) or team != prev_line[position]):
+                    key = ",".join(sorted(team))
+                    teams[key] = teams.get(key, 0) + 1
+            prev_line = line
+
+        self.connection.execute("DELETE FROM hours WHERE date = ?", (date_str,))
+        self.connection.execute("DELETE FROM teams WHERE date = ?", (date_str,))
+        self.connection.executemany("INSERT INTO hours (name, date, total_hours, night_hours, deep_night_hours) VALUES (?, ?, ?, ?, ?)",
+                                    [(name, date_str, *counts) for name, counts in hours.items()])
+        self.connection.executemany("INSERT INTO teams VALUES (?, ?, ?)",
+                                    [(team, date_str, num_of_occurrences) for team, num_of_occurrences in teams.items()])
+        return prev_line
+
+    @staticmethod
+    def get_valid_line(line, valid_names):
+        return [[name for name in team if name in valid_names] for team in line]
+
+
+##################################################################################
+# Checks the rest rules while the schedule is built, one assignment at a time:
+#  - TTR after each shift (same as verify(): ttr_night after a night hour, ttr_day otherwise)
+#  - No night shifts in two nights in a row
+# Keeps the last served hour and the last night of each user, so each check is O(1)
+# Violations are collected (see ScheduleResult.violations), or stop the build (cfg.stop_early)
+# Hours are absolute: 0 is the first planned hour, the previous schedule is at -24..-1
+##################################################################################
+class ScheduleValidator:
+    def __init__(self, cfg, users_db):
+        self.cfg = cfg
+        self.ids = users_db.ids
+        num_of_users = len(users_db.names)
+        self.last_served = [None] * num_of_users
+        self.last_night = [None] * num_of_users
+        # List of violation messages
+        self.violations = []
+
+    # Record the previous schedule (not checked)
+    def add_prev_schedule(self, prev_schedule):
+        for hour, line in enumerate(prev_schedule):
+            for team in line:
+                for name in team:
+                    if name in self.ids:
+                        self.record(self.ids[name], hour - len(prev_schedule))
+
+    def record(self, user_id, absolute_hour):
+        self.last_served[user_id] = absolute_hour
+        if self.cfg.is_night(absolute_hour % HOURS_IN_DAY):
+            self.last_night[user_id] = get_night_index(absolute_hour)
+
+    # Check an assignment, and record it
+    def check(self, name, absolute_hour):
+        if name not in self.ids:
+            return
+        user_id = self.ids[name]
+        hour_str = f"day {absolute_hour // HOURS_IN_DAY + 1}, {absolute_hour % HOURS_IN_DAY}:00"
+
+        # TTR (continuing the shift, or another position at the same hour, is not a new shift)
+        last_served_hour = self.last_served[user_id]
+        if last_served_hour is not None and absolute_hour - last_served_hour > 1:
+            rest = absolute_hour - last_served_hour - 1
+            expected_ttr = self.cfg.ttr_night if self.cfg.is_night(last_served_hour % HOURS_IN_DAY) else self.cfg.ttr_day
+            if rest < expected_ttr:
+                self.add_violation(f"At {hour_str}, {name} got {rest} hours of rest, instead of {expected_ttr}")
+
+        # Two nights in a row (a shift that continues from 23:00 is the same night shift)
+        is_continuing = last_served_hour is not None and absolute_hour - last_served_hour <= 1
+        if self.cfg.is_night(absolute_hour % HOURS_IN_DAY) and not is_continuing:
+            if self.last_night[user_id] == get_night_index(absolute_hour) - 1:
+                self.add_violation(f"At {hour_str}, {name} serves a night shift, after serving last night")
+
+        self.record(user_id, absolute_hour)
+
+    def add_violation(self, message):
+        if self.cfg.stop_early:
+            error(message + " (stopped early)")
+        self.violations.append(message)
+
+
+##################################################################################
+# Dense schedule: array [hour][position][slot] of person ids (-1: empty slot)
+# Names are interned into ids once (names list: id --> name), and converted
+# back to names only for output. Used to store the planned days, and by the checks
+# (verify(), check_teams(), check_positions()) to work with NumPy operations
+# instead of loops over the lists of names
+##################################################################################
+class ScheduleTensor:
+    def __init__(self, slots, names):
+        self.slots = slots
+        self.names = names
+
+    # Build from a schedule: list of hours, each a list of positions, each a list of names
+    # names: intern table to use (new names are added at its end), or None for a new one
+    @classmethod
+    def from_schedule(cls, schedule, names=None):
+        import numpy as np
+        names = [] if names is None else names
+        ids = {name: i for i, name in enumerate(names)}
+        num_of_positions = max((len(line) for line in schedule), default=0)
+        max_team_size = max((len(team) for line in schedule for team in line), default=0)
+        slots = []
+        for line in schedule:
+            for team in line:
+                team_ids = []
+                for name in team:
+                    # Skip empty names (team of size 0)
+                    if not name:
+                        continue
+                    if name not in ids:
+                        ids[name] = len(names)
+                        names.append(name)
+                    team_ids.append(ids[name])
+                slots.append(team_ids + [-1] * (max_team_size - len(team_ids)))
+            slots += [[-1] * max_team_size] * (num_of_positions - len(line))
+        slots = np.array(slots, dtype=get_id_dtype(len(names))).reshape(len(schedule), num_of_positions, max_team_size)
+        return cls(slots, names)
+
+    # Concatenate schedules (in time) that use the same intern table
+    @classmethod
+    def concatenate(cls, tensors, names):
+        import numpy as np
+        num_of_slots = max((tensor.slots.shape[2] for tensor in tensors), default=0)
+        num_of_positions = max((tensor.slots.shape[1] for tensor in tensors), default=0)
+        slots = np.full((sum(tensor.num_of_hours() for tensor in tensors), num_of_positions, num_of_slots), -1,
+                        dtype=get_id_dtype(len(names)))
+        hour = 0
+        for tensor in tensors:
+            shape = tensor.slots.shape
+            slots[hour:hour + shape[0], :shape[1], :shape[2]] = tensor.slots
+            hour += shape[0]
+        return cls(slots, names)
+
+    # Schedule of the hours [first, last), sharing the slots (not a copy)
+    def get_hours(self, first, last):
+        return ScheduleTensor(self.slots[first:last], self.names)
+
+    # Back to list of hours, each a list of positions, each a list of names
+    def to_schedule(self):
+        return [[self.get_team(hour, position) for position in range(self.slots.shape[1])]
+                for hour in range(self.num_of_hours())]
+
+    def get_team(self, hour, position):
+        return [self.names[i] for i in self.slots[hour, position].tolist() if i >= 0]
+
+    def num_of_hours(self):
+        return self.slots.shape[0]
+
+    # Occupancy matrix [person id][hour]: True if the person serves at this hour (any position)
+    def get_occupancy(self):
+        import numpy as np
+        occupancy = np.zeros((len(self.names), self.num_of_hours()), dtype=bool)
+        hours, _, _ = np.nonzero(self.slots >= 0)
+        occupancy[self.slots[self.slots >= 0], hours] = True
+        return occupancy
+
+    # Arrays of all assignments, in the order of the schedule: hour, position, person id
+    def get_assignments(self):
+        import numpy as np
+        hours, positions, slots = np.nonzero(self.slots >= 0)
+        return hours, positions, self.slots[hours, positions, slots]
+
+
+##################################################################################
+# Result of Scheduler.plan()
+##################################################################################
+class ScheduleResult:
+    def __init__(self, cfg, users_db, prev_schedule, seed):
+        self.cfg = cfg
+        self.seed = seed
+        # Users DB after the build (served hours, teams)
+        self.users_db = users_db
+        # Intern table of all schedules: ids of the users DB, then other names of the previous schedule
+        self.names = list(users_db.names)
+        self.prev_schedule = ScheduleTensor.from_schedule(prev_schedule, self.names)
+        # List of (date, single day schedule as ScheduleTensor)
+        self.days = []
+        # Violations of the rest rules found while building (see ScheduleValidator)
+        self.violations = []
+
+    def add_day(self, date_str, schedule):
+        self.days.append((date_str, ScheduleTensor.from_schedule(schedule, self.names)))
+
+    # Previous schedule followed by all planned days, hour by hour (ScheduleTensor)
+    @property
+    def total_schedule(self):
+        return ScheduleTensor.concatenate([self.prev_schedule] + [day for _, day in self.days], self.names)
+
+    # Replace the planned days with the hours of total_schedule (after the previous schedule)
+    def set_total_schedule(self, total_schedule):
+        first_hour = self.prev_schedule.num_of_hours()
+        for k, (date_str, _) in enumerate(self.days):
+            hour = first_hour + k * HOURS_IN_DAY
+            self.days[k] = (date_str, total_schedule.get_hours(hour, hour + HOURS_IN_DAY))
+
+    # Fairness score, as returned by check_fairness(). Lower is better
+    def fairness_score(self):
+        return self.users_db.get_fairness_score()
+
+
+##################################################################################
+# Batched XLS output
+# Collects the schedules of all planned days, and writes them in a single
+# load + save of the XLS file (instead of load + save per day)
+##################################################################################
+class XlsOutput:
+    def __init__(self, file_name, cfg_position_names):
+        self.file_name = file_name
+        self.position_names = cfg_position_names
+        # List of (sheet name, schedule as ScheduleTensor), in the order of the days
+        self.pending = []
+
+    def add_schedule(self, schedule, sheet_name):
+        self.pending.append((sheet_name, ScheduleTensor.from_schedule(schedule)))
+
+    # Write all pending schedules to the file
+    def save(self, profiler=None):
+        if not self.pending:
+            return
+        profiler = profiler or Profiler()
+
+        import openpyxl
+        with profiler.stage("xls load"):
+            workbook = openpyxl.load_workbook(self.file_name)
+        for sheet_name, schedule in self.pending:
+            with profiler.stage("xls write"):
+                worksheet = write_schedule_to_xls(workbook, schedule.to_schedule(), sheet_name, self.position_names)
+            with profiler.stage("xls styling"):
+                color_worksheet(worksheet)
+        with profiler.stage("xls save"):
+            workbook.save(self.file_name)
+        self.pending = []
+
+
+##################################################################################
+# Counters of the build (--counters), per hour of the day and position:
+#  - choices: candidates filterings (see Scheduler.get_available_users_db()),
+#    one for each team member, and one more when taking the night fallback
+#    The assignment engine counts the same pool for each team member, see Scheduler.count_assignment_pools()
+#  - pool:    size of the candidates pool - sum, min and histogram (bins: COUNTERS_POOL_BINS)
+#  - pruned:  people removed from the pool by remove_repetative()
+#  - night fallbacks: team members who served last night, because no one else was available
+#  - resizes: resize_team() calls, up and down
+# Updates are a few array increments, and only when enabled (Scheduler.counters is None otherwise)
+##################################################################################
+class BuildCounters:
+    def __init__(self, num_of_positions):
+        import numpy as np
+        shape = (HOURS_IN_DAY, num_of_positions)
+        self.choices = np.zeros(shape, dtype=np.int64)
+        self.pool_sum = np.zeros(shape, dtype=np.int64)
+        self.pool_min = np.full(shape, -1, dtype=np.int64)
+        self.pool_histogram = np.zeros(shape + (len(COUNTERS_POOL_BINS),), dtype=np.int64)
+        self.pruned = np.zeros(shape, dtype=np.int64)
+        self.night_fallbacks = np.zeros(shape, dtype=np.int64)
+        self.resizes_up = np.zeros(shape, dtype=np.int64)
+        self.resizes_down = np.zeros(shape, dtype=np.int64)
+
+    def add_pool(self, hour, position, pool_size, pruned):
+        self.choices[hour, position] += 1
+        self.pool_sum[hour, position] += pool_size
+        if self.pool_min[hour, position] < 0 or pool_size < self.pool_min[hour, position]:
+            self.pool_min[hour, position] = pool_size
+        self.pool_histogram[hour, position, bisect.bisect_right(COUNTERS_POOL_BINS, pool_size) - 1] += 1
+        self.pruned[hour, position] += pruned
+
+    def add_night_fallback(self, hour, position, num_of_members=1):
+        self.night_fallbacks[hour, position] += num_of_members
+
+    def add_resize(self, hour, position, is_up):
+        if is_up:
+            self.resizes_up[hour, position] += 1
         else:
-            return 0
+            self.resizes_down[hour, position] += 1
+
+    # Names of the histogram bins: "0", "1", "2", "3-4", ..., "33+"
+    @staticmethod
+    def get_bin_names():
+        names = []
+        for k, low in enumerate(COUNTERS_POOL_BINS):
+            high = COUNTERS_POOL_BINS[k + 1] - 1 if k + 1 < len(COUNTERS_POOL_BINS) else None
+            names.append(str(low) if high == low else f"{low}-{high}" if high is not None else f"{low}+")
+        return names
+
+    # All counters, as lists [hour][position]
+    def to_dict(self, position_names):
+        return {"positions": position_names, "pool_bins": self.get_bin_names(),
+                "choices": self.choices.tolist(), "pool_sum": self.pool_sum.tolist(), "pool_min": self.pool_min.tolist(),
+                "pool_histogram": self.pool_histogram.tolist(), "pruned": self.pruned.tolist(),
+                "night_fallbacks": self.night_fallbacks.tolist(),
+                "resizes_up": self.resizes_up.tolist(), "resizes_down": self.resizes_down.tolist()}
+
+    # Print the counters per hour, per position, and the pool size histogram
+    def print(self, position_names, invert=1):
+        import numpy as np
+        print_header("Build counters per hour".ljust(COLUMN_WIDTH) + self.get_columns_header())
+        for hour in range(HOURS_IN_DAY):
+            print("{:02d}:00".format(hour).ljust(COLUMN_WIDTH) + self.get_columns_str(np.s_[hour, :]))
+
+        print_header("Build counters per position".ljust(COLUMN_WIDTH) + self.get_columns_header())
+        for position, position_name in enumerate(position_names):
+            print(format_str(position_name, invert=invert) + self.get_columns_str(np.s_[:, position]))
+
+        print_header("Candidates pool size".ljust(COLUMN_WIDTH) + "".join(name.rjust(10) for name in self.get_bin_names()))
+        print("Choices".ljust(COLUMN_WIDTH) + "".join(str(count).rjust(10) for count in self.pool_histogram.sum(axis=(0, 1)).tolist()))
+        print_delimiter()
+
+    @staticmethod
+    def get_columns_header():
+        return "".join(title.rjust(12) for title in ["Choices", "Avg pool", "Min pool", "Pruned", "Night fb", "Resize +", "Resize -"])
+
+    # Counters of a part of the [hour][position] arrays, summed
+    def get_columns_str(self, index):
+        choices = int(self.choices[index].sum())
+        pool_min = self.pool_min[index]
+        pool_min = pool_min[pool_min >= 0]
+        columns = [choices, f"{self.pool_sum[index].sum() / choices:.1f}" if choices else "-",
+                   int(pool_min.min()) if len(pool_min) else "-", int(self.pruned[index].sum()),
+                   int(self.night_fallbacks[index].sum()), int(self.resizes_up[index].sum()), int(self.resizes_down[index].sum())]
+        return "".join(str(column).rjust(12) for column in columns)
+
+
+##################################################################################
+# Profile of a run (--profile): wall time and allocations of each stage
+# (parse, build of each day, XLS write, styling, checks), written as JSON
+# Allocations are traced with tracemalloc: net (still allocated at the end of the stage)
+# and peak (above the start of the stage). Stages are not nested
+# Optionally, also the top functions (cProfile) and allocation sites (tracemalloc)
+# When disabled (the default), stage() does nothing
+##################################################################################
+class Profiler:
+    def __init__(self, enabled=0, top=0):
+        self.enabled = enabled
+        # Number of top functions and allocation sites (0: none)
+        self.top = top
+        # Dict [stage name] --> {calls, seconds, net_bytes, peak_bytes}, in the order of the first call
+        self.stages = {}
+        self.start_time = None
+        self.cprofile = None
+        # tracemalloc keeps a single peak, reset by each stage: the peak of the run,
+        # and of each open stage ({"peak_bytes"}, innermost last), see fold_peak()
+        self.peak_bytes = 0
+        self.open_stages = []
+
+    def start(self):
+        if not self.enabled:
+            return
+        import tracemalloc
+        tracemalloc.start()
+        if self.top:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.start_time = time.perf_counter()
+
+    # Context of a stage, same name again adds to it
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.run_stage(name)
+
+    @contextlib.contextmanager
+    def run_stage(self, name):
+        import tracemalloc
+        self.fold_peak()
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        open_stage = {"peak_bytes": start_bytes}
+        self.open_stages.append(open_stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.fold_peak()
+            self.open_stages.pop()
+            current_bytes = tracemalloc.get_traced_memory()[0]
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "net_bytes": 0, "peak_bytes": 0})
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["net_bytes"] += current_bytes - start_bytes
+            stage["peak_bytes"] = max(stage["peak_bytes"], open_stage["peak_bytes"] - start_bytes)
+
+    # Add the peak since the last reset to the peak of the run and of the open stages
+    # (all of them were open since the last reset, each stage resets when it starts)
+    def fold_peak(self):
+        import tracemalloc
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        self.peak_bytes = max(self.peak_bytes, peak_bytes)
+        for open_stage in self.open_stages:
+            open_stage["peak_bytes"] = max(open_stage["peak_bytes"], peak_bytes)
+
+    # Stop, write the profile to the file and print the stages
+    def stop(self, file_name):
+        if not self.enabled:
+            return
+        import json
+        import tracemalloc
+        total_seconds = time.perf_counter() - self.start_time
+        self.fold_peak()
+        profile = {"command": sys.argv, "total_seconds": round(total_seconds, 6),
+                   "peak_bytes": self.peak_bytes,
+                   "stages": [{"name": name, **stage, "seconds": round(stage["seconds"], 6)} for name, stage in self.stages.items()]}
+        if self.top:
+            self.cprofile.disable()
+            profile["top_functions"] = self.get_top_functions()
+            profile["top_allocations"] = [{"location": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+                                          for stat in tracemalloc.take_snapshot().statistics("lineno")[:self.top]]
+        tracemalloc.stop()
+
+        with open(file_name, "w", encoding="utf-8") as file:
+            json.dump(profile, file, indent=1)
+
+        print_header(f"Profile ({file_name})")
+        for stage in profile["stages"]:
+            print(f"{stage['name'].ljust(COLUMN_WIDTH)} {stage['seconds']:9.3f} s {stage['calls']:6} calls "
+                  f"{stage['net_bytes'] / 2**20:9.2f} MB net {stage['peak_bytes'] / 2**20:9.2f} MB peak")
+        print(f"{'Total'.ljust(COLUMN_WIDTH)} {total_seconds:9.3f} s")
+        print_delimiter()
+
+    # Top functions by cumulative time: function, calls, own time, cumulative time
+    def get_top_functions(self):
+        import pstats
+        stats = pstats.Stats(self.cprofile).stats
+        top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        return [{"function": f"{file_name}:{line}({function})", "calls": num_of_calls,
+                 "own_seconds": round(own_seconds, 6), "cumulative_seconds": round(cumulative_seconds, 6)}
+                for (file_name, line, function), (_, num_of_calls, own_seconds, cumulative_seconds, _) in top]
 
 
 ##################################################################################
 # Utils
 ##################################################################################
 
+# Night of a night hour (hour % 24 is the hour of the day)
+# Nights are counted by date, same as the night list of the build (night hours of the previous date)
+def get_night_index(hour):
+    return hour // HOURS_IN_DAY
+
+
+# Smallest integer type for person ids (and -1 for "no one")
+def get_id_dtype(num_of_ids):
+    import numpy as np
+    return np.int16 if num_of_ids < 2 ** 15 else np.int32
+
+
 def print_delimiter(): print("#" * LINE_WIDTH)
 
 
@@ -462,8 +1636,8 @@ def parse_command_line_arguments():
 
     # Define the command-line arguments - mandatory
     parser.add_argument("file_name", type=str, help="XLS file name ")
-    parser.add_argument("--prev", type=str, required=True, metavar='SHEET_NAME',
-                        help="Prev schedule sheet name. Must be a valid date (yyyy-mm-dd)")
+    parser.add_argument("--prev", type=str, metavar='SHEET_NAME',
+                        help="Prev schedule sheet name. Must be a valid date (yyyy-mm-dd). Required, unless --resume is used")
     parser.add_argument("--positions", type=int, required=True, metavar='N', help="Number of positions")
 
     # Define the command-line arguments - optional
@@ -479,56 +1653,113 @@ def parse_command_line_arguments():
                         help=f"Shuffle coefficient. Default is 4. Higher value gives more randomization, may reduce fairness for short runs")
     parser.add_argument("--night_first", type=int, metavar='H0', help="First hour of the night (must be after midnight)")
     parser.add_argument("--night_last",  type=int, metavar='H1', help="Last hour of the night")
-    parser.add_argument("--by_score", action="store_true", help="Using score(day_time_served + night_time_served*1.5) to assume positions")
+    parser.add_argument("--by_score", action="store_true", help="Using score(day_time_served + night_time_served*1.5) to assume positions (same as --policy score)")
+    parser.add_argument("--policy", type=str, choices=SELECTION_POLICIES.keys(),
+                        help="How to choose a person out of the available: lowest TTRs at random (ttr_tier, default), "
+                             "lowest score out of the lowest TTRs (score), or at random, weighted by how little they served (deficit)")
+    parser.add_argument("--engine", type=str, choices=ENGINES,
+                        help="How to fill the shifts: one team member at a time (greedy, default), "
+                             "or all positions of the hour at once, by min-cost assignment (assignment)")
     parser.add_argument("--invert", action="store_true", help="Invert strings for STDOUT")
+    parser.add_argument("--csv", type=str, metavar='FILE', help="Also write the planned days to a CSV file")
+    parser.add_argument("--tries", type=int, metavar='N',
+                        help="Build the schedule N times (seeds SEED, SEED+1, ...), keep the fairest one")
+    parser.add_argument("--jobs", type=int, metavar='K',
+                        help="Number of parallel processes for --tries. Default is the number of CPUs")
+    parser.add_argument("--optimize", type=int, metavar='N',
+                        help="After the build, try N moves (swap or replace a person in a shift) to improve fairness")
+    parser.add_argument("--optimize_time", type=float, metavar='SEC',
+                        help=f"Time budget for --optimize. Default is {OPTIMIZE_TIME_LIMIT} seconds")
+    parser.add_argument("--stop_early", action="store_true",
+                        help="Stop the build at the first violation of the rest rules (TTR, night shifts in two nights in a row)")
+    parser.add_argument("--checkpoint", type=str, metavar='FILE',
+                        help="Save the planner state (served hours, TTR, teams, last day) to FILE after each planned day")
+    parser.add_argument("--resume", type=str, metavar='FILE',
+                        help="Continue from the planner state in FILE (see --checkpoint), instead of the --prev sheet")
+    parser.add_argument("--ledger", type=str, metavar='FILE',
+                        help="Fairness ledger (SQLite file): start from the hours served before --prev, and add the planned days to it (with --write)")
+    parser.add_argument("--analyze", type=str, metavar='LAST_DATE',
+                        help="Do not build, only check the existing schedule sheets after --prev, up to LAST_DATE (yyyy-mm-dd), as one timeline")
+    parser.add_argument("--profile", action="store_true",
+                        help="Write wall time and allocations of each stage (parse, build of each day, XLS write, styling, checks) "
+                             "to FILE_NAME.profile.json")
+    parser.add_argument("--profile_top", type=int, metavar='N',
+                        help="With --profile, also write the top N functions (cProfile) and allocation sites (tracemalloc)")
+    parser.add_argument("--counters", action="store_true",
+                        help="Print counters of the build per hour and position (candidates pool sizes, prunes, night fallbacks, resizes), "
+                             "and write them to FILE_NAME.counters.json")
+    parser.add_argument("--import_time", action="store_true",
+                        help=f"Print startup time breakdown, warn if above budget ({STARTUP_BUDGET_MS} ms)")
 
     # Parse the command-line arguments
     args = parser.parse_args()
 
+    # Report startup time before anything else is imported
+    if args.import_time:
+        print_import_time()
+
     # Sanity
     if args.night_first is not None and args.night_last is None:
         error("providing night_first, must also provide night_last")
     if args.night_first is None and args.night_last is not None:
         error("providing night_last, must also provide night_first")
-
-    # Configure global variables
-    if args.file_name:   global INPUT_FILE_NAME;     INPUT_FILE_NAME = args.file_name
-    if args.days:        global DAYS_TO_PLAN;        DAYS_TO_PLAN = args.days
-    if args.positions:   global NUM_OF_POSITIONS;    NUM_OF_POSITIONS = args.positions
-    if args.seed:        global SEED;                SEED = args.seed; random.seed(SEED)
-    if args.ttrn:        global TTR_NIGHT;           TTR_NIGHT = args.ttrn
-    if args.ttrd:        global TTR_DAY;             TTR_DAY = args.ttrd
-    if args.graph:       global GRAPH;               GRAPH = args.graph;
-    if args.write:       global DO_WRITE;            DO_WRITE = args.write;
-    if args.invert:      global INVERT_STRINGS;      INVERT_STRINGS = 0;
-    if args.personal:    global PERSONAL_SCHEDULE;   PERSONAL_SCHEDULE = args.personal;
-    if args.shuffle:     global SHUFFLE_COEFFICIENT; SHUFFLE_COEFFICIENT = args.shuffle;
-    if args.statistics:  global PRINT_STATISTICS;    PRINT_STATISTICS = args.statistics;
+    if args.prev is None and args.resume is None:
+        error("must provide --prev, or --resume")
+    if args.analyze is not None and (args.prev is None or args.resume or args.write):
+        error("--analyze checks the sheets from --prev, cannot be used with --resume or --write")
+
+    # Configure user parameters
+    cfg = SchedulerCfg()
+    if args.file_name:   cfg.input_file_name = args.file_name
+    if args.days:        cfg.days_to_plan = args.days
+    if args.positions:   cfg.num_of_positions = args.positions
+    if args.seed:        cfg.seed = args.seed
+    if args.ttrn:        cfg.ttr_night = args.ttrn
+    if args.ttrd:        cfg.ttr_day = args.ttrd
+    if args.graph:       cfg.graph = args.graph
+    if args.write:       cfg.do_write = args.write
+    if args.csv:         cfg.csv_file_name = args.csv
+    if args.invert:      cfg.invert_strings = 0
+    if args.personal:    cfg.personal_schedule = args.personal
+    if args.shuffle:     cfg.shuffle_coefficient = args.shuffle
+    if args.statistics:  cfg.print_statistics = args.statistics
     if args.night_first is not None:
-        global NIGHT_HOURS;
-        NIGHT_HOURS = range(args.night_first, args.night_last);
-    if args.by_score:   global BY_SCORE;     BY_SCORE = args.by_score
+        cfg.night_hours = range(args.night_first, args.night_last)
+    if args.by_score:    cfg.policy = "score"
+    if args.policy:      cfg.policy = args.policy
+    if args.engine:      cfg.engine = args.engine
+    if args.tries:       cfg.tries = args.tries
+    if args.optimize:    cfg.optimize_iterations = args.optimize
+    if args.optimize_time is not None: cfg.optimize_time = args.optimize_time
+    if args.stop_early:  cfg.stop_early = args.stop_early
+    if args.jobs:        cfg.jobs = args.jobs
+    if args.checkpoint:  cfg.checkpoint_file_name = args.checkpoint
+    if args.resume:      cfg.resume_file_name = args.resume
+    if args.analyze:     cfg.analyze_last_date = args.analyze
+    if args.ledger:      cfg.ledger_file_name = args.ledger
+    if args.profile:     cfg.profile = args.profile
+    if args.profile_top: cfg.profile_top = args.profile_top
+    if args.counters:    cfg.counters = args.counters
 
     # Sanity checks
-    if not os.path.exists(args.file_name):                    error(f"File {args.file_name} does not exist.")
-    if DO_WRITE and not os.access(args.file_name, os.W_OK): error(f"File {args.file_name} is not writable.")
-    check_prev_name(args.prev)
+    if not os.path.exists(args.file_name):                      error(f"File {args.file_name} does not exist.")
+    if cfg.do_write and not os.access(args.file_name, os.W_OK): error(f"File {args.file_name} is not writable.")
+    if args.prev is not None: check_prev_name(args.prev)
+    if args.analyze is not None:
+        check_prev_name(args.analyze)
+        if args.analyze <= args.prev: error(f"--analyze {args.analyze} must be after --prev {args.prev}")
 
-    return args.prev
+    return cfg, args.prev
 
 
 ##################################################################################
 # Extract column from sheet
-def extract_column_from_sheet(sheet_name, column_name):
-    df = pd.read_excel(INPUT_FILE_NAME, sheet_name=sheet_name)
-    # You can add this and there will be not "nan" but for now out code can deal with NaN (na_filter=False to line 162)
-    # Check if the column exists in the DataFrame
-    if column_name in df.columns:
-        # Access and print the contents of the column
-        column_list = df[column_name].tolist()
-        return column_list
-    else:
+def extract_column_from_sheet(workbook, sheet_name, column_name):
+    # Note: empty cells are NaN, our code can deal with it
+    column_list = workbook.get_column(sheet_name, column_name)
+    if column_list is None:
         error(f"Column '{column_name}' not found in '{sheet_name}'.")
+    return column_list
 
 
 # Turning type [13/2 15:00-16:00] to hours in schedule
@@ -594,11 +1825,11 @@ def parse_hours(name, single_person_time_off, prev_date_str):
 
 ##################################################################################
 # Taking the "Time off" information from the xlsx file and turning it into a dict for later use
-def extract_personal_constraints(prev_date_str, column_name):
+def extract_personal_constraints(workbook, prev_date_str, column_name):
     # Init all the relevant data from the file
-    list_of_names = extract_column_from_sheet("List of people", "People")
+    list_of_names = extract_column_from_sheet(workbook, "List of people", "People")
     try:
-        list_of_constraints = extract_column_from_sheet("List of people", column_name)
+        list_of_constraints = extract_column_from_sheet(workbook, "List of people", column_name)
     except:
         error(f"Please add column '{column_name}' next to the People column, at 'List of people' sheet")
 
@@ -636,15 +1867,21 @@ def get_one_day_ahead(prev_date):
     return next_date_reformat
 
 
+##################################################################################
+# Get name of the sheet with the position configuration
+def get_position_sheet_name(position):
+    return "Position " + str(position + 1)
+
+
 ##################################################################################
 # Get configurations of all positions
-def get_positions_cfg():
+def get_positions_cfg(workbook, num_of_positions):
     # Declare list of positions
     positions_cfg_list = []
 
-    for position in range(NUM_OF_POSITIONS):
-        sheet_name = "Position " + str(position + 1)
-        single_position_cfg = get_single_position_cfg(sheet_name)
+    for position in range(num_of_positions):
+        sheet_name = get_position_sheet_name(position)
+        single_position_cfg = get_single_position_cfg(workbook, sheet_name)
         positions_cfg_list.append(single_position_cfg)
 
     return positions_cfg_list
@@ -652,21 +1889,21 @@ def get_positions_cfg():
 
 ##################################################################################
 # Get configuration of a single position
-def get_single_position_cfg(sheet_name):
+def get_single_position_cfg(workbook, sheet_name):
     cfg = PositionCfg()
 
     # Get position name
-    names = extract_column_from_sheet(sheet_name, "Name")
+    names = extract_column_from_sheet(workbook, sheet_name, "Name")
     cfg.name = names[0][::-1]
 
     # Get actions per hour
-    action_list = extract_column_from_sheet(sheet_name, "Action")
+    action_list = extract_column_from_sheet(workbook, sheet_name, "Action")
     if len(action_list) != HOURS_IN_DAY:
         error("In sheet " + sheet_name + ", swap list unexpected length: " + len(action_list));
     cfg.action = action_list
 
     # Get team size per hour
-    team_size_list = extract_column_from_sheet(sheet_name, "Team size")
+    team_size_list = extract_column_from_sheet(workbook, sheet_name, "Team size")
     if len(team_size_list) != HOURS_IN_DAY:
         error("In sheet " + sheet_name + ", team size list unexpected length: " + len(team_size_list));
     cfg.team_size = team_size_list
@@ -676,14 +1913,14 @@ def get_single_position_cfg(sheet_name):
 
 ##################################################################################
 # Get the previous schedule
-def get_prev_schedule(sheet_name, cfg_position_names):
+def get_prev_schedule(workbook, sheet_name, cfg_position_names):
     prev_schedule = []
     if not sheet_name:
         sheet_name = str(datetime.date.today())
     position_teams = []
-    for position in range(NUM_OF_POSITIONS):
+    for position in range(len(cfg_position_names)):
         position_name = cfg_position_names[position]
-        position_teams.append(extract_column_from_sheet(sheet_name, position_name[::-1]))
+        position_teams.append(extract_column_from_sheet(workbook, sheet_name, position_name[::-1]))
 
     for hour in range(HOURS_IN_DAY):
         prev_schedule.append([])
@@ -692,12 +1929,10 @@ def get_prev_schedule(sheet_name, cfg_position_names):
             if team_str == 'nan':
                 team_list = []
             else:
-                team_list = team_str.split(",")
+                # Same name, same string object (the schedules keep many references to each name)
+                team_list = [sys.intern(name) for name in team_str.split(",")]
             prev_schedule[hour].append(team_list)
 
-    # Print the schedule
-    print_schedule(prev_schedule, sheet_name, cfg_position_names)
-
     return prev_schedule
 
 
@@ -716,314 +1951,893 @@ def get_action_enum(action_str):
 
 
 ##################################################################################
-# Choose team
-def choose_team(hour, night_list, users_db, curr_position, team_size, day_from_beginning):
-    is_night = 1 if hour in NIGHT_HOURS or hour == 23 else  0
-
-    team = choose_team_try(hour, night_list, users_db, curr_position, team_size, day_from_beginning);
-    num_of_occ = users_db.teams_db.get_team_occ(team)
+# Min-cost assignment (Hungarian algorithm, with potentials)
+# cost is a matrix [rows][columns], rows <= columns
+# Returns array: column assigned to each row, with a minimal total cost
+# O(rows^2 * columns), the inner loop over the columns is vectorized
+##################################################################################
+def solve_assignment(cost):
+    import numpy as np
+    num_of_rows, num_of_columns = cost.shape
+    if num_of_rows > num_of_columns:
+        error(f"Cannot assign {num_of_rows} rows to {num_of_columns} columns")
+
+    # Potentials, and the row matched to each column (1-based, column 0 is a dummy)
+    u = np.zeros(num_of_rows + 1)
+    v = np.zeros(num_of_columns + 1)
+    row_of = np.zeros(num_of_columns + 1, dtype=np.int64)
+    way = np.zeros(num_of_columns + 1, dtype=np.int64)
+
+    for row in range(1, num_of_rows + 1):
+        # Find the shortest augmenting path from the new row
+        row_of[0] = row
+        column = 0
+        min_slack = np.full(num_of_columns + 1, np.inf)
+        used = np.zeros(num_of_columns + 1, dtype=bool)
+        while row_of[column] != 0:
+            used[column] = True
+            curr_row = row_of[column]
+            slack = cost[curr_row - 1] - u[curr_row] - v[1:]
+            # Relax the columns not on the path
+            free = ~used[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = column
+            # Next column: the one with the minimal slack
+            free_slack = np.where(free, min_slack[1:], np.inf)
+            next_column = int(np.argmin(free_slack)) + 1
+            delta = free_slack[next_column - 1]
+            # Update potentials
+            u[row_of[used]] += delta
+            v[used] -= delta
+            min_slack[~used] -= delta
+            column = next_column
+
+        # Flip the path
+        while column:
+            prev_column = way[column]
+            row_of[column] = row_of[prev_column]
+            column = prev_column
+
+    column_of = np.zeros(num_of_rows, dtype=np.int64)
+    for column in range(1, num_of_columns + 1):
+        if row_of[column]:
+            column_of[row_of[column] - 1] = column - 1
+    return column_of
 
-    # Try several options, choose a team that has the least previous occurrences
-    # Currently this feature is disabled (NUM_OF_TRIES = 0), because it didn't improve the results,
-    # probably because at any given time there are not many options to choose from
-    NUM_OF_TRIES = 0
-    for i in range(NUM_OF_TRIES):
-        team_alt = choose_team_try(hour, night_list, users_db, curr_position, team_size, day_from_beginning);
-        num_of_occ_alt = users_db.teams_db.get_team_occ(team_alt)
-        if num_of_occ_alt < num_of_occ:
-            print(f"Replacing team with better ({num_of_occ_alt} < {num_of_occ})")
-            team = team_alt
-            num_of_occ  = num_of_occ_alt
 
+##################################################################################
+# Scheduler builds the schedule for the next N days
+# All user configurations come from SchedulerCfg, and random numbers from its own
+# generator, so several schedulers can run side by side in one process
+# Nothing is printed: the caller decides what to do with each planned day
+#
+# Usage:
+#   result = Scheduler(cfg).plan(workbook_state, days)
+# Or, one day at a time (only the last day is kept):
+#   for date_str, schedule in Scheduler(cfg).generate(workbook_state, days): ...
+##################################################################################
+class Scheduler:
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.rng = random.Random(cfg.seed)
+        self.policy = None
+        self.validator = None
+        # Users DB of the current build
+        self.users_db = None
+        # Stages of the build, see Profiler
+        self.profiler = Profiler()
+        # Counters of the current build (--counters), see BuildCounters
+        self.counters = None
+
+    ##############################################################################
+    # Build schedule for N days, starting after the previous schedule of the workbook state
+    # The workbook state is not modified, so plan() can be called again
+    # on_day(date_str, schedule) is called as soon as each day is ready
+    def plan(self, workbook_state, days=None, seed=None, on_day=None):
+        if seed is None:
+            seed = self.cfg.seed
+        planned_days = self.generate(workbook_state, days, seed)
+        result = ScheduleResult(self.cfg, self.users_db, workbook_state.prev_schedule, seed)
+        result.violations = self.validator.violations
+
+        for curr_date_str, new_schedule in planned_days:
+            result.add_day(curr_date_str, new_schedule)
+            if on_day and not self.cfg.optimize_iterations:
+                on_day(curr_date_str, new_schedule)
+
+        # Post-processing: the days are final only after it
+        if self.cfg.optimize_iterations:
+            self.users_db.compile_availability(len(result.days) * HOURS_IN_DAY)
+            with self.profiler.stage("optimize"):
+                FairnessOptimizer(self.cfg, result, self.rng).run()
+                self.replay_result(workbook_state, result)
+            if on_day:
+                for curr_date_str, new_schedule in result.days:
+                    on_day(curr_date_str, new_schedule.to_schedule())
+
+        return result
+
+    ##############################################################################
+    # Post-processing moves only the served hours, so rebuild the users DB (TTR, previous
+    # positions, served hours, teams) and the rest rules violations from the final days,
+    # with the same bookkeeping as the build (see replay_single_day_schedule())
+    def replay_result(self, workbook_state, result):
+        users_db = self.start_users_db(workbook_state)
+        prev_schedule = workbook_state.prev_schedule
+        for day, (_, schedule) in enumerate(result.days):
+            schedule = schedule.to_schedule()
+            update_db = 1 if day == 0 and workbook_state.replay_prev else 0
+            self.replay_single_day_schedule(prev_schedule, schedule, users_db, workbook_state.positions_db, day, update_db)
+            prev_schedule = schedule
+        result.users_db = users_db
+        result.violations = self.validator.violations
+
+    ##############################################################################
+    # Start a build, return iterator of the planned days: (date, single day schedule)
+    # Each day is built when requested, and only the previous day is kept
+    # The users DB of the build is self.users_db
+    def generate(self, workbook_state, days=None, seed=None):
+        if days is None:
+            days = self.cfg.days_to_plan
+        if seed is None:
+            seed = self.cfg.seed
+        self.rng = random.Random(seed)
+        # Resumed from a checkpoint: continue its random sequence, unless a seed is given
+        if seed is None and workbook_state.rng_state is not None:
+            self.rng.setstate(workbook_state.rng_state)
+
+        # Selection policy for this build
+        if self.cfg.policy not in SELECTION_POLICIES:
+            error(f"Unknown selection policy '{self.cfg.policy}', expected one of {list(SELECTION_POLICIES)}")
+        self.policy = SELECTION_POLICIES[self.cfg.policy](self.cfg)
+        if self.cfg.engine not in ENGINES:
+            error(f"Unknown engine '{self.cfg.engine}', expected one of {ENGINES}")
+        users_db = self.start_users_db(workbook_state)
+        self.counters = BuildCounters(self.cfg.num_of_positions) if self.cfg.counters else None
+
+        return self.build_days(workbook_state, users_db, days)
+
+    ##############################################################################
+    # Users DB and validator of a build, from the workbook state
+    # The build modifies the users DB, so it is a copy
+    def start_users_db(self, workbook_state):
+        users_db = copy.deepcopy(workbook_state.users_db)
+        users_db.cfg = self.cfg
+        self.policy.attach(users_db)
+        self.validator = ScheduleValidator(self.cfg, users_db)
+        self.validator.add_prev_schedule(workbook_state.prev_schedule)
+        self.users_db = users_db
+        return users_db
+
+    ##############################################################################
+    # Build the days one by one (see generate())
+    def build_days(self, workbook_state, users_db, days):
+        prev_date_str = workbook_state.prev_date_str
+        prev_schedule = workbook_state.prev_schedule
+        for day in range(days):
+            # Build next day schedule (availability is compiled for a day at a time, to keep memory flat)
+            users_db.compile_availability(HOURS_IN_DAY, day * HOURS_IN_DAY)
+            curr_date_str = get_next_date(prev_date_str)
+            # Note: update DB from the previous schedule only for the first day
+            # For other days, DB is updated while building
+            update_db = 1 if day == 0 and workbook_state.replay_prev else 0
+            with self.profiler.stage(f"build {curr_date_str}"):
+                new_schedule = self.build_single_day_schedule(prev_schedule, users_db, workbook_state.positions_db, day, update_db)
+            yield curr_date_str, new_schedule
+
+            # Update prev
+            prev_date_str = curr_date_str
+            prev_schedule = new_schedule
+
+    ##############################################################################
+    # Choose team
+    def choose_team(self, hour, night_list, users_db, curr_position, team_size, day_from_beginning):
+        is_night = 1 if self.cfg.is_night(hour) or hour == 23 else  0
+
+        team = self.choose_team_try(hour, night_list, users_db, curr_position, team_size, day_from_beginning);
+        num_of_occ = users_db.teams_db.get_team_occ(team)
+
+        # Try several options, choose a team that has the least previous occurrences
+        # Currently this feature is disabled (NUM_OF_TRIES = 0), because it didn't improve the results,
+        # probably because at any given time there are not many options to choose from
+        NUM_OF_TRIES = 0
+        for i in range(NUM_OF_TRIES):
+            team_alt = self.choose_team_try(hour, night_list, users_db, curr_position, team_size, day_from_beginning);
+            num_of_occ_alt = users_db.teams_db.get_team_occ(team_alt)
+            if num_of_occ_alt < num_of_occ:
+                print(f"Replacing team with better ({num_of_occ_alt} < {num_of_occ})")
+                team = team_alt
+                num_of_occ  = num_of_occ_alt
+
+        self.finalize_team(team, users_db, is_night)
+
+        return team
+
+    ##############################################################################
     # Update once team is finalized
-    for name in team:
-        users_db.set_ttr(name, is_night)
-    users_db.teams_db.update_team(team)
-
-    return team
-##################################################################################
-# Try to choose team. Do not update DB, because this is not a final decision
-def choose_team_try(hour, night_list, users_db, curr_position, team_size, day_from_beginning):
-    # Init
-    team = []
-    is_night = 1 if hour in NIGHT_HOURS or hour == 23 else  0
-
-    # Calculate absolute hour to use in personal constraints
-    real_hour = day_from_beginning * 24 + hour
-
-    # Build team
-    for i in range(team_size):
-        # Build local db - exclude previous night watchers & people not available at this time
-        local_users_db = get_available_users_db(users_db, curr_position, is_night, night_list, real_hour, exclude=team)
-
-        # Choose team member
-        if is_night and local_users_db.is_empty():
-            #print("Is night and no users, choose user with the least hight_hours")
-            # Get the DB again, but do not exclude night watchers
-            local_users_db = get_available_users_db(users_db, curr_position, 0, night_list, real_hour, exclude=team)
-            name = local_users_db.get_user_with_lowest_night_hours()
+    def finalize_team(self, team, users_db, is_night):
+        for name in team:
+            users_db.set_ttr(name, is_night)
+        users_db.teams_db.update_team(team)
+
+    ##############################################################################
+    # Choose teams of all positions with SWAP at this hour at once (--engine assignment)
+    # Each team member is a slot, people are assigned to the slots with a minimal total cost
+    # Returns dict [position] --> team
+    def assign_teams(self, hour, night_list, users_db, positions_db, positions, day_from_beginning):
+        import numpy as np
+        is_night = 1 if self.cfg.is_night(hour) or hour == 23 else  0
+        real_hour = day_from_beginning * 24 + hour
+
+        # Position of each slot
+        slot_positions = [position for position in positions for _ in range(positions_db.position[position].team_size[hour])]
+        teams = {position: [] for position in positions}
+        if not slot_positions:
+            return teams
+
+        # People who can serve at this hour (rested and available)
+        user_ids = np.flatnonzero((users_db.rested_at <= users_db.clock) & users_db.get_available_mask(real_hour))
+        if len(user_ids) < len(slot_positions):
+            error(f"At {hour}:00, {len(user_ids)} people are available for {len(slot_positions)} team members "
+                  f"(try --shuffle {self.cfg.shuffle_coefficient+1})")
+
+        if self.counters:
+            self.count_assignment_pools(users_db, hour, user_ids, slot_positions, is_night, night_list)
+
+        cost = self.get_assignment_cost(users_db, user_ids, slot_positions, is_night, night_list)
+
+        # Solve, and solve again with a penalty for teams that occurred before
+        best_occ = None
+        for _ in range(ASSIGN_TEAM_ROUNDS + 1):
+            chosen = solve_assignment(cost)
+            curr_teams = {position: [] for position in positions}
+            for slot, column in enumerate(chosen):
+                curr_teams[slot_positions[slot]].append(users_db.names[user_ids[column]])
+            occ = {position: users_db.teams_db.get_team_occ(team) if len(team) > 1 else 0 for position, team in curr_teams.items()}
+            if best_occ is None or sum(occ.values()) < sum(best_occ.values()):
+                teams, best_occ = curr_teams, occ
+            if sum(occ.values()) == 0:
+                break
+            # Penalty for the members of the repeated teams, in the slots of that position
+            for slot, column in enumerate(chosen):
+                cost[slot, column] += ASSIGN_TEAM_COST * occ[slot_positions[slot]]
+
+        for position, team in teams.items():
+            for name in team:
+                self.verify_team_member(name, users_db, is_night, real_hour, night_list)
+            self.finalize_team(team, users_db, is_night)
+            if self.counters and is_night:
+                self.counters.add_night_fallback(hour, position, sum(1 for name in team if name in night_list))
+
+        return teams
+
+    ##############################################################################
+    # Counters of assign_teams(), same as the greedy engine: a choice for each team member,
+    # out of the pool that get_available_users_db() would give (without the other members of the team)
+    def count_assignment_pools(self, users_db, hour, user_ids, slot_positions, is_night, night_list):
+        import numpy as np
+        candidates = np.zeros(len(users_db.names), dtype=bool)
+        candidates[user_ids] = True
+        if is_night:
+            candidates &= ~users_db.get_mask(night_list)
+        num_of_candidates = int(np.count_nonzero(candidates))
+        for position in slot_positions:
+            pool_size = int(np.count_nonzero(users_db.remove_repetative(candidates, position)))
+            self.counters.add_pool(hour, position, pool_size, num_of_candidates - pool_size)
+
+    ##############################################################################
+    # Cost matrix [slot][person] for assign_teams()
+    def get_assignment_cost(self, users_db, user_ids, slot_positions, is_night, night_list):
+        # Cost of the person, regardless of the position:
+        import numpy as np
+        # prefer long rest (TTR slack) and low score (and at night, low night load)
+        ttr = (users_db.rested_at[user_ids] - users_db.clock).astype(float)
+        person_cost = ASSIGN_TTR_WEIGHT * ttr + ASSIGN_SCORE_WEIGHT * users_db.get_score(user_ids)
+        if is_night:
+            person_cost += ASSIGN_NIGHT_WEIGHT * users_db.night_hours[user_ids]
+            person_cost += ASSIGN_NIGHT_FALLBACK_COST * users_db.get_mask(night_list)[user_ids]
+        person_cost += ASSIGN_JITTER * np.array([self.rng.random() for _ in user_ids])
+
+        # Cost of the person in each slot: avoid repeating the previous position
+        prev_position = users_db.prev_position[user_ids]
+        cost = np.empty((len(slot_positions), len(user_ids)))
+        for slot, position in enumerate(slot_positions):
+            cost[slot] = person_cost + ASSIGN_REPEAT_COST * (prev_position == position)
+        return cost
+    ##############################################################################
+    # Try to choose team. Do not update DB, because this is not a final decision
+    def choose_team_try(self, hour, night_list, users_db, curr_position, team_size, day_from_beginning):
+        # Init
+        team = []
+        is_night = 1 if self.cfg.is_night(hour) or hour == 23 else  0
+
+        # Calculate absolute hour to use in personal constraints
+        real_hour = day_from_beginning * 24 + hour
+
+        # Build team
+        for i in range(team_size):
+            # Build local db - exclude previous night watchers & people not available at this time
+            candidates = self.get_available_users_db(users_db, curr_position, is_night, night_list, real_hour, exclude=team)
+
+            # Choose team member
+            if is_night and candidates.is_empty():
+                #print("Is night and no users, choose user with the least hight_hours")
+                # Get the DB again, but do not exclude night watchers
+                candidates = self.get_available_users_db(users_db, curr_position, 0, night_list, real_hour, exclude=team)
+                name = candidates.get_user_with_lowest_night_hours(self.rng)
+                if self.counters:
+                    self.counters.add_night_fallback(hour, curr_position)
+            else:
+                name = self.choose_team_member(candidates)
+
+            # Check for violations
+            self.verify_team_member(name, users_db, is_night, real_hour, night_list)
+
+            # Update TTR
+            team.append(name)
+
+        return team
+
+    ##############################################################################
+    # Choose a single person out of available
+    def choose_team_member(self, candidates):
+        return self.policy.choose(candidates, self.rng)
+
+    ##############################################################################
+    # Check chosen team member for violations
+    def verify_team_member(self, name, users_db, is_night, absolute_hour, night_list):
+        relative_hour  = absolute_hour % HOURS_IN_DAY
+        message_header = f"At {relative_hour}:00, the chosen team member ({name}) "
+
+        if users_db.get_ttr(name) > 0:
+            error(message_header+f"has a positive TTR {ttr_db[name]}\n")
+        if not users_db.is_available(name, absolute_hour):
+            error(message_header+f"should be on vacation (try --shuffle {self.cfg.shuffle_coefficient+1})\n")
+        #if is_night and name in night_list:
+        #    warning(message_header+f"has already served last night")
+
+        return
+
+
+    ##############################################################################
+    # Get view of the users DB, but only people available to be chosen
+    # Note: users are not copied, only their ids are collected
+    def get_available_users_db(self, users_db, curr_position, is_night, night_list, real_hour, exclude=[]):
+        import numpy as np
+        # Exclude people with positive TTR (didn't get their rest yet)
+        candidates = users_db.rested_at <= users_db.clock
+
+        # Do not add people on "exclude" list
+        candidates &= ~users_db.get_mask(exclude)
+
+        # If is night, do not add previous night watchers to local_db
+        if is_night:
+            candidates &= ~users_db.get_mask(night_list)
+
+        # Do not add people not available due to time off/on
+        candidates &= users_db.get_available_mask(real_hour)
+
+        # Remove people that recently served in this position
+        pool = users_db.remove_repetative(candidates, curr_position)
+        if self.counters:
+            pool_size = int(np.count_nonzero(pool))
+            self.counters.add_pool(real_hour % HOURS_IN_DAY, curr_position, pool_size, int(np.count_nonzero(candidates)) - pool_size)
+
+        return CandidatesView(users_db, pool)
+
+
+    ##############################################################################
+    # Resize team
+    # Do not replace all team members, but, based on the previous team,
+    # release or add N members
+    def resize_team(self, hour, night_list, users_db, curr_position, old_team, new_team_size, day_from_beginning):
+        if self.counters:
+            self.counters.add_resize(hour, curr_position, new_team_size > len(old_team))
+        if new_team_size == 0:
+            return [""]
+
+        # Create new team list (to avoid modifying the previous hour value, team is passed by reference)
+        new_team = old_team.copy()
+
+        old_team_size = len(old_team)
+        if old_team_size == new_team_size:
+            error(f"Resize at {hour}:00: old_team_size == new_team_size == {old_team_size}")
+
+        # Resize
+        if new_team_size < old_team_size:
+            # Reduce team size
+            for i in range(old_team_size - new_team_size):
+                random_index = self.rng.randint(0, len(new_team) - 1)
+                released = new_team.pop(random_index)
         else:
-            name = choose_team_member(local_users_db)
+            # Increase team size
+            num_of_members_to_add = new_team_size - old_team_size
+            new_team += self.choose_team(hour, night_list, users_db, curr_position, num_of_members_to_add, day_from_beginning)
+
+        return new_team
+
+
+    ##############################################################################
+    # Build schedule for a single day, based on the previous day
+    def build_single_day_schedule(self, prev_schedule, users_db, positions_db, day_from_beginning, update_db):
+        schedule = [[] for _ in range(HOURS_IN_DAY)]
+        # Stores the current team at the specific position
+        # If no action, the same team continues to the next hour
+        # FIXME: use [hour-1]?
+        prev_team = [[] for _ in range(self.cfg.num_of_positions)]
+
+        # Get list of night watchers information from the previous schedule
+        # Optionally, update the DB with it (see build_days())
+        night_list = self.get_night_list(users_db, prev_schedule, update_db)
+
+        # For each hour
+        for hour in range(HOURS_IN_DAY):
+            is_night = self.cfg.is_night(hour)
+            actions = [get_action_enum(str(positions_db.position[position].action[hour])) for position in range(self.cfg.num_of_positions)]
+
+            # Assignment engine: choose all SWAP teams of this hour at once
+            swap_teams = {}
+            if self.cfg.engine == "assignment":
+                swap_positions = [position for position in range(self.cfg.num_of_positions) if actions[position] == SWAP]
+                swap_teams = self.assign_teams(hour, night_list, users_db, positions_db, swap_positions, day_from_beginning)
+
+            # For each position
+            for position in range(self.cfg.num_of_positions):
+                # Assign team (should be a function)
+                team_size = positions_db.position[position].team_size[hour]
+                action = actions[position]
+                team = prev_team[position]
+
+                if action == SWAP and position in swap_teams:
+                    team = swap_teams[position]
+                elif action == SWAP:
+                    team = self.choose_team(hour, night_list, users_db, position, team_size, day_from_beginning)
+                elif action == RESIZE:
+                    team = self.resize_team(hour, night_list, users_db, position, team, team_size, day_from_beginning)
+                elif hour == 0:
+                    team = prev_schedule[HOURS_IN_DAY - 1][position]
+                    # Note: these people should be recorded as night watchers
+                    # They are not on the list, because they started the shift at "day hours" (23:00)
+                    for name in team:
+                        night_list.append(name)
 
-        # Check for violations
-        verify_team_member(name, users_db, is_night, real_hour, night_list)
+                # Put the team in the schedule
+                schedule[hour].append(team)
+                prev_team[position] = team
 
-        # Update TTR
-        team.append(name)
+                # Update user personal data
+                for name in team:
+                    users_db.update_user(name, position, hour)
+                    self.validator.check(name, day_from_beginning * HOURS_IN_DAY + hour)
 
-    return team
+            # End of hour - update TTR
+            users_db.decrement_ttr()
 
-##################################################################################
-# Choose a single person out of available
-def choose_team_member(users_db):
+        return schedule
 
-    # Get all names for with <SHUFFLE_COEFFICIENT> TTRs
-    # (TTR, TTR+1, ... , TTR+SHUFFLE_COEFFICIENT-1)
-    all_names_with_lowest_ttr = get_list_of_lowest_ttrs(users_db)
 
-    # Get all names with lowest score if setting is set to true
-    if(BY_SCORE):
-        all_names_with_lowest_ttr = get_list_of_lowest_score(users_db, all_names_with_lowest_ttr)
-    # Choose random name
-    shuffled_list_of_names = random.sample(all_names_with_lowest_ttr, len(all_names_with_lowest_ttr))
+    ##############################################################################
+    # Replay a single day of a schedule that is already built (see replay_result()),
+    # with the bookkeeping of build_single_day_schedule(): the teams of SWAP, and the members
+    # that RESIZE adds, are finalized (TTR, teams), then each member serves the hour
+    def replay_single_day_schedule(self, prev_schedule, schedule, users_db, positions_db, day_from_beginning, update_db):
+        self.get_night_list(users_db, prev_schedule, update_db)
+        prev_team = [[] for _ in range(self.cfg.num_of_positions)]
 
-    name = shuffled_list_of_names[0]
+        for hour in range(HOURS_IN_DAY):
+            is_night = 1 if self.cfg.is_night(hour) or hour == 23 else  0
+            for position in range(self.cfg.num_of_positions):
+                action = get_action_enum(str(positions_db.position[position].action[hour]))
+                team = schedule[hour][position]
 
-    return name
+                if action == SWAP:
+                    self.finalize_team(team, users_db, is_night)
+                elif action == RESIZE and len(team) > len(prev_team[position]):
+                    # The added members are at the end of the team, see resize_team()
+                    self.finalize_team(team[len(prev_team[position]):], users_db, is_night)
+                prev_team[position] = team
 
-##################################################################################
-# Gets the name with the lowest score out of the names with the lowest ttr
-def get_list_of_lowest_score(users_db, all_names_with_lowest_ttr):
-    min_score = 1000
-    for i in range(len(all_names_with_lowest_ttr)):
-        # Calculating score (day_hours + night_hours*1.5
-        score = (users_db.users_data[all_names_with_lowest_ttr[i]].total_hours - users_db.users_data[all_names_with_lowest_ttr[i]].night_hours) + users_db.users_data[all_names_with_lowest_ttr[i]].night_hours*1.5
-        # Getting the minimum score
-        if score < min_score:
-            min_score = score
-            name = all_names_with_lowest_ttr[i]
+                for name in team:
+                    users_db.update_user(name, position, hour)
+                    self.validator.check(name, day_from_beginning * HOURS_IN_DAY + hour)
 
-    # Returning in list because of line 712
-    return [name]
+            users_db.decrement_ttr()
 
-##################################################################################
-# Check chosen team member for violations
-def verify_team_member(name, users_db, is_night, absolute_hour, night_list):
-    relative_hour  = absolute_hour % HOURS_IN_DAY
-    message_header = f"At {relative_hour}:00, the chosen team member ({name}) "
+    ##############################################################################
+    # Get list of night watchers
+    # Optionally update the DB
+    def get_night_list(self, users_db, schedule, update_db=0):
+        # Init
+        night_list = []
 
-    if users_db.get_ttr(name) > 0:
-        error(message_header+f"has a positive TTR {ttr_db[name]}\n")
-    if not users_db.is_available(name, absolute_hour):
-        error(message_header+f"should be on vacation (try --shuffle {SHUFFLE_COEFFICIENT+1})\n")
-    #if is_night and name in night_list:
-    #    warning(message_header+f"has already served last night")
+        for hour in range(HOURS_IN_DAY):
+            is_night = self.cfg.is_night(hour)
 
-    return
+            for position in range(self.cfg.num_of_positions):
+                team = schedule[hour][position]
 
+                for name in team:
+                    # Ignore people that are not on the list
+                    if not name in users_db.valid_names: continue
 
-##################################################################################
-# Build ttr_db, but only people available to be chosen
-def get_available_users_db(users_db, curr_position, is_night, night_list, real_hour, exclude=[]):
-    # Init
-    available_users_db = UsersDB()
+                    if is_night:
+                        if name not in night_list:
+                            night_list.append(name)
 
-    # Build available people DB
-    for item in users_db.users_data.items():
-        name = item[0]
-        user_data = item[1]
-        ttr = user_data.ttr
+                    # Update user_db
+                    if update_db:
+                        users_db.update_user(name, position, hour)
 
-        # Do not add people on "exclude" list
-        if name in exclude:
-            continue
+            # Update TTS (for each hour, not for each position)
+            if update_db:
+                users_db.decrement_ttr()
 
-        # If is night, do not add previous night watchers to local_db
-        if is_night and name in night_list:
-            continue
+        return night_list
 
-        # Do not add people not available due to time off/on
-        if not users_db.is_available(name, real_hour):
-            continue
 
-        # Exclude people with positive TTR (didn't get their rest yet)
-        if ttr > 0:
-            continue
+##################################################################################
+# Analysis of existing schedules (--analyze), without building
+# Replays the days into the users DB (served hours, TTR, teams) and checks the rest rules,
+# same as the build does, so the sinks (see get_sinks()) check them as one timeline
+# The previous schedule is replayed first, same as before a build (see WorkbookState.replay_prev)
+##################################################################################
+class ScheduleAnalyzer:
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.rng = random.Random(cfg.seed)
+        self.validator = None
+        # Users DB of the analysis
+        self.users_db = None
+        # Stages of the analysis, see Profiler
+        self.profiler = Profiler()
+
+    ##############################################################################
+    # Start the analysis, return iterator of the days: (date, single day schedule)
+    # days: list of (date, single day schedule), in order
+    def generate(self, workbook_state, days):
+        users_db = copy.deepcopy(workbook_state.users_db)
+        users_db.cfg = self.cfg
+        self.validator = ScheduleValidator(self.cfg, users_db)
+        self.validator.add_prev_schedule(workbook_state.prev_schedule)
+        self.users_db = users_db
+        return self.replay_days(users_db, workbook_state.prev_schedule, days, workbook_state.replay_prev)
+
+    ##############################################################################
+    # Replay the days one by one (see generate())
+    def replay_days(self, users_db, prev_schedule, days, replay_prev=1):
+        if replay_prev:
+            self.replay_prev_schedule(users_db, prev_schedule)
+
+        # Team at each position in the last hour, a team that continues is the same shift
+        prev_team = [[name for name in team if name in users_db.ids] for team in prev_schedule[HOURS_IN_DAY - 1]]
+        for day, (date_str, schedule) in enumerate(days):
+            with self.profiler.stage(f"replay {date_str}"):
+                self.replay_single_day(schedule, users_db, prev_team, day)
+            yield date_str, schedule
+
+    ##############################################################################
+    # Update the users DB with the previous schedule (not checked, teams are not counted)
+    def replay_prev_schedule(self, users_db, prev_schedule):
+        for hour in range(HOURS_IN_DAY):
+            for position in range(self.cfg.num_of_positions):
+                for name in prev_schedule[hour][position]:
+                    # Ignore people that are not on the list
+                    if name in users_db.ids:
+                        users_db.update_user(name, position, hour)
+            users_db.decrement_ttr()
 
-        # If got this far, the person is available
-        available_users_db.add_user(user_data)
+    ##############################################################################
+    def replay_single_day(self, schedule, users_db, prev_team, day_from_beginning):
+        for hour in range(HOURS_IN_DAY):
+            for position in range(self.cfg.num_of_positions):
+                # Ignore people that are not on the list
+                team = [name for name in schedule[hour][position] if name in users_db.ids]
+
+                # Teams are counted per shift, not per hour
+                if team != prev_team[position]:
+                    users_db.teams_db.update_team(team)
+                prev_team[position] = team
 
-    # Collect people that recently served in this position
-    available_users_db.remove_repetative(curr_position)
+                # Update user personal data
+                for name in team:
+                    users_db.update_user(name, position, hour)
+                    self.validator.check(name, day_from_beginning * HOURS_IN_DAY + hour)
 
-    return available_users_db
+            # End of hour - update TTR
+            users_db.decrement_ttr()
 
 
 ##################################################################################
-# Resize team
-# Do not replace all team members, but, based on the previous team,
-# release or add N members
-def resize_team(hour, night_list, users_db, curr_position, old_team, new_team_size, day_from_beginning):
-    if new_team_size == 0:
-        return [""]
+# Sinks: get the planned days one by one (add_day()), and finish when the build
+# is done (close()), or drop their partial output if it stopped (abort())
+# main() streams the days to a list of sinks, see get_sinks()
+##################################################################################
+class ScheduleSink:
+    # Stages of the sink, see Profiler (set by get_sinks())
+    profiler = Profiler()
 
-    # Create new team list (to avoid modifying the previous hour value, team is passed by reference)
-    new_team = old_team.copy()
+    def add_day(self, date_str, schedule):
+        pass
 
-    old_team_size = len(old_team)
-    if old_team_size == new_team_size:
-        error(f"Resize at {hour}:00: old_team_size == new_team_size == {old_team_size}")
+    def close(self):
+        pass
 
-    # Resize
-    if new_team_size < old_team_size:
-        # Reduce team size
-        for i in range(old_team_size - new_team_size):
-            random_index = random.randint(0, len(new_team) - 1)
-            released = new_team.pop(random_index)
-    else:
-        # Increase team size
-        num_of_members_to_add = new_team_size - old_team_size
-        new_team += choose_team(hour, night_list, users_db, curr_position, num_of_members_to_add, day_from_beginning)
+    def abort(self):
+        pass
+
+
+##################################################################################
+# Print each day to screen (and personal schedule)
+class StdoutSink(ScheduleSink):
+    def __init__(self, cfg, position_names):
+        self.cfg = cfg
+        self.position_names = position_names
 
-    return new_team
+    def add_day(self, date_str, schedule):
+        with self.profiler.stage("print"):
+            output_schedule(self.cfg, schedule, date_str, self.position_names)
 
 
 ##################################################################################
-# Build schedule for a single day, based on the previous day
-def build_single_day_schedule(curr_date_str, prev_schedule, users_db, cfg, day_from_beginning):
-    schedule = [[] for _ in range(HOURS_IN_DAY)]
-    # Stores the current team at the specific position
-    # If no action, the same team continues to the next hour
-    # FIXME: use [hour-1]?
-    prev_team = [[] for _ in range(NUM_OF_POSITIONS)]
+# Write all days to the XLS file, once the build is done (see XlsOutput)
+class XlsSink(ScheduleSink):
+    def __init__(self, file_name, position_names):
+        self.xls_output = XlsOutput(file_name, position_names)
 
-    # Note: update DB only for the first day
-    # For other days, DB is updated while building
-    update_db = 1  if day_from_beginning == 0 else 0
+    def add_day(self, date_str, schedule):
+        self.xls_output.add_schedule(schedule, date_str)
 
-    # Get list of night watchers information from the previous schedule
-    night_list = get_night_list(users_db, prev_schedule, update_db)
+    def close(self):
+        self.xls_output.save(self.profiler)
 
-    # For each hour
-    for hour in range(HOURS_IN_DAY):
-        is_night = 1 if hour in NIGHT_HOURS else 0
-        # For each position
-        for position in range(NUM_OF_POSITIONS):
-            # Assign team (should be a function)
-            team_size = cfg.position[position].team_size[hour]
-            action = get_action_enum(str(cfg.position[position].action[hour]))
-            team = prev_team[position]
-
-            if action == SWAP:
-                team = choose_team(hour, night_list, users_db, position, team_size, day_from_beginning)
-            elif action == RESIZE:
-                team = resize_team(hour, night_list, users_db, position, team, team_size, day_from_beginning)
-            elif hour == 0:
-                team = prev_schedule[HOURS_IN_DAY - 1][position]
-                # Note: these people should be recorded as night watchers
-                # They are not on the list, because they started the shift at "day hours" (23:00)
-                for name in team:
-                    night_list.append(name)
 
-            # Put the team in the schedule
-            schedule[hour].append(team)
-            prev_team[position] = team
+##################################################################################
+# Write each day to a CSV file: date, hour, team per position
+# Written to a temporary file, that replaces the file when the build is done,
+# so a build that stopped does not leave a partial CSV file
+class CsvSink(ScheduleSink):
+    def __init__(self, file_name, position_names):
+        import csv
+        self.file_name = file_name
+        self.temp_file_name = file_name + ".tmp"
+        self.file = open(self.temp_file_name, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        # Names are kept inverted (for the screen), same as for the XLS file
+        self.writer.writerow(["Date", "Hour"] + [name[::-1] for name in position_names])
+
+    def add_day(self, date_str, schedule):
+        with self.profiler.stage("csv write"):
+            self.write_day(date_str, schedule)
+
+    def write_day(self, date_str, schedule):
+        for hour in range(HOURS_IN_DAY):
+            self.writer.writerow([date_str, "{:02d}:00".format(hour)] + [",".join(team)[::-1] for team in schedule[hour]])
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temp_file_name, self.file_name)
+
+    def abort(self):
+        # After close(), the file is already in place
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.temp_file_name)
 
-            # Update user personal data
-            for name in team:
-                users_db.update_user(name, position, hour)
 
-        # End of hour - update TTR
-        users_db.decrement_ttr()
+##################################################################################
+# Verify each day against the days before it (as many as the longest TTR can reach),
+# report the violations found while building
+# Existing days (--analyze) may break the rules: they are not verified (that stops at the
+# first violation), the violations found by ScheduleValidator are reported instead
+class VerifySink(ScheduleSink):
+    def __init__(self, cfg, users_db, prev_schedule, violations):
+        self.cfg = cfg
+        self.users_db = users_db
+        self.violations = violations
+        self.num_of_days = 1 + max(cfg.ttr_night, cfg.ttr_day) // HOURS_IN_DAY + 1
+        # Last days, and the absolute hour of the first one
+        self.days = [ScheduleTensor.from_schedule(prev_schedule, list(users_db.names))]
+        self.first_hour = 0
+
+    def add_day(self, date_str, schedule):
+        if self.cfg.analyze_last_date:
+            return
+        self.days.append(ScheduleTensor.from_schedule(schedule, self.days[0].names))
+        with self.profiler.stage("verify"):
+            verify(self.cfg, self.users_db.valid_names, ScheduleTensor.concatenate(self.days, self.days[0].names), self.first_hour)
+        if len(self.days) == self.num_of_days:
+            self.days.pop(0)
+            self.first_hour += HOURS_IN_DAY
+
+    def close(self):
+        if self.cfg.analyze_last_date:
+            print_header(f"Rest rules violations (TTR, nights in a row): {len(self.violations)}")
+            for message in self.violations[:ANALYZE_MAX_VIOLATIONS]:
+                print(message)
+            if len(self.violations) > ANALYZE_MAX_VIOLATIONS:
+                print(f"... and {len(self.violations) - ANALYZE_MAX_VIOLATIONS} more")
+            return
+        for message in self.violations:
+            warning(message)
 
-    # Print to screen and (optionally) to file
-    output_schedule(schedule, curr_date_str, cfg.position_names())
 
-    return schedule
+##################################################################################
+# Statistics of the whole schedule (--statistics): teams, positions
+# Keeps all the days, as person ids (see ScheduleTensor)
+class StatisticsSink(ScheduleSink):
+    def __init__(self, cfg, users_db, prev_schedule, position_names):
+        self.cfg = cfg
+        self.users_db = users_db
+        self.position_names = position_names
+        self.days = [ScheduleTensor.from_schedule(prev_schedule, list(users_db.names))]
+
+    def add_day(self, date_str, schedule):
+        self.days.append(ScheduleTensor.from_schedule(schedule, self.days[0].names))
+
+    def close(self):
+        total_schedule = ScheduleTensor.concatenate(self.days, self.days[0].names)
+        with self.profiler.stage("check teams"):
+            check_teams(self.cfg, total_schedule)
+        with self.profiler.stage("check positions"):
+            check_positions(self.cfg, total_schedule, self.position_names)
+        self.users_db.teams_db.print(self.cfg.invert_strings)
 
 
 ##################################################################################
-# Print schedule to screen and (optionally) to file
-def output_schedule(schedule, date_str, cfg_position_names):
-    # Print to screen
-    print_schedule(schedule, date_str, cfg_position_names)
-    if PERSONAL_SCHEDULE:
-        print_personal_info(schedule, date_str)
+# Fairness of the whole schedule, from the running statistics of the users DB
+class FairnessSink(ScheduleSink):
+    def __init__(self, cfg, users_db):
+        self.cfg = cfg
+        self.users_db = users_db
+        self.score = None
 
-    # Write to XLS file
-    if DO_WRITE: write_schedule_to_xls(schedule, date_str, cfg_position_names)
+    def close(self):
+        with self.profiler.stage("check fairness"):
+            self.score = check_fairness(self.cfg, self.users_db)
 
 
 ##################################################################################
-# Getting the lowest items and keys of the values for an "n" amount of numbers above the lowest ttr
-# Returns the names with ttr in [TTR, TTR+1, TTR+2, ... TTR+n-1]
-def get_list_of_lowest_ttrs(users_db):
-    # Sanity
-    if users_db.is_empty():
-        error("At function get_list_of_lowest_ttrs() got an empty users DB")
+# Save the planner state after each day (--checkpoint, see PlannerCheckpoint)
+# The days are streamed as soon as they are built, so the users DB and the random
+# generator are at the end of the day. After post-processing (--optimize) they are at
+# the end of all the days (the users DB is rebuilt from the final days, see
+# Scheduler.replay_result()), so the state is saved once, with the last day
+class CheckpointSink(ScheduleSink):
+    def __init__(self, cfg, scheduler):
+        self.file_name = cfg.checkpoint_file_name
+        self.scheduler = scheduler
+        self.each_day = not cfg.optimize_iterations
+        self.last_day = None
+
+    def add_day(self, date_str, schedule):
+        self.last_day = (date_str, schedule)
+        if self.each_day:
+            self.save()
+
+    def close(self):
+        if not self.each_day and self.last_day:
+            self.save()
+
+    def save(self):
+        date_str, schedule = self.last_day
+        with self.profiler.stage("checkpoint"):
+            PlannerCheckpoint.from_build(date_str, schedule, self.scheduler.users_db, self.scheduler.rng).save(self.file_name)
 
-    # Get list of all available TTRs
-    list_of_unique_available_ttr_values = []
-    for item in users_db.users_data.items():
-        if item[1].ttr not in list_of_unique_available_ttr_values:
-            list_of_unique_available_ttr_values.append(item[1].ttr)
 
-    # Sort the list
-    sorted_list_of_ttr_values = sorted(list_of_unique_available_ttr_values)
+##################################################################################
+# Add the days to the fairness ledger (--ledger, see FairnessLedger)
+# Only days that are committed (--write, or existing sheets with --analyze) are added,
+# all at once when the run is done, so a run that stopped does not change the ledger
+class LedgerSink(ScheduleSink):
+    def __init__(self, cfg, prev_schedule, valid_names):
+        self.cfg = cfg
+        self.valid_names = valid_names
+        self.prev_line = prev_schedule[HOURS_IN_DAY - 1]
+        self.days = []
+
+    def add_day(self, date_str, schedule):
+        self.days.append((date_str, schedule))
 
-    # Get N lowest TTRs
-    list_of_n_lowest_ttrs = sorted_list_of_ttr_values[:SHUFFLE_COEFFICIENT]
+    def close(self):
+        with self.profiler.stage("ledger"):
+            ledger = FairnessLedger(self.cfg.ledger_file_name)
+            try:
+                ledger.set_days(self.cfg, self.days, self.prev_line, self.valid_names)
+            finally:
+                ledger.close()
 
-    # Get list of names (only for negative TTRs)
-    names_with_lowest_ttrs = []
-    for item in users_db.users_data.items():
-        name = item[0]
-        ttr  = item[1].ttr
-        if ttr <= 0 and ttr in list_of_n_lowest_ttrs:
-            names_with_lowest_ttrs.append(name)
 
-    return names_with_lowest_ttrs
+##################################################################################
+# Print the counters of the build when it is done (--counters, see BuildCounters),
+# and write them next to the XLS file
+class CountersSink(ScheduleSink):
+    def __init__(self, cfg, scheduler, position_names):
+        self.cfg = cfg
+        self.scheduler = scheduler
+        self.position_names = position_names
+
+    def close(self):
+        import json
+        counters = self.scheduler.counters
+        counters.print(self.position_names, self.cfg.invert_strings)
+        with open(get_counters_file_name(self.cfg), "w", encoding="utf-8") as file:
+            json.dump({"engine": self.cfg.engine, **counters.to_dict(self.position_names)}, file, ensure_ascii=False)
 
 
 ##################################################################################
-# Get list of night watchers
-# Optionally update the DB
-def get_night_list(users_db, schedule, update_db=0):
-    # Init
-    night_list = []
+# Sinks for the command line options, in the order of the output
+# scheduler: Scheduler (or ScheduleAnalyzer), after generate()
+def get_sinks(cfg, scheduler, workbook_state):
+    users_db = scheduler.users_db
+    violations = scheduler.validator.violations
+    position_names = workbook_state.positions_db.position_names()
+    # Existing days (--analyze) are not printed, only checked
+    sinks = [] if cfg.analyze_last_date else [StdoutSink(cfg, position_names)]
+    if cfg.do_write:
+        sinks.append(XlsSink(cfg.input_file_name, position_names))
+    if cfg.csv_file_name:
+        sinks.append(CsvSink(cfg.csv_file_name, position_names))
+    sinks.append(VerifySink(cfg, users_db, workbook_state.prev_schedule, violations))
+    if cfg.print_statistics or cfg.analyze_last_date:
+        sinks.append(StatisticsSink(cfg, users_db, workbook_state.prev_schedule, position_names))
+    sinks.append(FairnessSink(cfg, users_db))
+    if cfg.checkpoint_file_name:
+        sinks.append(CheckpointSink(cfg, scheduler))
+    # A dry run (without --write) only reads the ledger
+    if cfg.ledger_file_name and (cfg.do_write or cfg.analyze_last_date):
+        sinks.append(LedgerSink(cfg, workbook_state.prev_schedule, users_db.valid_names))
+    # Existing days (--analyze) have no build to count
+    if cfg.counters and not cfg.analyze_last_date:
+        sinks.append(CountersSink(cfg, scheduler, position_names))
+    for sink in sinks:
+        sink.profiler = scheduler.profiler
+    return sinks
 
-    for hour in range(HOURS_IN_DAY):
-        is_night = 1 if hour in NIGHT_HOURS else 0
 
-        for position in range(NUM_OF_POSITIONS):
-            team = schedule[hour][position]
+##################################################################################
+# Profile (--profile) and counters (--counters) are written next to the XLS file
+def get_profile_file_name(cfg):
+    return os.path.splitext(cfg.input_file_name)[0] + ".profile.json"
 
-            for name in team:
-                # Ignore people that are not on the list
-                if not name in users_db.valid_names: continue
 
-                if is_night:
-                    if name not in night_list:
-                        night_list.append(name)
+def get_counters_file_name(cfg):
+    return os.path.splitext(cfg.input_file_name)[0] + ".counters.json"
 
-                # Update user_db
-                if update_db:
-                    users_db.update_user(name, position, hour)
 
-        # Update TTS (for each hour, not for each position)
-        if update_db:
-            users_db.decrement_ttr()
+##################################################################################
+# Stream the days to the sinks, each day as soon as it is ready
+# If the build stops (error() exits), the sinks drop their partial output
+def stream_days(days, sinks):
+    try:
+        for date_str, schedule in days:
+            for sink in sinks:
+                sink.add_day(date_str, schedule)
+        for sink in sinks:
+            sink.close()
+    except SystemExit:
+        for sink in sinks:
+            sink.abort()
+        raise
 
-    return night_list
+
+##################################################################################
+# Print schedule to screen (and personal schedule)
+# Note: the files are written by the sinks (see get_sinks())
+def output_schedule(cfg, schedule, date_str, cfg_position_names):
+    # Print to screen
+    print_schedule(cfg, schedule, date_str, cfg_position_names)
+    if cfg.personal_schedule:
+        print_personal_info(schedule, date_str)
 
 
 ##################################################################################
 # Print schedule
-def print_schedule(schedule, schedule_name, cfg_position_names):
+def print_schedule(cfg, schedule, schedule_name, cfg_position_names):
     print_delimiter_and_str(schedule_name)
     header = "Hour\t"
-    for p in range(NUM_OF_POSITIONS):
-        header += format_str(cfg_position_names[p]) + "\t"
+    for p in range(len(cfg_position_names)):
+        header += format_str(cfg_position_names[p], invert=cfg.invert_strings) + "\t"
     print_header(header)
 
     for hour in range(HOURS_IN_DAY):
@@ -1031,23 +2845,21 @@ def print_schedule(schedule, schedule_name, cfg_position_names):
             error("No schedule for hour " + "{:02d}:00".format(hour))
         line_str = "{:02d}:00\t".format(hour)
         for team in schedule[hour]:
-            line_str += format_str(",".join(team))
+            line_str += format_str(",".join(team), invert=cfg.invert_strings)
             line_str += "\t"
         print(line_str)
 
 ##################################################################################
 # Format str for output: inverse if needed, constant width
-def format_str(str, width=COLUMN_WIDTH):
-    if INVERT_STRINGS:
+def format_str(str, width=COLUMN_WIDTH, invert=1):
+    if invert:
         str = str[::-1]
     return str.ljust(width)
 
 ##################################################################################
-# Write schedule to XLS file
-def write_schedule_to_xls(schedule, sheet_name, cfg_position_names):
-    # Open an existing Excel file
-    workbook = openpyxl.load_workbook(INPUT_FILE_NAME)
-
+# Write schedule to a new sheet of an open XLS workbook, return the sheet
+# Note: the sheet is colored (see color_worksheet()) and the workbook is saved by the caller
+def write_schedule_to_xls(workbook, schedule, sheet_name, cfg_position_names):
     # Get sheet name for output (only if not provided by the user)
     if not sheet_name:
         sheet_name = str(datetime.date.today() + datetime.timedelta(days=1))
@@ -1060,7 +2872,7 @@ def write_schedule_to_xls(schedule, sheet_name, cfg_position_names):
 
     # Build header row
     header_row = ["Time"]
-    for p in range(NUM_OF_POSITIONS):
+    for p in range(len(cfg_position_names)):
         name = cfg_position_names[p]
         header_row.append(name[::-1])
     worksheet.append(header_row)
@@ -1073,70 +2885,57 @@ def write_schedule_to_xls(schedule, sheet_name, cfg_position_names):
             row_of_str.append((",".join(team))[::-1])
         worksheet.append(row_of_str)
 
-    # Add colors
-    color_worksheet(worksheet)
-
-    # Save the workbook to a file
-    workbook.save(INPUT_FILE_NAME)
+    return worksheet
 
 
 ##################################################################################
 # Color the worksheet
+# Single pass over the cells: each position column gets its color, the header row is bold
+# Fill and font objects are shared by all the cells with the same style
 def color_worksheet(worksheet):
-    color_column(worksheet, 2, 'pink')
-    color_column(worksheet, 3, 'green')
-    color_column(worksheet, 4, 'yellow')
-    color_column(worksheet, 5, 'blue')
-    color_column(worksheet, 6, 'purple')
+    from openpyxl.styles import Font
+    header_font = Font(bold=True)
+    position_fills = get_position_fills(worksheet.max_column - 1)
 
-    for cell in worksheet[1]:
-        cell.font = Font(bold=True)
+    for row in worksheet.iter_rows():
+        for cell in row:
+            # First column is the time, not a position
+            if cell.column > 1:
+                cell.fill = position_fills[cell.column - 2]
+            if cell.row == 1:
+                cell.font = header_font
 
 
 ##################################################################################
-# Add color to column
-def color_column(worksheet, index, color):
-    # Create a PatternFill object with the required color
-    if color in COLOR_CODES.keys():
-        color_code = COLOR_CODES[color]
-        fill = PatternFill(start_color=color_code, end_color=color_code, fill_type="solid")
-    else:
-        error(f"Undefined color '{color}'")
+# Get list of fills, one for each position
+def get_position_fills(num_of_positions):
+    fills_by_color = {}
+    position_fills = []
+    for position in range(num_of_positions):
+        color = POSITION_COLORS[position % len(POSITION_COLORS)]
+        if color not in fills_by_color:
+            fills_by_color[color] = get_color_fill(color)
+        position_fills.append(fills_by_color[color])
+    return position_fills
 
-    # Get data from the worksheet
-    data = []
-    for row in worksheet.iter_rows(values_only=True):
-        data.append(list(row))
 
-    for row_num, row in enumerate(data, 1):
-        for col_num, value in enumerate(row, 1):
-            cell = worksheet.cell(row=row_num, column=col_num, value=value)
-            if col_num == index:  # Check if it's the first column
-                cell.fill = fill
+##################################################################################
+# Create a PatternFill object with the required color
+def get_color_fill(color):
+    from openpyxl.styles import PatternFill
+    if color not in COLOR_CODES.keys():
+        error(f"Undefined color '{color}'")
+
+    color_code = COLOR_CODES[color]
+    return PatternFill(start_color=color_code, end_color=color_code, fill_type="solid")
 
 
 ##################################################################################
 # Check fairness
-def check_fairness(users_db, schedule):
+def check_fairness(cfg, users_db):
 
-    # Get served hours
-    user_total_hours = users_db.get_total_hours()
-    #user_night_hours = users_db.get_night_hours()
-
-    user_deep_night_hours = {}
-    user_night_hours = {}
-    for name in users_db.valid_names:
-        user_deep_night_hours[name] = 0
-        user_night_hours[name] = 0
-
-        # Calculate night_hours_served
-    for absolute_hour in range(len(schedule)):
-        for team in schedule[absolute_hour]:
-            for name in team:
-                if absolute_hour % 24 in DEEP_NIGHT_HOURS and name in user_deep_night_hours:
-                    user_deep_night_hours[name] += 1
-                if absolute_hour % 24 in NIGHT_HOURS and name in user_night_hours:
-                    user_night_hours[name] += 1
+    # Get served hours (kept by the users DB while building)
+    user_total_hours, user_night_hours, user_deep_night_hours = users_db.get_served_hours()
 
     # Calculating the most hours served to print it in line
     #name_of_the_most_hours_served = max(user_total_hours, key=lambda k: user_total_hours[k])
@@ -1147,12 +2946,12 @@ def check_fairness(users_db, schedule):
     # Report
     print_header("Check fairness")
     for name in user_total_hours:
-        print(f"Name: {format_str(name)} served: {str(user_total_hours[name]).ljust(4)}\t{('*' * user_total_hours[name]).ljust(max_total_hours+5)}"
+        print(f"Name: {format_str(name, invert=cfg.invert_strings)} served: {str(user_total_hours[name]).ljust(4)}\t{('*' * user_total_hours[name]).ljust(max_total_hours+5)}"
               f" Night: {str(int(user_night_hours[name])).ljust(4)}" + ('*' * int(user_night_hours[name])).ljust(max_night_hours) +
               f" Deep:  {str(int(user_deep_night_hours[name])).ljust(4)}" + ('*' * int(user_deep_night_hours[name])).ljust(max_night_hours)
               )
 
-    # Calculate average, night average
+    # Calculate average, night average (rounded, for the report)
     total_hours_average = round(sum(user_total_hours.values()) / len(user_total_hours))
     night_hours_average = round(sum(user_night_hours.values()) / len(user_night_hours))
     deep_hours_average  = round(sum(user_deep_night_hours.values()) / len(user_deep_night_hours))
@@ -1166,12 +2965,12 @@ def check_fairness(users_db, schedule):
 
     print_delimiter()
 
-    # Adding standard_deviation
-    standard_deviation_value_day = standard_deviation("Total", user_total_hours, total_hours_average, True)
-    standard_deviation_value_night = standard_deviation("Night", user_night_hours, night_hours_average, True)
+    # Adding standard_deviation (of the exact average)
+    standard_deviation_value_day = print_standard_deviation("Total", users_db.total_stats.std())
+    standard_deviation_value_night = print_standard_deviation("Night", users_db.night_stats.std())
     print_delimiter()
 
-    if (GRAPH):
+    if (cfg.graph):
         # Red line - Average, Green dotted lines - Average ± Standard Deviation, Blue dots - People
         make_graph(user_night_hours, user_total_hours, total_hours_average, night_hours_average, standard_deviation_value_day)
 
@@ -1179,25 +2978,21 @@ def check_fairness(users_db, schedule):
 
 
 ##################################################################################
-def standard_deviation(header_str, hours_served, average, do_print):
-    # FIXME: bug in this function, needs debug
-    # Looks like it's called twice, with different types of DB
-
-    # In order to calculate the standard deviation you need to calculate the sum of the
-    # differences between all the people and the average to the power of 2 and then divide
-    # that by the number of people and then square root all of that
-    sum_of_delta_hours = 0
-    number_of_people = len(hours_served)
-
-    for name in hours_served:
-        #print(f"name: {name}")
-        sum_of_delta_hours += math.pow(average - hours_served[name], 2)
-    standard_deviation_value = math.sqrt(sum_of_delta_hours / number_of_people)
+# Standard deviation of hours served (dict [name] --> hours, or list of hours)
+def standard_deviation(header_str, hours_served, do_print):
+    values = hours_served.values() if isinstance(hours_served, dict) else hours_served
+    standard_deviation_value = RunningStats(values).std()
 
     # If you want to print set do_print to True
     if (do_print):
-        print(f"{header_str} standard deviation:" + " " + str(round(standard_deviation_value, 4)).ljust(28) + (
-                    "*" * (round(standard_deviation_value))))
+        print_standard_deviation(header_str, standard_deviation_value)
+    return round(standard_deviation_value, 4)
+
+
+##################################################################################
+def print_standard_deviation(header_str, standard_deviation_value):
+    print(f"{header_str} standard deviation:" + " " + str(round(standard_deviation_value, 4)).ljust(28) + (
+                "*" * (round(standard_deviation_value))))
     return round(standard_deviation_value, 4)
 
 
@@ -1252,28 +3047,36 @@ def make_graph(night_hours_served, hours_served, average, night_hours_average, s
 
 ##################################################################################
 # Verify result
-def verify(valid_names, schedule):
-    # Init last_served
-    last_served = {}
-    for name in valid_names:
-        last_served[name] = -1
+# first_hour: absolute hour of the first hour of the schedule (when verifying a part of it)
+# schedule: ScheduleTensor
+def verify(cfg, valid_names, schedule, first_hour=0):
+    import numpy as np
+    valid_names = set(valid_names)
+    valid_ids = [i for i, name in enumerate(schedule.names) if name in valid_names]
 
-    # Check schedule
-    for hour in range(len(schedule)):
-        line = schedule[hour]
-        # print(f"Verify ({hour}): {line}")
-        for team in line:
-            for name in team:
-                # Ignore people that were removed from the list
-                if name in last_served:
-                    last_served_hour = last_served[name]
-                    if last_served_hour != -1:
-                        diff = hour - last_served_hour - 1
-                        expected_ttr = TTR_NIGHT if last_served_hour in NIGHT_HOURS else TTR_DAY
-                        if diff < expected_ttr and diff > 0:
-                            error(
-                                f"Poor {name} did not get his {expected_ttr} hour rest (served at {last_served_hour}, then at {hour})")
-                    last_served[name] = hour
+    # Served hours of each person, in order: (person, hour) pairs, sorted by person then hour
+    people, hours = np.nonzero(schedule.get_occupancy()[valid_ids])
+    if len(hours) < 2:
+        return
+    hours += first_hour
+
+    # Rest between each served hour and the next one of the same person
+    same_person = people[1:] == people[:-1]
+    last_served_hour = hours[:-1]
+    diff = hours[1:] - last_served_hour - 1
+    # Night TTR by the hour of the day (same as ScheduleValidator)
+    expected_ttr = np.where(np.isin(last_served_hour % HOURS_IN_DAY, list(cfg.night_hours)), cfg.ttr_night, cfg.ttr_day)
+    violations = np.flatnonzero(same_person & (diff < expected_ttr) & (diff > 0))
+
+    # Report the first violation in the order of the schedule (hour, then position and slot)
+    if len(violations):
+        def get_order(k):
+            person_id = valid_ids[people[k + 1]]
+            return hours[k + 1], np.argwhere(schedule.slots[hours[k + 1] - first_hour] == person_id)[0].tolist()
+        violations = violations[hours[violations + 1] == hours[violations + 1].min()]
+        first = min(violations, key=get_order)
+        name = schedule.names[valid_ids[people[first]]]
+        error(f"Poor {name} did not get his {expected_ttr[first]} hour rest (served at {hours[first]}, then at {hours[first + 1]})")
 
 
 ##################################################################################
@@ -1297,7 +3100,7 @@ def print_personal_info(schedule, date):
 
     # Note: skipping the previous schedule
     for hour in range(len(schedule)):
-        for position in range(NUM_OF_POSITIONS):
+        for position in range(len(schedule[hour])):
             team = schedule[hour][position]
             # Skip empty teams
             if not team:
@@ -1317,31 +3120,26 @@ def print_personal_info(schedule, date):
 
 ##################################################################################
 # Print information that can be useful for debug
-def print_debug_info():
-    print_delimiter_and_str(f"Current seed: {SEED}")
+def print_debug_info(cfg):
+    print_delimiter_and_str(f"Current seed: {cfg.seed}")
 
 
 ##################################################################################
 # Check reappearance of teams
-def check_teams(schedule):
-    teams_db = {}
-    for hour in range(len(schedule)):
-        for position in range(NUM_OF_POSITIONS):
-            team = schedule[hour][position]
-            # Skip empty teams
-            if not team:
-                continue
-
-            # Skip single person teams - may also be interesting later
-            if len(team) == 1:
-                continue
+def check_teams(cfg, schedule):
+    import numpy as np
+    # schedule: ScheduleTensor
+    # Teams of 2 people and more (single person teams may also be interesting later)
+    slots = schedule.slots.reshape(-1, schedule.slots.shape[2])
+    slots = slots[(slots >= 0).sum(axis=1) > 1]
 
-            # Team is a list - sort and turn into string
-            sorted_team_str = format_str(",".join(sorted(team)), 0)
-            if sorted_team_str in teams_db.keys():
-                teams_db[sorted_team_str] += 1
-            else:
-                teams_db[sorted_team_str] = 1
+    # Count each team (members in id order), in the order of first occurrence
+    teams, first_index, counts = np.unique(np.sort(slots, axis=1), axis=0, return_index=True, return_counts=True)
+    teams_db = {}
+    for k in np.argsort(first_index, kind="stable"):
+        # Team is a list - sort and turn into string
+        team = sorted(schedule.names[i] for i in teams[k] if i >= 0)
+        teams_db[format_str(",".join(team), 0, cfg.invert_strings)] = int(counts[k])
 
     # Sort by number of occurance
     sorted_teams_db = dict(sorted(teams_db.items(), key=lambda item: item[1]))
@@ -1353,120 +3151,96 @@ def check_teams(schedule):
 # time_spent_at_position:
 #   {person_name} --> [list of hours spent in each position]
 #   Used to see accumulated time at each position, for each person
-# per_person_prev_position:
-#   {person_name} --> [previous position name, previous absolute hour]
+# repeated:
+#   Each assignment compared with the previous assignment of the same person
 #   Used to detect assignment to the same position
-def check_positions(schedule, position_names):
-    # Build DB, for each name, list of positions
-    # Each member will reflect hours spent in this position
-    time_spent_at_position = {}
-    per_person_prev_position = {}
-    position_idx = 0
-    hour_idx = 1
+def check_positions(cfg, schedule, position_names):
+    import numpy as np
+    # schedule: ScheduleTensor
+    num_of_positions = len(position_names)
+    hours, positions, people = schedule.get_assignments()
+    keep = positions < num_of_positions
+    hours, positions, people = hours[keep], positions[keep], people[keep]
+
+    # Hours spent in each position, for each name (that served, in order of first appearance)
+    time_spent = np.zeros((len(schedule.names), num_of_positions), dtype=np.int64)
+    np.add.at(time_spent, (people, positions), 1)
+    served, first_index = np.unique(people, return_index=True)
+    served = served[np.argsort(first_index, kind="stable")]
+    time_spent = time_spent[served]
+    time_spent_at_position = dict(zip([schedule.names[i] for i in served], time_spent.tolist()))
+
+    # Detect assignment to the same position: compare each assignment with the previous one of the same person
+    order = np.lexsort((hours, people))
+    prev_people, prev_hours, prev_positions = people[order][:-1], hours[order][:-1], positions[order][:-1]
+    curr_people, curr_hours, curr_positions = people[order][1:], hours[order][1:], positions[order][1:]
+    repeated = ((curr_people == prev_people) & (curr_positions == prev_positions) &
+                (curr_hours - prev_hours > 2) & (curr_hours > 24))
     warn_cnt = 0
-
-    # Collect data from schedule
-    for hour in range(len(schedule)):
-        for position in range(NUM_OF_POSITIONS):
-            team = schedule[hour][position]
-            # Skip empty teams
-            if not team:
-                continue
-
-            # Update DB
-            for name in team:
-                # Init new entry with list of zeros
-                if name not in time_spent_at_position:
-                    time_spent_at_position[name] = []
-                    for p in range(NUM_OF_POSITIONS):
-                        time_spent_at_position[name].append(0)
-                # Update
-                time_spent_at_position[name][position] += 1
-
-                # Init entries with -1 (as 0 is real position):
-                if name not in per_person_prev_position:
-                    per_person_prev_position[name] = []
-                    for p in range(NUM_OF_POSITIONS):
-                        per_person_prev_position[name].append(-1)
-
-                # Sample DB:
-                samp_position = per_person_prev_position[name][position_idx]
-                samp_hour = per_person_prev_position[name][hour_idx]
-                hour_diff = hour - samp_hour
-
-                # Compare, and avoid fail if belongs to same entry:
-                if samp_position == position and hour_diff > 2 and hour > 24:
-                    warning(
-                        f"name: {name} ,hour: {hour}:00, got again the same position: {position_names[position]}. Last hour: {samp_hour}")
-                    warn_cnt += 1
-
-                # Update DB:
-                per_person_prev_position[name][position_idx] = position
-                per_person_prev_position[name][hour_idx] = hour
+    # Report in the order of the schedule
+    for k in sorted(np.flatnonzero(repeated), key=lambda k: order[k + 1]):
+        warning(
+            f"name: {schedule.names[curr_people[k]]} ,hour: {curr_hours[k]}:00, got again the same position: {position_names[curr_positions[k]]}. Last hour: {prev_hours[k]}")
+        warn_cnt += 1
 
     if warn_cnt > 5:
         warning(f"Got too many repetitions {warn_cnt}")
 
     # Print header (with position names)
     header_str = "Positions summary".ljust(COLUMN_WIDTH + 18)
-    for p in range(NUM_OF_POSITIONS):
-        header_str += format_str(str(position_names[p]), 15)
+    for p in range(num_of_positions):
+        header_str += format_str(str(position_names[p]), 15, cfg.invert_strings)
         #header_str += str(position_names[p]).ljust(15)
     print_header(header_str)
 
     # Print summary per person
     for name in time_spent_at_position:
         positions_str = ""
-        for p in range(NUM_OF_POSITIONS):
+        for p in range(num_of_positions):
             positions_str += str(time_spent_at_position[name][p]).ljust(15)
-        print(f"Name: {format_str(name)} positions: {positions_str}")
+        print(f"Name: {format_str(name, invert=cfg.invert_strings)} positions: {positions_str}")
 
     # Print averages
     average_str = ""
-    position_average_list = get_position_average_list(time_spent_at_position)
-    for p in range(NUM_OF_POSITIONS):
+    position_average_list = (time_spent.sum(axis=0) // max(len(served), 1)).tolist()
+    for p in range(num_of_positions):
         average_str += str(position_average_list[p]).ljust(15)
     print_delimiter_and_str("Average:".ljust(COLUMN_WIDTH + 18) + average_str)
 
     # Print standard deviation
-    hours_in_position = []
     standard_deviation_value_str = ""
-    # Getting hours_in_position
-    for position in range(NUM_OF_POSITIONS):
-        for name in time_spent_at_position:
-             hours_in_position.append(time_spent_at_position[name][position])
-
-        for k in range(len(position_average_list)):
-             standard_deviation_value = standard_deviation("", hours_in_position, position_average_list[k], False)
+    for position in range(num_of_positions):
+        standard_deviation_value = standard_deviation("", time_spent[:, position], False)
         standard_deviation_value_str += str(standard_deviation_value).ljust(15)
 
-        hours_in_position = []
-
     print_delimiter_and_str("Standard Deviation:".ljust(COLUMN_WIDTH + 18) + standard_deviation_value_str)
 
 
 ##################################################################################
-# Calculate average per position
-def get_position_average_list(db):
-    # Init list of totals, used to calculate expected average
-    position_total_hours = []
-    for position in range(NUM_OF_POSITIONS):
-        position_total_hours.append(0)
-
-    # Get total hours for each position
-    for name in db.keys():
-        for position in range(NUM_OF_POSITIONS):
-            position_total_hours[position] += db[name][position]
-
-    # Get number of people
-    num_of_people = len(db.keys())
-
-    # Calculate average per position
-    position_average_list = []
-    for position in range(NUM_OF_POSITIONS):
-        position_average_list.append(int(position_total_hours[position] / num_of_people))
+# Print startup time breakdown: loading this script, then each heavy module
+# Warn if loading the script is above the budget, or if it already imported a heavy module
+def print_import_time():
+    print_header("Import time")
+    module_load_ms = MODULE_LOAD_TIME * 1000
+    print(f"{'scheduler'.ljust(COLUMN_WIDTH)} {module_load_ms:8.1f} ms (budget {STARTUP_BUDGET_MS} ms)")
+
+    preloaded = [module for module in HEAVY_MODULES if module in sys.modules]
+    for module in HEAVY_MODULES:
+        if module in preloaded:
+            continue
+        start = time.perf_counter()
+        try:
+            __import__(module)
+        except ImportError:
+            print(f"{module.ljust(COLUMN_WIDTH)} {'-':>8} (not installed)")
+            continue
+        print(f"{module.ljust(COLUMN_WIDTH)} {(time.perf_counter() - start) * 1000:8.1f} ms")
+    print_delimiter()
 
-    return position_average_list
+    if module_load_ms > STARTUP_BUDGET_MS:
+        warning(f"Startup took {module_load_ms:.1f} ms, above the budget of {STARTUP_BUDGET_MS} ms")
+    if preloaded:
+        warning(f"Heavy modules imported at startup: {preloaded}")
 
 
 ##################################################################################
@@ -1484,9 +3258,9 @@ def check_prev_name(prev_name):
 
 ##################################################################################
 # Extract list of valid names from XLS
-def extract_valid_names():
+def extract_valid_names(workbook):
     # Get list of names from XLS
-    all_cells = extract_column_from_sheet("List of people", "People")
+    all_cells = extract_column_from_sheet(workbook, "List of people", "People")
 
     # Add to list only non-empty values
     valid_names = []
@@ -1498,62 +3272,432 @@ def extract_valid_names():
 
 ##################################################################################
 # Extract all necessary information from input file
-def parse_input_file(prev_date_str):
+# When resumed from a checkpoint, the previous schedule and the users DB counters are
+# taken from the checkpoint, and the previous schedule sheet is not needed
+def parse_input_file(cfg, prev_date_str, checkpoint=None):
+    # Read the file once, only the sheets we need
+    sheet_names = ["List of people"]
+    sheet_names += [get_position_sheet_name(position) for position in range(cfg.num_of_positions)]
+    if checkpoint is None:
+        sheet_names.append(prev_date_str)
+    workbook = WorkbookSnapshot(cfg.input_file_name, sheet_names)
+
     # Create an instance of the Cfg class
     positions_db = PositionsDB()
-    users_db = UsersDB(extract_valid_names())
+    users_db = UsersDB(extract_valid_names(workbook), cfg)
 
     # Get personal time off/on
-    users_db.set_time_off(extract_personal_constraints(prev_date_str, "Time off"))
-    users_db.set_time_on(extract_personal_constraints(prev_date_str, "Time on"))
+    users_db.set_time_off(extract_personal_constraints(workbook, prev_date_str, "Time off"))
+    users_db.set_time_on(extract_personal_constraints(workbook, prev_date_str, "Time on"))
 
     # Get positions configurations
-    positions_db.position = get_positions_cfg()
+    positions_db.position = get_positions_cfg(workbook, cfg.num_of_positions)
 
     # Get previous schedule
-    prev_schedule = get_prev_schedule(prev_date_str, positions_db.position_names())
+    if checkpoint is None:
+        prev_schedule = get_prev_schedule(workbook, prev_date_str, positions_db.position_names())
+        return WorkbookState(users_db, prev_schedule, positions_db, prev_date_str)
 
-    return users_db, prev_schedule, positions_db
+    # Or, continue from the checkpoint
+    if any(len(line) != cfg.num_of_positions for line in checkpoint.schedule):
+        error(f"Checkpoint of {checkpoint.date_str} has {len(checkpoint.schedule[0])} positions, expected {cfg.num_of_positions}")
+    users_db.set_state(checkpoint.users)
+    users_db.teams_db.set_state(checkpoint.teams)
+    workbook_state = WorkbookState(users_db, checkpoint.schedule, positions_db, prev_date_str)
+    workbook_state.replay_prev = 0
+    workbook_state.rng_state = checkpoint.rng_state
+    return workbook_state
 
 
 ##################################################################################
-# Main
+# Start from the hours served before the previous schedule, as kept by the fairness ledger
+# Note: the previous schedule itself is replayed, same as without the ledger
+def load_ledger(cfg, workbook_state):
+    # No ledger yet (it is created by the first run with --write), nothing to start from
+    if not os.path.exists(cfg.ledger_file_name):
+        return
+    ledger = FairnessLedger(cfg.ledger_file_name)
+    try:
+        workbook_state.users_db.add_history(ledger.get_hours(workbook_state.prev_date_str))
+        workbook_state.users_db.teams_db.set_state(ledger.get_teams(workbook_state.prev_date_str))
+    finally:
+        ledger.close()
+
+
 ##################################################################################
-def main():
+# Extract the existing schedules after prev_date_str, up to last_date_str (--analyze)
+# All the sheets are read in a single pass over the file (see WorkbookSnapshot)
+# Return the workbook state, and list of (date, single day schedule)
+def parse_history(cfg, prev_date_str, last_date_str):
+    dates = [get_next_date(prev_date_str)]
+    while dates[-1] < last_date_str:
+        dates.append(get_next_date(dates[-1]))
+
+    # Read the file once, only the sheets we need
+    sheet_names = ["List of people"]
+    sheet_names += [get_position_sheet_name(position) for position in range(cfg.num_of_positions)]
+    sheet_names += [prev_date_str] + dates
+    workbook = WorkbookSnapshot(cfg.input_file_name, sheet_names)
 
-    # Parse script arguments
-    prev_date_str = parse_command_line_arguments()
+    positions_db = PositionsDB()
+    positions_db.position = get_positions_cfg(workbook, cfg.num_of_positions)
+    users_db = UsersDB(extract_valid_names(workbook), cfg)
+    position_names = positions_db.position_names()
+    prev_schedule = get_prev_schedule(workbook, prev_date_str, position_names)
+    days = [(date_str, get_prev_schedule(workbook, date_str, position_names)) for date_str in dates]
 
-    # Extract all necessary information from input file
-    users_db, prev_schedule, positions_db = parse_input_file(prev_date_str)
+    return WorkbookState(users_db, prev_schedule, positions_db, prev_date_str), days
 
-    # Init total new schedule
-    total_new_schedule = prev_schedule.copy()
 
-    # Build schedule for N days
-    for day in range(DAYS_TO_PLAN):
-        # Build next day schedule
-        curr_date_str = get_next_date(prev_date_str)
-        new_schedule = build_single_day_schedule(curr_date_str, prev_schedule, users_db, positions_db, day)
+##################################################################################
+# Post-processing of a finished schedule (--optimize)
+# Simulated annealing over moves on the planned days:
+#  - replace: a person's shift (consecutive hours in a position) is given to another person
+#  - swap:    two people exchange their shifts
+# Moves must keep the rules of the build: the TTR after each shift (as checked by verify()),
+# time off/on, and no night shifts in two nights in a row
+# Moves update the served hours of the users DB, so the fairness (as check_fairness():
+# standard deviations of total and night hours) is read from its running statistics in O(1),
+# and the rules are checked against sorted lists of served hours per person in O(log n)
+# The score also counts the shifts at the same position as the previous shift of the person
+# (see OPTIMIZE_REPEAT_WEIGHT), updated around the moved shift only
+# Note: the rest of the users DB (TTR, previous positions, teams) is not updated by the moves,
+# Scheduler.replay_result() rebuilds it from the final days
+##################################################################################
+class FairnessOptimizer:
+    def __init__(self, cfg, result, rng):
+        self.cfg = cfg
+        self.result = result
+        self.rng = rng
+        self.users_db = users_db = result.users_db
+        # Array [hour][position][slot] of person ids (same ids as the users DB)
+        self.schedule = result.total_schedule
+        self.slots = self.schedule.slots
+        # Hours of the previous schedule cannot be changed
+        self.first_hour = result.prev_schedule.num_of_hours()
+
+        # Sorted list of served hours, position of each served hour, and number of
+        # night hours served per night, of each user
+        self.num_of_users = num_of_users = len(users_db.names)
+        self.served = [[] for _ in range(num_of_users)]
+        self.positions = [{} for _ in range(num_of_users)]
+        self.nights = [{} for _ in range(num_of_users)]
+        hours, positions, people = self.schedule.get_assignments()
+        for hour, position, user_id in zip(hours.tolist(), positions.tolist(), people.tolist()):
+            if user_id < num_of_users:
+                self.add_hour(user_id, hour, position)
+        self.repeats = sum(self.count_repeats(user_id, 0, self.schedule.num_of_hours()) for user_id in range(num_of_users))
+
+    def is_night_hour(self, hour):
+        return self.cfg.is_night(hour % HOURS_IN_DAY)
+
+    def add_hour(self, user_id, hour, position):
+        bisect.insort(self.served[user_id], hour)
+        self.positions[user_id][hour] = position
+        if self.is_night_hour(hour):
+            night = get_night_index(hour)
+            self.nights[user_id][night] = self.nights[user_id].get(night, 0) + 1
+
+    def remove_hour(self, user_id, hour):
+        del self.served[user_id][bisect.bisect_left(self.served[user_id], hour)]
+        del self.positions[user_id][hour]
+        if self.is_night_hour(hour):
+            night = get_night_index(hour)
+            self.nights[user_id][night] -= 1
+            if not self.nights[user_id][night]:
+                del self.nights[user_id][night]
+
+    # Fairness score: standard deviation of total hours + of night hours, and the repeats
+    def get_score(self):
+        return self.users_db.total_stats.std() + self.users_db.night_stats.std() + OPTIMIZE_REPEAT_WEIGHT * self.repeats
+
+    # Number of shifts of the user at the same position as the previous shift,
+    # out of the shifts around the hours [first, last] (the served hour before, and the one after)
+    def count_repeats(self, user_id, first, last):
+        served = self.served[user_id]
+        positions = self.positions[user_id]
+        begin = max(bisect.bisect_left(served, first) - 1, 0)
+        end = min(bisect.bisect_right(served, last) + 1, len(served))
+        return sum(1 for prev_hour, hour in zip(served[begin:end - 1], served[begin + 1:end])
+                   if hour - prev_hour > 1 and positions[prev_hour] == positions[hour])
+
+    # Check TTR between two served hours (as verify())
+    def is_rest_ok(self, prev_hour, next_hour):
+        expected_ttr = self.cfg.ttr_night if self.is_night_hour(prev_hour) else self.cfg.ttr_day
+        return next_hour - prev_hour - 1 >= expected_ttr
+
+    # Get a random shift: (position, first hour, last hour, user id), or None
+    def get_random_shift(self):
+        hour = self.rng.randrange(self.first_hour, self.schedule.num_of_hours())
+        position = self.rng.randrange(self.slots.shape[1])
+        team = [user_id for user_id in self.slots[hour, position].tolist() if 0 <= user_id < self.num_of_users]
+        if not team:
+            return None
+        return self.get_shift(position, hour, self.rng.choice(team))
+
+    # Get a random shift of the user, or None
+    def get_random_shift_of(self, user_id):
+        import numpy as np
+        served = self.served[user_id]
+        index = bisect.bisect_left(served, self.first_hour)
+        if index == len(served):
+            return None
+        hour = served[self.rng.randrange(index, len(served))]
+        position = int(np.flatnonzero((self.slots[hour] == user_id).any(axis=1))[0])
+        return self.get_shift(position, hour, user_id)
+
+    # Get the whole shift of the user, that includes hour at position
+    # Shifts that started in the previous schedule are not split (None)
+    def get_shift(self, position, hour, user_id):
+        first = hour
+        while first > 0 and user_id in self.slots[first - 1, position]:
+            first -= 1
+        if first < self.first_hour:
+            return None
+        last = hour
+        while last + 1 < self.schedule.num_of_hours() and user_id in self.slots[last + 1, position]:
+            last += 1
+        return position, first, last, user_id
+
+    # Check if the user can take the shift [first, last]
+    def can_take(self, user_id, first, last):
+        served = self.served[user_id]
+        index = bisect.bisect_left(served, first)
+        # Not serving at the same time
+        if index < len(served) and served[index] <= last:
+            return False
+        # TTR before and after the shift
+        if index > 0 and not self.is_rest_ok(served[index - 1], first):
+            return False
+        if index < len(served) and not self.is_rest_ok(last, served[index]):
+            return False
+        # Time off/on
+        if not self.users_db.availability[first - self.first_hour:last - self.first_hour + 1, user_id].all():
+            return False
+        # No nights in a row
+        nights = {get_night_index(hour) for hour in range(first, last + 1) if self.is_night_hour(hour)}
+        for night in nights:
+            if self.nights[user_id].get(night - 1) or self.nights[user_id].get(night + 1):
+                return False
+        return True
+
+    # Check if the user can give away the shift [first, last]: TTR between the hours around it
+    def can_give(self, user_id, first, last):
+        served = self.served[user_id]
+        before = bisect.bisect_left(served, first)
+        after = bisect.bisect_right(served, last)
+        if before == 0 or after == len(served):
+            return True
+        return self.is_rest_ok(served[before - 1], served[after])
+
+    # Move the shift [first, last] at position from one user to another
+    def move_shift(self, position, first, last, from_id, to_id):
+        team = self.slots[first:last + 1, position]
+        team[team == from_id] = to_id
+        self.repeats -= self.count_repeats(from_id, first, last) + self.count_repeats(to_id, first, last)
+        night_hours = 0
+        deep_night_hours = 0
+        for hour in range(first, last + 1):
+            self.remove_hour(from_id, hour)
+            self.add_hour(to_id, hour, position)
+            night_hours += self.is_night_hour(hour)
+            deep_night_hours += hour % HOURS_IN_DAY in DEEP_NIGHT_HOURS
+        num_of_hours = last - first + 1
+        self.repeats += self.count_repeats(from_id, first, last) + self.count_repeats(to_id, first, last)
+
+        self.users_db.add_hours(from_id, -num_of_hours, -night_hours, -deep_night_hours)
+        self.users_db.add_hours(to_id, num_of_hours, night_hours, deep_night_hours)
+
+    # Try to replace the person of a random shift, return list of moves done
+    def try_replace(self):
+        shift = self.get_random_shift()
+        if not shift:
+            return []
+        position, first, last, from_id = shift
+        to_id = self.rng.randrange(len(self.users_db.names))
+        if to_id == from_id or not self.can_give(from_id, first, last) or not self.can_take(to_id, first, last):
+            return []
+        self.move_shift(position, first, last, from_id, to_id)
+        return [(position, first, last, from_id, to_id)]
+
+    # Try to swap the people of two random shifts, return list of moves done
+    def try_swap(self):
+        moves = self.try_replace()
+        if not moves:
+            return []
+        # The new person gives one of their shifts back
+        _, _, _, to_id, from_id = moves[0]
+        shift = self.get_random_shift_of(from_id)
+        if shift and shift[:3] != moves[0][:3] and self.can_give(from_id, shift[1], shift[2]) and self.can_take(to_id, shift[1], shift[2]):
+            position, first, last, _ = shift
+            self.move_shift(position, first, last, from_id, to_id)
+            return moves + [(position, first, last, from_id, to_id)]
+        self.undo(moves)
+        return []
+
+    def undo(self, moves):
+        for position, first, last, from_id, to_id in reversed(moves):
+            self.move_shift(position, first, last, to_id, from_id)
+
+    # Run until the number of moves or the time budget is reached
+    # Returns the fairness score before and after
+    def run(self):
+        start = time.perf_counter()
+        iterations = self.cfg.optimize_iterations
+        score = start_score = best_score = self.get_score()
+        moves_done = []
+        best_moves = 0
+
+        for iteration in range(iterations):
+            if time.perf_counter() - start > self.cfg.optimize_time:
+                break
+            if self.rng.random() < OPTIMIZE_SWAP_RATIO:
+                moves = self.try_swap()
+            else:
+                moves = self.try_replace()
+            if not moves:
+                continue
+
+            # Accept better, or worse with a probability that goes down with the temperature
+            new_score = self.get_score()
+            temperature = OPTIMIZE_START_TEMPERATURE * (1 - iteration / iterations)
+            delta = new_score - score
+            if delta <= 0 or (temperature > 0 and self.rng.random() < math.exp(-delta / temperature)):
+                score = new_score
+                moves_done += moves
+                if score < best_score - 1e-9:
+                    best_score = score
+                    best_moves = len(moves_done)
+            else:
+                self.undo(moves)
 
-        # Append new_schedule to total
-        total_new_schedule = total_new_schedule + new_schedule
+        # Go back to the best schedule seen
+        self.undo(moves_done[best_moves:])
+        self.result.set_total_schedule(self.schedule)
 
-        # Update prev
-        prev_date_str = curr_date_str
-        prev_schedule = new_schedule
+        return start_score, best_score
 
-    # Run checks
-    verify(users_db.valid_names, total_new_schedule)
-    if (PRINT_STATISTICS):
-        check_teams(total_new_schedule)
-        check_positions(total_new_schedule, positions_db.position_names())
-        users_db.teams_db.print()
 
-    # Added for future use
-    total_score = check_fairness(users_db, total_new_schedule)
+##################################################################################
+# Best of N tries (--tries)
+# The input file is parsed once, then the whole schedule is built for each seed
+# (in parallel, --jobs), and the seed of the fairest schedule is returned
+##################################################################################
+
+# Configuration and parsed input file, used by try_seed() in each worker process
+TRY_INPUT = None
+
+def init_try_worker(cfg, workbook_state):
+    global TRY_INPUT; TRY_INPUT = (cfg, workbook_state)
 
 
 ##################################################################################
+# Build the schedule with the given seed
+# Return fairness score, or None if the build failed
+def try_seed(seed):
+    cfg, workbook_state = TRY_INPUT
+
+    # Failed tries are expected, hide their errors and warnings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            result = Scheduler(cfg).plan(workbook_state, seed=seed)
+            verify(cfg, result.users_db.valid_names, result.total_schedule)
+        except SystemExit:
+            return None
+
+    return result.fairness_score()
+
+
+##################################################################################
+# Find the seed that gives the fairest schedule
+def find_fairest_seed(cfg, workbook_state):
+    first_seed = cfg.seed if cfg.seed else 1
+    seeds = list(range(first_seed, first_seed + cfg.tries))
+    jobs = min(cfg.jobs or os.cpu_count() or 1, cfg.tries)
+
+    if jobs == 1:
+        init_try_worker(cfg, workbook_state)
+        scores = [try_seed(seed) for seed in seeds]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_try_worker,
+                                 initargs=(cfg, workbook_state)) as executor:
+            scores = list(executor.map(try_seed, seeds))
+
+    # Choose the lowest score, failed tries are ignored
+    results = [(score, seed) for seed, score in zip(seeds, scores) if score is not None]
+    if not results:
+        error(f"All {cfg.tries} tries failed (seeds {seeds[0]}..{seeds[-1]})")
+    best_score, best_seed = min(results)
+
+    print_header(f"Best of {cfg.tries} tries ({len(results)} valid, {jobs} jobs): "
+                 f"seed {best_seed}, fairness score {best_score}")
+    return best_seed
+
+
+##################################################################################
+# Main
+##################################################################################
+def main():
+
+    # Parse script arguments
+    cfg, prev_date_str = parse_command_line_arguments()
+    profiler = Profiler(cfg.profile, cfg.profile_top)
+    profiler.start()
+    # Import NumPy as a stage of its own (the functions that use it import it),
+    # instead of as part of the first stage that uses it
+    with profiler.stage("import"):
+        __import__("numpy")
+
+    # Only check the existing schedules
+    if cfg.analyze_last_date:
+        with profiler.stage("parse"):
+            workbook_state, days = parse_history(cfg, prev_date_str, cfg.analyze_last_date)
+        print_header(f"Analysis of {len(days)} days: {days[0][0]} to {cfg.analyze_last_date}")
+        analyzer = ScheduleAnalyzer(cfg)
+        analyzer.profiler = profiler
+        stream_days(analyzer.generate(workbook_state, days), get_sinks(cfg, analyzer, workbook_state))
+        profiler.stop(get_profile_file_name(cfg))
+        return
+
+    # Continue from a checkpoint: plan the days after its last day
+    checkpoint = None
+    if cfg.resume_file_name:
+        checkpoint = PlannerCheckpoint.load(cfg.resume_file_name)
+        if prev_date_str and prev_date_str != checkpoint.date_str:
+            warning(f"Resuming after {checkpoint.date_str} (from {cfg.resume_file_name}), ignoring --prev {prev_date_str}")
+        prev_date_str = checkpoint.date_str
+
+    # Extract all necessary information from input file
+    with profiler.stage("parse"):
+        workbook_state = parse_input_file(cfg, prev_date_str, checkpoint)
+        # Served hours of earlier days (a checkpoint already includes them)
+        if cfg.ledger_file_name and checkpoint is None:
+            load_ledger(cfg, workbook_state)
+    position_names = workbook_state.positions_db.position_names()
+    print_schedule(cfg, workbook_state.prev_schedule, prev_date_str, position_names)
+
+    # Build many times, continue with the seed of the fairest schedule
+    if cfg.tries > 1:
+        with profiler.stage("tries"):
+            cfg.seed = find_fairest_seed(cfg, workbook_state)
+
+    # Build schedule for N days, stream each day to the sinks when ready (print, write, checks)
+    # Post-processing needs all the days, so they are streamed after it
+    scheduler = Scheduler(cfg)
+    scheduler.profiler = profiler
+    if cfg.optimize_iterations:
+        result = scheduler.plan(workbook_state)
+        planned_days = ((date_str, schedule.to_schedule()) for date_str, schedule in result.days)
+    else:
+        planned_days = scheduler.generate(workbook_state)
+
+    stream_days(planned_days, get_sinks(cfg, scheduler, workbook_state))
+    profiler.stop(get_profile_file_name(cfg))
+
+
+##################################################################################
+MODULE_LOAD_TIME = time.perf_counter() - MODULE_LOAD_START
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,512 @@
+import contextlib
+import io
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+import scheduler
+
+
+##################################################################################
+# Helpers
+##################################################################################
+
+# Synthetic workbook (see benchmark.py), previous schedule sheet is benchmark.PREV_DATE
+@pytest.fixture
+def workbook(tmp_path):
+    file_name = str(tmp_path / "synthetic.xlsx")
+    benchmark.generate_workbook(file_name, people=34, positions=2, team_size=2, pattern="2h", density=0, days=7, seed=1)
+    return file_name
+
+
+# Run quietly, the scheduler prints as it goes
+def quiet(function, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def plan(file_name, days, **cfg_args):
+    cfg = scheduler.SchedulerCfg(input_file_name=file_name, num_of_positions=2, **cfg_args)
+    workbook_state = quiet(scheduler.parse_input_file, cfg, benchmark.PREV_DATE)
+    planner = scheduler.Scheduler(cfg)
+    result = quiet(planner.plan, workbook_state, days=days)
+    return planner, result
+
+
+##################################################################################
+# Rest rules: verify() and ScheduleValidator
+##################################################################################
+
+# Schedule of one position over the hours [0, num_of_hours), name --> served hours
+def get_schedule(num_of_hours, served):
+    schedule = [[[]] for _ in range(num_of_hours)]
+    for name, hours in served.items():
+        for hour in hours:
+            schedule[hour][0].append(name)
+    return scheduler.ScheduleTensor.from_schedule(schedule)
+
+
+def get_validator_violations(cfg, schedule):
+    users_db = scheduler.UsersDB(schedule.names, cfg)
+    validator = scheduler.ScheduleValidator(cfg, users_db)
+    for hour in range(schedule.num_of_hours()):
+        for name in schedule.get_team(hour, 0):
+            validator.check(name, hour)
+    return validator.violations
+
+
+@pytest.mark.parametrize("day", [0, 1, 2])
+def test_verify_takes_night_ttr_after_a_night_hour_of_any_day(day):
+    cfg = scheduler.SchedulerCfg(num_of_positions=1)
+    first = day * scheduler.HOURS_IN_DAY
+
+    # 02:00 is a night hour: 6 hours of rest is enough after a day hour (4), not after a night hour (9)
+    schedule = get_schedule(first + 24, {"A": [first + 2, first + 9], "B": [first + 12, first + 19]})
+    with pytest.raises(SystemExit):
+        quiet(scheduler.verify, cfg, ["A", "B"], schedule)
+    assert get_validator_violations(cfg, schedule) == [f"At day {day + 1}, 9:00, A got 6 hours of rest, instead of 9"]
+
+    # Enough rest after both
+    schedule = get_schedule(first + 24, {"A": [first + 2, first + 12], "B": [first + 12, first + 17]})
+    quiet(scheduler.verify, cfg, ["A", "B"], schedule)
+    assert get_validator_violations(cfg, schedule) == []
+
+
+def test_verify_reports_the_first_violation_in_schedule_order():
+    cfg = scheduler.SchedulerCfg(num_of_positions=1)
+    schedule = get_schedule(48, {"A": [30, 33], "B": [10, 12], "C": [40, 41]})
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), pytest.raises(SystemExit):
+        scheduler.verify(cfg, ["A", "B", "C"], schedule)
+    assert output.getvalue() == "Error: Poor B did not get his 4 hour rest (served at 10, then at 12)\n"
+
+    # Consecutive hours are the same shift, people that are not on the list are ignored
+    quiet(scheduler.verify, cfg, ["A", "C"], get_schedule(48, {"A": [10, 11, 12], "B": [10, 12], "C": [40, 41]}))
+
+
+##################################################################################
+# Deficit selection policy
+##################################################################################
+
+def test_deficit_sampler_total_matches_weights_after_long_run():
+    rng = random.Random(1)
+    scores = [rng.uniform(0, 10) for _ in range(50)]
+    sampler = scheduler.DeficitSampler(scores)
+
+    # Scores only grow, as people serve
+    for _ in range(5000):
+        user_id = rng.randrange(len(scores))
+        scores[user_id] += rng.choice([2, 3, 4.5])
+        sampler.update(user_id, scores[user_id])
+
+    exact_total = sum(sampler.get_weight(score) for score in scores)
+    assert sampler.tree.total() == pytest.approx(exact_total, rel=1e-9, abs=0)
+    assert sampler.tree.total() == pytest.approx(sum(sampler.tree.weights), rel=1e-9, abs=0)
+
+
+def test_deficit_sampler_falls_back_to_the_candidates_weights():
+    import numpy as np
+    # Users 0-3 hold almost all the weight, and are not candidates
+    scores = [0.0] * 4 + [40.0, 42.0, 44.0, 46.0]
+    sampler = scheduler.DeficitSampler(scores)
+    mask = np.array([False] * 4 + [True] * 4)
+    candidates = scheduler.CandidatesView(None, mask)
+
+    rng = random.Random(1)
+    counts = np.zeros(len(scores))
+    for _ in range(4000):
+        counts[sampler.sample(candidates, rng)] += 1
+    assert counts[:4].sum() == 0
+    # Weights of the candidates: 1, 1/2, 1/4, 1/8 of the first
+    expected = np.array([8, 4, 2, 1]) / 15
+    assert counts[4:] / counts.sum() == pytest.approx(expected, abs=0.03)
+
+    sampler.update(4, 50.0)
+    assert sampler.weights.tolist() == sampler.tree.weights
+
+
+def test_deficit_policy_is_fairer_than_ttr_tier(workbook):
+    deviations = {}
+    for policy in ["deficit", "ttr_tier"]:
+        planner, _ = plan(workbook, 60, seed=1, policy=policy)
+        deviations[policy] = float(planner.users_db.total_hours.std())
+
+        if policy == "deficit":
+            sampler = planner.users_db.sampler
+            assert sampler.tree.total() == pytest.approx(sum(sampler.tree.weights), rel=1e-9, abs=0)
+
+    assert deviations["deficit"] <= deviations["ttr_tier"]
+
+
+##################################################################################
+# Assignment engine (--engine assignment)
+##################################################################################
+
+@pytest.mark.parametrize("num_of_rows, num_of_columns", [(1, 1), (3, 3), (4, 4), (2, 5), (4, 6)])
+def test_solve_assignment_is_optimal(num_of_rows, num_of_columns):
+    import itertools
+    import numpy as np
+    rng = np.random.default_rng(num_of_rows * 10 + num_of_columns)
+    for _ in range(20):
+        # Few distinct costs, so there are ties
+        cost = rng.integers(0, 5, size=(num_of_rows, num_of_columns)).astype(float)
+        chosen = scheduler.solve_assignment(cost)
+        assert len(set(chosen.tolist())) == num_of_rows
+        best = min(sum(cost[row, column] for row, column in enumerate(columns))
+                   for columns in itertools.permutations(range(num_of_columns), num_of_rows))
+        assert cost[np.arange(num_of_rows), chosen].sum() == best
+
+
+def test_assignment_stops_when_a_shift_cannot_be_filled(tmp_path):
+    # 5 people, 4 team members at each SWAP (every 2 hours), while the day TTR is 4 hours
+    file_name = str(tmp_path / "small.xlsx")
+    benchmark.generate_workbook(file_name, people=5, positions=2, team_size=2, pattern="2h", density=0, days=7, seed=1)
+    cfg = scheduler.SchedulerCfg(input_file_name=file_name, num_of_positions=2, seed=1, engine="assignment")
+    workbook_state = quiet(scheduler.parse_input_file, cfg, benchmark.PREV_DATE)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), pytest.raises(SystemExit):
+        scheduler.Scheduler(cfg).plan(workbook_state, days=1)
+    assert output.getvalue().startswith("Error: At 3:00, 1 people are available for 4 team members")
+
+    # More team members than people
+    import numpy as np
+    with pytest.raises(SystemExit):
+        quiet(scheduler.solve_assignment, np.zeros((3, 2)))
+
+
+##################################################################################
+# Post-processing (--optimize)
+##################################################################################
+
+@pytest.mark.parametrize("pattern", ["2h", "mixed"])
+def test_replay_of_a_build_gives_the_state_of_the_build(tmp_path, pattern):
+    # "mixed" resizes the teams (a person is added in the day hours, then released)
+    file_name = str(tmp_path / "synthetic.xlsx")
+    benchmark.generate_workbook(file_name, people=40, positions=3, team_size=2, pattern=pattern, density=0.1, days=7, seed=1)
+    cfg = scheduler.SchedulerCfg(input_file_name=file_name, num_of_positions=3, seed=2)
+    workbook_state = quiet(scheduler.parse_input_file, cfg, benchmark.PREV_DATE)
+    planner = scheduler.Scheduler(cfg)
+    result = quiet(planner.plan, workbook_state, days=3)
+    users_state = result.users_db.get_state()
+    teams_state = result.users_db.teams_db.get_state()
+    violations = list(result.violations)
+
+    quiet(planner.replay_result, workbook_state, result)
+    assert result.users_db is not workbook_state.users_db
+    assert result.users_db.get_state() == users_state
+    assert result.users_db.teams_db.get_state() == teams_state
+    assert result.violations == violations
+
+
+def test_optimize_does_not_add_position_repeats(workbook):
+    def count_repeats(result):
+        # New shifts of a person at the position of their previous shift
+        repeats = 0
+        prev = {}
+        for _, day in result.days:
+            for hour, line in enumerate(day.to_schedule()):
+                for position, team in enumerate(line):
+                    for name in team:
+                        if name in prev and prev[name][0] == position and prev[name][1] != hour - 1:
+                            repeats += 1
+                        prev[name] = (position, hour)
+            prev = {name: (position, hour - scheduler.HOURS_IN_DAY) for name, (position, hour) in prev.items()}
+        return repeats
+
+    _, built = plan(workbook, 4, seed=3)
+    _, optimized = plan(workbook, 4, seed=3, optimize_iterations=3000)
+    assert count_repeats(optimized) <= count_repeats(built)
+
+
+def test_optimize_keeps_users_db_in_sync_with_final_schedule(workbook):
+    planner, result = plan(workbook, 4, seed=3, optimize_iterations=3000)
+    users_db = result.users_db
+    assert planner.users_db is users_db
+
+    # Served hours and last position of each person, from the final days
+    total_hours = {}
+    prev_position = {}
+    for _, day in result.days:
+        for hour, line in enumerate(day.to_schedule()):
+            for position, team in enumerate(line):
+                for name in team:
+                    total_hours[name] = total_hours.get(name, 0) + 1
+                    prev_position[name] = position
+
+    for name, i in users_db.ids.items():
+        # The previous schedule of the synthetic workbook is empty
+        assert users_db.total_hours[i] == total_hours.get(name, 0)
+        assert users_db.prev_position[i] == prev_position.get(name, -1)
+    assert result.violations == planner.validator.violations
+
+
+##################################################################################
+# Streaming: generate() and the sinks
+##################################################################################
+
+# Keeps what it gets, calls error() at a given day
+class RecordingSink(scheduler.ScheduleSink):
+    def __init__(self, error_at_day=None):
+        self.days = []
+        self.closed = self.aborted = 0
+        self.error_at_day = error_at_day
+
+    def add_day(self, date_str, schedule):
+        if len(self.days) == self.error_at_day:
+            scheduler.error(f"Stop at {date_str}")
+        self.days.append(date_str)
+
+    def close(self):
+        self.closed += 1
+
+    def abort(self):
+        self.aborted += 1
+
+
+def test_generate_builds_each_day_when_requested(workbook):
+    cfg = scheduler.SchedulerCfg(input_file_name=workbook, num_of_positions=2, seed=1)
+    workbook_state = quiet(scheduler.parse_input_file, cfg, benchmark.PREV_DATE)
+    planner = scheduler.Scheduler(cfg)
+    days = planner.generate(workbook_state, 3)
+    # The previous schedule of the synthetic workbook is empty
+    assert planner.users_db.total_hours.sum() == 0
+
+    date_str, schedule = next(days)
+    assert date_str == "2024-01-02"
+    assert planner.users_db.total_hours.sum() == sum(len(team) for line in schedule for team in line)
+    assert [date_str for date_str, _ in days] == ["2024-01-03", "2024-01-04"]
+
+
+def test_sinks_get_all_days_then_close(workbook, tmp_path):
+    csv_file_name = str(tmp_path / "days.csv")
+    _, result = plan(workbook, 3, seed=1)
+    days = [(date_str, day.to_schedule()) for date_str, day in result.days]
+    sinks = [scheduler.CsvSink(csv_file_name, ["A", "B"]), RecordingSink()]
+    scheduler.stream_days(iter(days), sinks)
+
+    assert sinks[1].days == [date_str for date_str, _ in days]
+    assert (sinks[1].closed, sinks[1].aborted) == (1, 0)
+    with open(csv_file_name, encoding="utf-8") as file:
+        assert len(file.readlines()) == 1 + 3 * scheduler.HOURS_IN_DAY
+    # No temporary file is left
+    assert sorted(os.listdir(tmp_path)) == ["days.csv", "synthetic.xlsx"]
+
+
+def test_sinks_drop_partial_output_when_the_build_stops(workbook, tmp_path):
+    csv_file_name = str(tmp_path / "days.csv")
+    _, result = plan(workbook, 3, seed=1)
+    days = [(date_str, day.to_schedule()) for date_str, day in result.days]
+    sinks = [scheduler.CsvSink(csv_file_name, ["A", "B"]), RecordingSink(error_at_day=2)]
+    with pytest.raises(SystemExit):
+        quiet(scheduler.stream_days, iter(days), sinks)
+
+    assert sinks[1].days == [date_str for date_str, _ in days[:2]]
+    assert (sinks[1].closed, sinks[1].aborted) == (0, 1)
+    assert sorted(os.listdir(tmp_path)) == ["synthetic.xlsx"]
+
+
+##################################################################################
+# Checkpoint (--checkpoint, --resume)
+##################################################################################
+
+@pytest.mark.parametrize("policy", ["ttr_tier", "deficit"])
+def test_resume_continues_the_same_build(workbook, tmp_path, policy):
+    _, continuous = plan(workbook, 4, seed=5, policy=policy)
+
+    # Build 2 days with a checkpoint of each day, then resume from the last one
+    checkpoint_file_name = str(tmp_path / "checkpoint.json")
+    cfg = scheduler.SchedulerCfg(input_file_name=workbook, num_of_positions=2, seed=5, policy=policy,
+                                 checkpoint_file_name=checkpoint_file_name)
+    workbook_state = quiet(scheduler.parse_input_file, cfg, benchmark.PREV_DATE)
+    planner = scheduler.Scheduler(cfg)
+    quiet(scheduler.stream_days, planner.generate(workbook_state, 2), [scheduler.CheckpointSink(cfg, planner)])
+    checkpoint = scheduler.PlannerCheckpoint.load(checkpoint_file_name)
+    assert checkpoint.date_str == "2024-01-03"
+
+    # Without a seed, the resumed build continues the random sequence of the checkpoint
+    cfg = scheduler.SchedulerCfg(input_file_name=workbook, num_of_positions=2, policy=policy)
+    workbook_state = quiet(scheduler.parse_input_file, cfg, checkpoint.date_str, checkpoint)
+    planner = scheduler.Scheduler(cfg)
+    resumed = quiet(planner.plan, workbook_state, days=2)
+
+    assert [date_str for date_str, _ in resumed.days] == [date_str for date_str, _ in continuous.days[2:]]
+    for (_, day), (_, continuous_day) in zip(resumed.days, continuous.days[2:]):
+        assert day.to_schedule() == continuous_day.to_schedule()
+    assert planner.users_db.get_state() == continuous.users_db.get_state()
+    assert planner.users_db.teams_db.get_state() == continuous.users_db.teams_db.get_state()
+
+
+def test_resume_after_optimize_keeps_the_rest_rules(workbook, tmp_path):
+    checkpoint_file_name = str(tmp_path / "checkpoint.json")
+    planner, result = plan(workbook, 3, seed=3, optimize_iterations=3000, checkpoint_file_name=checkpoint_file_name)
+    days = ((date_str, schedule.to_schedule()) for date_str, schedule in result.days)
+    quiet(scheduler.stream_days, days, [scheduler.CheckpointSink(planner.cfg, planner)])
+
+    # Continue with another seed, as a later run would
+    checkpoint = scheduler.PlannerCheckpoint.load(checkpoint_file_name)
+    assert checkpoint.date_str == result.days[-1][0]
+    cfg = scheduler.SchedulerCfg(input_file_name=workbook, num_of_positions=2, seed=4)
+    workbook_state = quiet(scheduler.parse_input_file, cfg, checkpoint.date_str, checkpoint)
+    resumed = quiet(scheduler.Scheduler(cfg).plan, workbook_state, days=2)
+
+    assert not [message for message in resumed.violations if "hours of rest" in message]
+    # The last day of the first run, and the resumed days (exits on a violation)
+    quiet(scheduler.verify, cfg, workbook_state.users_db.valid_names, resumed.total_schedule)
+
+
+##################################################################################
+# Analysis of existing schedules (--analyze)
+##################################################################################
+
+def test_analyze_reports_violations_of_existing_sheets(workbook):
+    _, result = plan(workbook, 2, seed=1)
+    days = [(date_str, day.to_schedule()) for date_str, day in result.days]
+
+    # Someone who served at 02:00 (a night hour) of the second day serves again at 06:00, with 3 hours of rest
+    schedule = days[1][1]
+    name = schedule[2][0][0]
+    assert name not in schedule[6][1]
+    schedule[6][1][0] = name
+
+    import openpyxl
+    xls = openpyxl.load_workbook(workbook)
+    position_names = [f"Position {position + 1}" for position in range(2)]
+    for date_str, day in days:
+        scheduler.write_schedule_to_xls(xls, day, date_str, position_names)
+    xls.save(workbook)
+
+    cfg = scheduler.SchedulerCfg(input_file_name=workbook, num_of_positions=2, seed=1, analyze_last_date=days[-1][0])
+    workbook_state, history = quiet(scheduler.parse_history, cfg, benchmark.PREV_DATE, cfg.analyze_last_date)
+    analyzer = scheduler.ScheduleAnalyzer(cfg)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        scheduler.stream_days(analyzer.generate(workbook_state, history), scheduler.get_sinks(cfg, analyzer, workbook_state))
+
+    output = output.getvalue()
+    # One report of each violation: the moved shift, and the original shift at 15:00 that follows it
+    assert "Rest rules violations (TTR, nights in a row): 2\n" in output
+    assert output.count(f"{name} got") == 2
+    assert f"At day 2, 6:00, {name} got 3 hours of rest, instead of 9\n" in output
+    assert f"At day 2, 15:00, {name} got 8 hours of rest, instead of 9\n" in output
+    assert "did not get his" not in output
+    # The analysis goes on to the fairness
+    assert "Total standard deviation" in output
+
+
+##################################################################################
+# Profile (--profile)
+##################################################################################
+
+def test_profile_run_peak_is_at_least_each_stage_peak(tmp_path):
+    import json
+    profile_file_name = str(tmp_path / "profile.json")
+    profiler = scheduler.Profiler(enabled=1)
+    profiler.start()
+    with profiler.stage("big"):
+        data = [bytes(1000) for _ in range(10000)]
+        del data
+    with profiler.stage("outer"):
+        with profiler.stage("inner"):
+            data = [bytes(1000) for _ in range(2000)]
+            del data
+        with profiler.stage("small"):
+            data = [0] * 10
+            del data
+    quiet(profiler.stop, profile_file_name)
+
+    with open(profile_file_name, encoding="utf-8") as file:
+        profile = json.load(file)
+    stages = {stage["name"]: stage for stage in profile["stages"]}
+    assert stages["big"]["peak_bytes"] >= 10000 * 1000
+    # The peak of an outer stage includes the peaks of the stages in it
+    assert stages["outer"]["peak_bytes"] >= stages["inner"]["peak_bytes"] >= 2000 * 1000
+    for stage in profile["stages"]:
+        assert profile["peak_bytes"] >= stage["peak_bytes"]
+
+
+##################################################################################
+# Fairness ledger (--ledger)
+##################################################################################
+
+def test_ledger_keeps_only_people_on_the_list(tmp_path):
+    cfg = scheduler.SchedulerCfg(num_of_positions=2)
+    valid_names = ["A", "B", "C"]
+    # Position 0: A and a person who is not on the list, position 1: an empty cell (team of size 0), then B,C
+    schedule = [[["A", "Ghost"], [""]] for _ in range(12)] + [[["A", "Ghost"], ["B", "C"]] for _ in range(12)]
+
+    ledger = scheduler.FairnessLedger(str(tmp_path / "ledger.db"))
+    ledger.set_days(cfg, [("2024-01-02", schedule)], [["A", "Ghost"], []], valid_names)
+    hours = ledger.get_hours("2024-01-03")
+    teams = ledger.get_teams("2024-01-03")
+    ledger.close()
+
+    assert sorted(hours) == ["A", "B", "C"]
+    assert hours["A"][0] == 24
+    assert hours["B"][0] == hours["C"][0] == 12
+    # A alone continues from the previous day, B,C is a new team
+    assert teams == [[["B", "C"], 1]]
+
+
+def test_ledger_is_written_only_with_write(workbook, tmp_path):
+    ledger_file_name = str(tmp_path / "ledger.db")
+    for do_write in [0, 1]:
+        cfg = scheduler.SchedulerCfg(input_file_name=workbook, num_of_positions=2, seed=1,
+                                     ledger_file_name=ledger_file_name, do_write=do_write)
+        workbook_state = quiet(scheduler.parse_input_file, cfg, benchmark.PREV_DATE)
+        planner = scheduler.Scheduler(cfg)
+        quiet(scheduler.load_ledger, cfg, workbook_state)
+        days = planner.generate(workbook_state, 2)
+        quiet(scheduler.stream_days, days, scheduler.get_sinks(cfg, planner, workbook_state))
+        # A dry run does not even create the ledger
+        assert os.path.exists(ledger_file_name) == bool(do_write)
+
+    ledger = scheduler.FairnessLedger(ledger_file_name)
+    hours = ledger.get_hours("2024-01-04")
+    ledger.close()
+    assert sum(total_hours for total_hours, _, _ in hours.values()) == planner.users_db.total_hours.sum()
+
+
+##################################################################################
+# Build counters (--counters)
+##################################################################################
+
+def test_counters_count_a_choice_per_team_member_in_both_engines(workbook):
+    counters = {}
+    for engine in scheduler.ENGINES:
+        planner, _ = plan(workbook, 3, seed=2, engine=engine, counters=1)
+        counters[engine] = planner.counters
+
+    # The greedy engine filters the candidates once more for each night fallback
+    greedy_choices = counters["greedy"].choices - counters["greedy"].night_fallbacks
+    assert (greedy_choices == counters["assignment"].choices).all()
+    assert counters["assignment"].choices.sum() > 0
+
+
+##################################################################################
+# Score index (--policy score)
+##################################################################################
+
+def test_score_index_lowest():
+    score_index = scheduler.ScoreIndex([3.0, 1.0, 2.0, 1.0])
+    assert score_index.get_lowest({0, 2, 3}) == 3
+    score_index.move(3, 5.0)
+    assert score_index.get_lowest({0, 2, 3}) == 2
+    # No user qualifies: not a valid id (-1 used to pick the last user)
+    assert score_index.get_lowest(set()) is None
+    assert score_index.get_lowest({7}) is None
+
+
+##################################################################################
+# Startup (--import_time)
+##################################################################################
+
+def test_loading_the_script_does_not_import_heavy_modules():
+    import subprocess
+    code = "import sys, scheduler; print([module for module in scheduler.HEAVY_MODULES if module in sys.modules])"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert output == "[]\n"